@@ -1,8 +1,84 @@
+"""
+Фикстуры UI-тестов.
+Зависимости тестов: pip install pytest selenium, для параллельного выполнения - pip install pytest-xdist
+(без него параметр -n не распознаётся, тесты выполняются последовательно командой pytest app/tests.py).
+Тесты можно выполнять параллельно процессами pytest-xdist (pytest app/tests.py -n auto): каждый процесс
+запускает один браузер Chrome без окна на всю сессию, между тестами браузер не перезапускается, а очищается.
+Адрес сайта задаётся параметром --base-url (или переменной окружения BASE_URL), значение local - локальный
+сайт из каталога site, повторяющий страницы поиска, подсказок и просмотра изображений, тесты с ним не требуют сети.
+"""
+import functools
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
 import pytest
 from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+
+SITE = Path(__file__).parent / 'site'
+
+
+def pytest_addoption(parser):
+    parser.addoption('--base-url', default=os.environ.get('BASE_URL', 'https://yandex.ru/'),
+                     help='адрес тестируемого сайта, local - локальный сайт из каталога site')
+    parser.addoption('--headed', action='store_true', help='показывать окно браузера')
+    parser.addoption('--chromedriver', default=os.environ.get('CHROMEDRIVER'),
+                     help='путь к chromedriver (по умолчанию драйвер находит Selenium Manager)')
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """
+    раздача файлов локального сайта без записи запросов в вывод тестов
+    """
+    def log_message(self, format, *args):
+        pass
+
 
 @pytest.fixture(scope="session")
-def browser():
-    driver = webdriver.Chrome(executable_path="chromedriver")
+def base_url(request):
+    """
+    адрес тестируемого сайта, для local - запуск локального сервера на свободном порту (свой в каждом процессе)
+    """
+    url = request.config.getoption('--base-url')
+    if url != 'local':
+        yield url if url.endswith('/') else url + '/'
+        return
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(SITE)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def driver(request):
+    """
+    браузер процесса тестов, запускается один раз на сессию
+    """
+    options = webdriver.ChromeOptions()
+    if not request.config.getoption('--headed'):
+        options.add_argument('--headless=new')
+    for argument in ('--no-sandbox', '--disable-dev-shm-usage', '--window-size=1366,768'):
+        options.add_argument(argument)
+    driver = webdriver.Chrome(service=Service(request.config.getoption('--chromedriver')), options=options)
+    yield driver
+    driver.quit()
+
+
+@pytest.fixture
+def browser(driver):
+    """
+    браузер для одного теста, после теста - сброс состояния: лишние вкладки закрываются,
+    cookies и хранилища очищаются, открывается пустая страница
+    """
     yield driver
-    driver.quit()
\ No newline at end of file
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(handles[0])
+    driver.delete_all_cookies()
+    driver.execute_script('try { localStorage.clear(); sessionStorage.clear(); } catch (e) {}')
+    driver.get('about:blank')
@@ -3,8 +3,8 @@ from yandex import YandexActions
 
 class TestYandex:
 
-    def test_1(self, browser):
-        yandex_main_page = YandexActions(browser)
+    def test_1(self, browser, base_url):
+        yandex_main_page = YandexActions(browser, base_url)
         yandex_main_page.go_to_site()
         input_box = yandex_main_page.get_input_box()
         assert input_box is not None
@@ -16,13 +16,13 @@ class TestYandex:
         links = yandex_main_page.get_search_results_links("tensor.ru", limit)
         assert len(links) == limit
 
-    def test_2(self, browser):
-        yandex_main_page = YandexActions(browser)
+    def test_2(self, browser, base_url):
+        yandex_main_page = YandexActions(browser, base_url)
         yandex_main_page.go_to_site()
         nav_images_link = yandex_main_page.get_navigation_link('Картинки')
         yandex_main_page.open_link(nav_images_link)
 
-        assert "https://yandex.ru/images/" in browser.current_url
+        assert f"{base_url}images/" in browser.current_url
         # получаем список категорий изображений
         img_cats = yandex_main_page.get_images_categories()
         # получаем ссылку на первую категорию
@@ -1,31 +1,147 @@
+import json
+from time import monotonic, sleep
+
+from selenium.common.exceptions import StaleElementReferenceException, TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
+# поиск элементов и извлечение значений в браузере за одно обращение к драйверу:
+# ожидание появления элементов по изменениям документа (MutationObserver) вместо опроса,
+# результат - найденные элементы или JSON со значениями их полей, null по истечении времени
+WAIT_SCRIPT = """
+const [by, selector, fields, limit, timeout, done] = arguments;
+const find = () => {
+    if (by === 'xpath') {
+        const result = document.evaluate(selector, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+        return Array.from({length: result.snapshotLength}, (_, i) => result.snapshotItem(i));
+    }
+    return Array.from(document.querySelectorAll(selector));
+};
+// как WebElement.get_attribute: свойство элемента, если оно есть, иначе атрибут
+const property = (element, name) => {
+    const value = element[name];
+    return ['string', 'number', 'boolean'].includes(typeof value) ? value : element.getAttribute(name);
+};
+const value = (element, field) => {
+    if (field === 'text') return element.textContent.trim();
+    if (!field.startsWith('.')) return property(element, field);
+    // относительный XPath: атрибут (./a/@href) или текст дочернего элемента
+    const node = document.evaluate(field, element, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    if (node === null) return null;
+    if (node.nodeType === Node.ATTRIBUTE_NODE) return property(node.ownerElement, node.name);
+    return node.textContent.trim();
+};
+const collect = () => {
+    let elements = find();
+    if (elements.length === 0) return null;
+    if (limit !== null) elements = elements.slice(0, limit);
+    if (fields === null) return elements;
+    return JSON.stringify(elements.map(
+        (element) => Object.fromEntries(Object.entries(fields).map(([name, field]) => [name, value(element, field)]))));
+};
+const result = collect();
+if (result !== null) return done(result);
+let timer = null;
+const observer = new MutationObserver(() => {
+    const result = collect();
+    if (result !== null) finish(result);
+});
+const finish = (result) => {
+    observer.disconnect();
+    clearTimeout(timer);
+    done(result);
+};
+observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+timer = setTimeout(() => finish(null), timeout);
+"""
+
+# наибольшее время одного ожидания в браузере в секундах (меньше времени выполнения скрипта драйвера по умолчанию),
+# более долгое ожидание выполняется несколькими вызовами
+SCRIPT_WAIT = 25
+
+# ошибки драйвера при смене документа во время выполнения скрипта (переход по ссылке)
+NAVIGATION_ERRORS = ('document unloaded', 'context was destroyed', 'Cannot find context')
+
 
 class WebPage:
+    # интервал опроса ожиданий WebDriverWait и повтора ожидания после смены документа
+    poll_interval = 0.05
 
-    def __init__(self, driver):
+    def __init__(self, driver, base_url="https://yandex.ru/", poll_interval=None):
         self.driver = driver
-        self.base_url = "https://yandex.ru/"
+        self.base_url = base_url
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+
+    @staticmethod
+    def _selector(locator):
+        """
+        локатор в виде XPath или CSS-селектора
+        """
+        by, value = locator
+        if by in (By.XPATH, By.CSS_SELECTOR):
+            return by, value
+        if by == By.ID:
+            return By.CSS_SELECTOR, f'[id="{value}"]'
+        if by == By.NAME:
+            return By.CSS_SELECTOR, f'[name="{value}"]'
+        if by == By.CLASS_NAME:
+            return By.CSS_SELECTOR, f'.{value}'
+        if by == By.TAG_NAME:
+            return By.CSS_SELECTOR, value
+        raise ValueError(f"Unsupported locator {locator}")
+
+    def _wait(self, locator, fields, limit, time, message):
+        """
+        ожидание появления элементов и их получение или извлечение значений полей (см. WAIT_SCRIPT)
+        """
+        by, selector = self._selector(locator)
+        deadline = monotonic() + time
+        while True:
+            remaining = min(max(deadline - monotonic(), 0), SCRIPT_WAIT)
+            try:
+                result = self.driver.execute_async_script(WAIT_SCRIPT, by, selector, fields, limit, remaining * 1000)
+            except StaleElementReferenceException:
+                result = None
+            except WebDriverException as ex:
+                # документ сменился во время ожидания - ожидание на новом документе, остальные ошибки не скрываются
+                if not any(error in (ex.msg or '') for error in NAVIGATION_ERRORS):
+                    raise
+                result = None
+            if result is not None:
+                return result if fields is None else json.loads(result)
+            if monotonic() >= deadline:
+                raise TimeoutException(message)
+            sleep(self.poll_interval)
+
+    def query(self, locator, fields, limit=None, time=10):
+        """
+        значения полей всех найденных элементов за одно обращение к драйверу
+        fields - словарь {название: поле}, поле - text (текст элемента), имя свойства или атрибута элемента
+        или относительный XPath (./a/@href - атрибут дочернего элемента, ./span - текст дочернего элемента)
+        limit - наибольшее количество элементов
+        :return: список словарей {название: значение} в порядке элементов в документе
+        """
+        return self._wait(locator, fields, limit, time, f"Can't find elements by locator {locator}")
 
     def find_element(self, locator,time=10):
-        return WebDriverWait(self.driver,time).until(EC.presence_of_element_located(locator),
-                                                      message=f"Can't find element by locator {locator}")
+        return self._wait(locator, None, 1, time, f"Can't find element by locator {locator}")[0]
 
     def find_elements(self, locator,time=10):
-        return WebDriverWait(self.driver,time).until(EC.presence_of_all_elements_located(locator),
-                                                      message=f"Can't find elements by locator {locator}")
+        return self._wait(locator, None, None, time, f"Can't find elements by locator {locator}")
 
     def go_to_site(self):
         return self.driver.get(self.base_url)
 
     def wait_for_page_loads(self,time=10):
-        return WebDriverWait(self.driver, 10).until(lambda d: d.execute_script('return document.readyState') == 'complete')
+        return WebDriverWait(self.driver, time, poll_frequency=self.poll_interval).until(
+            lambda d: d.execute_script('return document.readyState') == 'complete')
 
     def open_new_page(self, link, time=10):
         windows_before = self.driver.window_handles
         self.driver.execute_script(f'window.open("{link}","_blank");')
-        WebDriverWait(self.driver, 120).until(EC.new_window_is_opened(windows_before))
+        WebDriverWait(self.driver, 120, poll_frequency=self.poll_interval).until(EC.new_window_is_opened(windows_before))
         wnd_handles = self.driver.window_handles
         window_after = self.driver.window_handles[len(wnd_handles)-1]
         self.driver.switch_to.window(window_after)
@@ -27,8 +27,8 @@ class YandexActions(WebPage):
         """
         получить текст из строки поиска
         """
-        input_field = self.find_element(YandexSeacrhLocators.LOCATOR_YANDEX_INPUT_FIELD)
-        return input_field.get_attribute('value')
+        input_field, = self.query(YandexSeacrhLocators.LOCATOR_YANDEX_INPUT_FIELD, {'value': 'value'}, limit=1)
+        return input_field['value']
 
     def enter_word(self, word):
         """
@@ -57,10 +57,10 @@ class YandexActions(WebPage):
         получить результаты поиска содержащие указанную ссылку
         limit - количество получаемых результатов
         """
-        search_results = self.find_elements(YandexSeacrhLocators.LOCATOR_YANDEX_SEARCH_RESULTS)
+        search_results = self.query(YandexSeacrhLocators.LOCATOR_YANDEX_SEARCH_RESULTS, {'href': 'href'}, limit=limit)
         links = []
-        for _, search_item in zip(range(limit), search_results):
-            href = search_item.get_attribute('href')
+        for search_item in search_results:
+            href = search_item['href']
             if link not in href: break
             else: links.append(href)
         return links
@@ -85,8 +85,8 @@ class YandexActions(WebPage):
         """
         получить элементы категорий изображений
         """
-        img_cats = self.find_elements(YandexSeacrhLocators.LOCATOR_YANDEX_IMG_CATEGORIES)
-        img_catefories = [{item.get_attribute('data-grid-text'): item.find_element(By.XPATH, './a').get_attribute('href')} for item in img_cats]
+        img_cats = self.query(YandexSeacrhLocators.LOCATOR_YANDEX_IMG_CATEGORIES, {'text': 'data-grid-text', 'href': './a/@href'})
+        img_catefories = [{item['text']: item['href']} for item in img_cats]
         return img_catefories
 
     def get_thumbs_in_images(self):
@@ -109,8 +109,8 @@ class YandexActions(WebPage):
         получить источник открытого изображения
         """
         locator = (By.XPATH, f'//img[@class="MMImage-Origin"]')
-        source = self.find_element(locator).get_attribute('src')
-        return source
+        image, = self.query(locator, {'src': 'src'}, limit=1)
+        return image['src']
 
     def open_link(self, element):
         """
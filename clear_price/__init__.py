@@ -0,0 +1,3 @@
+"""
+Пакет расчёта скорректированной ("очищенной") цены валюты относительно валюты, оказывающей на неё влияние
+"""
@@ -0,0 +1,158 @@
+"""
+Сообщения о выходе скорректированных цен за экстремумы.
+Расчёт только кладёт сообщение в очередь (без ожидания), отправка получателям выполняется
+отдельной задачей asyncio, поэтому медленный получатель не задерживает обработку таймфреймов.
+Получатели: терминал, файл JSONL, канал Redis (pub/sub), webhook.
+"""
+import asyncio
+import json
+import logging
+import sys
+import time
+import urllib.request
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+
+from clear_price.metrics import LatencyMetrics
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # отправка в Redis доступна только при установленном redis
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Alert:
+    """
+    выход скорректированной цены за экстремум
+    """
+    time: int  # время таймфрейма в наносекундах от эпохи
+    follower: str  # ведомая валюта
+    deviation: float  # процент выхода за максимум (положительный) или за минимум (отрицательный)
+    clear_price: float
+    created: int  # время расчёта (time.time_ns()), от него считается задержка отправки
+    horizon: int | None = None  # длина окна дополнительного горизонта в таймфреймах (None - основное окно)
+
+    @property
+    def message(self) -> str:
+        direction = 'превысила максимальную' if self.deviation > 0 else 'уменьшилась от минимальной'
+        history = 'прошедшую историю' if self.horizon is None else f'последние {self.horizon} таймфреймов'
+        return (f'{datetime.fromtimestamp(self.time / 1e9)} цена {self.follower}(CLEAR) {direction} '
+                f'за {history} на {abs(self.deviation)}')
+
+
+class StdoutSink:
+    """
+    вывод сообщений в терминал
+    """
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    async def send(self, alert: Alert):
+        self.stream.write(alert.message + '\n')
+        self.stream.flush()
+
+    async def close(self):
+        pass
+
+
+class JsonlSink:
+    """
+    запись сообщений в файл, по объекту JSON в строке
+    """
+    def __init__(self, path: str | Path):
+        self.file = open(path, 'a')
+
+    async def send(self, alert: Alert):
+        self.file.write(json.dumps(asdict(alert)) + '\n')
+        self.file.flush()
+
+    async def close(self):
+        self.file.close()
+
+
+class RedisSink:
+    """
+    Публикация сообщений в канал Redis. По умолчанию - канал orders_and_prices, который слушает node.js:
+    сообщение - объект {ключ: данные}, ключ - ведомая валюта с суффиксом (ALERT): под ключом с суффиксом (CLEAR)
+    в тот же канал публикуются бары скорректированных цен (см. TimeSeriesPublisher) с тем же временем
+    """
+    def __init__(self, url: str = 'redis://localhost:6379', channel: str = 'orders_and_prices'):
+        if aioredis is None:
+            raise ImportError('Для отправки сообщений в Redis нужен пакет redis')
+        self.client = aioredis.from_url(url)
+        self.channel = channel
+
+    async def send(self, alert: Alert):
+        payload = {f'{alert.follower}(ALERT)': {'time': alert.time // 1_000_000, 'clear': alert.clear_price,
+                                                  'deviation': alert.deviation, 'horizon': alert.horizon}}
+        await self.client.publish(self.channel, json.dumps(payload))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class WebhookSink:
+    """
+    отправка сообщений POST-запросом с телом JSON (запрос выполняется в отдельном потоке)
+    """
+    def __init__(self, url: str, timeout: float = 5):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, body: bytes):
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    async def send(self, alert: Alert):
+        await asyncio.to_thread(self._post, json.dumps(asdict(alert) | {'message': alert.message}).encode())
+
+    async def close(self):
+        pass
+
+
+class AlertDispatcher:
+    """
+    очередь сообщений и их отправка всем получателям
+    """
+    def __init__(self, sinks: list, metrics: LatencyMetrics | None = None, queue_size: int = 10_000):
+        """
+        :param sinks: получатели (объекты с сопрограммами send(alert) и close())
+        :param metrics: гистограммы задержек, задержка отправки записывается в этап alert
+        :param queue_size: размер очереди, при переполнении новые сообщения отбрасываются
+        """
+        self.sinks = sinks
+        self.metrics = metrics
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.dropped = 0  # количество отброшенных сообщений
+
+    def emit(self, alert: Alert):
+        """
+        постановка сообщения в очередь без ожидания (вызывается из потока цикла событий)
+        """
+        try:
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        """
+        отправка сообщений из очереди, ошибка одного получателя не мешает остальным
+        """
+        try:
+            while True:
+                alert = await self.queue.get()
+                results = await asyncio.gather(*(sink.send(alert) for sink in self.sinks), return_exceptions=True)
+                for sink, result in zip(self.sinks, results):
+                    if isinstance(result, Exception):
+                        logger.error(f'Ошибка отправки сообщения в {type(sink).__name__}: {result!r}')
+                if self.metrics is not None:
+                    self.metrics.record('alert', time.time_ns() - alert.created)
+                self.queue.task_done()
+        finally:
+            for sink in self.sinks:
+                await sink.close()
@@ -0,0 +1,148 @@
+"""
+Векторный расчёт скорректированных цен и выходов за экстремумы по всей истории баров сразу.
+Результат совпадает с последовательной обработкой баров через PairEngine.on_bar
+(get_clear_price + check_for_extremum), но считается без цикла по барам:
+скользящие суммы и экстремумы окна находятся блочным методом - ряд делится на блоки длиной окна,
+окно, заканчивающееся в блоке, состоит из конца предыдущего блока и начала текущего,
+поэтому накопленные суммы не выходят за два блока и ошибка округления не растёт с длиной ряда.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+from clear_price.correlation import FLAT_STD
+from clear_price.pairs import extremum_deviation
+
+# количество блоков окна, обрабатываемых за один раз (ограничивает потребление памяти)
+CHUNK_BLOCKS = 256
+
+
+def _blocked(x: np.ndarray, window: int, fill: float, accumulate) -> np.ndarray:
+    """
+    скользящая свёртка accumulate (np.add, np.fmax, np.fmin) окна длиной window вдоль первой оси,
+    первые window - 1 значений считаются по расширяющемуся окну
+    """
+    n = len(x)
+    blocks = -(-n // window)
+    padded = np.full((blocks * window, *x.shape[1:]), fill)
+    padded[:n] = x
+    padded = padded.reshape(blocks, window, *x.shape[1:])
+    prefix = accumulate.accumulate(padded, axis=1)
+    # suffix[b, j] - свёртка значений блока b от позиции j + 1 до конца блока
+    suffix = np.full_like(padded, fill)
+    suffix[:, :-1] = accumulate.accumulate(padded[:, :0:-1], axis=1)[:, ::-1]
+    result = prefix.copy()
+    result[1:] = accumulate(suffix[:-1], prefix[1:])
+    return result.reshape(blocks * window, *x.shape[1:])[:n]
+
+
+def rolling_sum(x: np.ndarray, window: int) -> np.ndarray:
+    """
+    :return: суммы последних window значений (для начала ряда - всех значений)
+    """
+    return _blocked(x, window, 0.0, np.add)
+
+
+def rolling_max(x: np.ndarray, window: int) -> np.ndarray:
+    """
+    :return: максимумы последних window значений без учёта nan
+    """
+    return _blocked(x, window, np.nan, np.fmax)
+
+
+def rolling_min(x: np.ndarray, window: int) -> np.ndarray:
+    """
+    :return: минимумы последних window значений без учёта nan
+    """
+    return _blocked(x, window, np.nan, np.fmin)
+
+
+def clear_price_series(main: np.ndarray, influenced: np.ndarray, window: int) -> np.ndarray:
+    """
+    Скорректированные цены всех баров (аналог RollingCorrelation.clear_price для каждого бара)
+    :param main: цены ведомой валюты, форма (бары,) или (бары, пары)
+    :param influenced: цены ведущей валюты той же формы
+    :param window: размер анализируемой истории в барах
+    :return: скорректированные цены (nan, если корректировка невозможна)
+    """
+    n = np.minimum(np.arange(1, len(main) + 1), window).reshape(-1, *([1] * (main.ndim - 1)))
+    # ряды сдвигаются к нулю для уменьшения ошибки при вычитании больших сумм
+    x = main - main[0]
+    y = influenced - influenced[0]
+    sum_x, sum_y = rolling_sum(x, window), rolling_sum(y, window)
+    mean_x, mean_y = sum_x / n, sum_y / n
+    m2_x = rolling_sum(x * x, window) - sum_x * mean_x
+    m2_y = rolling_sum(y * y, window) - sum_y * mean_y
+    c_xy = rolling_sum(x * y, window) - sum_x * mean_y
+    flat = (m2_x <= n * (FLAT_STD * (mean_x + main[0])) ** 2) | (m2_y <= n * (FLAT_STD * (mean_y + influenced[0])) ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(flat, np.nan, main - (y - mean_y) * c_xy / m2_y)
+
+
+def extremum_series(clear: np.ndarray, window: int, percent: float) -> np.ndarray:
+    """
+    Выход скорректированных цен за экстремумы предыдущих window баров (аналог extremum_deviation для каждого бара)
+    :param clear: скорректированные цены
+    :param window: размер анализируемой истории в барах
+    :param percent: необходимый процент выхода за экстремум
+    :return: процент выхода за максимум (положительный) или за минимум (отрицательный), 0 - выхода нет
+    """
+    max_ = np.full_like(clear, np.nan)
+    min_ = np.full_like(clear, np.nan)
+    max_[1:] = rolling_max(clear, window)[:-1]
+    min_[1:] = rolling_min(clear, window)[:-1]
+    return extremum_deviation(clear, max_, min_, percent)
+
+
+class BacktestResult(NamedTuple):
+    clear: np.ndarray  # скорректированные цены
+    deviation: np.ndarray  # выходы за экстремумы в процентах (0 - выхода нет)
+
+    @property
+    def events(self) -> np.ndarray:
+        """
+        :return: индексы баров (и пар) с выходом за экстремум
+        """
+        return np.argwhere(self.deviation)
+
+
+def backtest(main: np.ndarray, influenced: np.ndarray, window: int, percent: float,
+             chunk_blocks: int = CHUNK_BLOCKS) -> BacktestResult:
+    """
+    Расчёт скорректированных цен и выходов за экстремумы по всей истории.
+    Длинные ряды обрабатываются частями по chunk_blocks окон с перекрытием в два окна,
+    которого достаточно для статистик и экстремумов первого бара части
+    :param main: цены ведомой валюты, форма (бары,) или (бары, пары)
+    :param influenced: цены ведущей валюты той же формы
+    :param window: размер анализируемой истории в барах
+    :param percent: необходимый процент выхода за экстремум
+    :param chunk_blocks: размер части в окнах
+    :return: скорректированные цены и выходы за экстремумы
+    """
+    main = np.asarray(main, dtype=np.float64)
+    influenced = np.asarray(influenced, dtype=np.float64)
+    clear = np.empty_like(main)
+    deviation = np.empty_like(main)
+    step = window * chunk_blocks
+    for start in range(0, len(main), step):
+        begin = max(0, start - 2 * window)
+        end = min(len(main), start + step)
+        part_clear = clear_price_series(main[begin:end], influenced[begin:end], window)
+        part_deviation = extremum_series(part_clear, window, percent)
+        clear[start:end] = part_clear[start - begin:]
+        deviation[start:end] = part_deviation[start - begin:]
+    return BacktestResult(clear, deviation)
+
+
+def sweep(main: np.ndarray, influenced: np.ndarray, windows: list[int], percents: list[float]) -> dict:
+    """
+    Перебор параметров: скорректированные цены считаются один раз на размер истории,
+    проверка на экстремумы - для каждого процента
+    :return: словарь {(размер истории, процент): количество выходов за экстремумы}
+    """
+    result = {}
+    for window in windows:
+        clear = backtest(main, influenced, window, max(percents)).clear
+        for percent in percents:
+            result[window, percent] = int(np.count_nonzero(extremum_series(clear, window, percent)))
+    return result
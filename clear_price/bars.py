@@ -0,0 +1,154 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from clear_price.ingest import Trades
+
+
+class Bars(NamedTuple):
+    """
+    бары всех валют за один таймфрейм, массивы в порядке символов агрегатора
+    """
+    time: int  # время начала таймфрейма в наносекундах от эпохи
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+    vwap: np.ndarray  # средневзвешенная по объёму цена
+    count: np.ndarray  # количество сделок
+
+
+class BarAggregator:
+    """
+    Агрегация сделок в бары по биржевому времени сделок.
+    Сделка относится к таймфрейму [k * tf, (k + 1) * tf) по своему времени T, поэтому бары не зависят
+    от задержек доставки и планировщика, а бары всех валют за таймфрейм выдаются одновременно.
+    Таймфрейм закрывается, когда время самой поздней полученной сделки превышает его конец на lateness,
+    сделки, пришедшие после закрытия своего таймфрейма, отбрасываются (счётчик late).
+    Накопители открытых таймфреймов предвыделены: кольцо из lateness // tf + 2 слотов на все валюты.
+    Если по валюте за таймфрейм не было сделок, все цены бара равны последней цене закрытия
+    """
+    def __init__(self, symbols: list[str], tf_ns: int, lateness_ns: int = 0):
+        """
+        :param symbols: символы валют
+        :param tf_ns: размер таймфрейма в наносекундах
+        :param lateness_ns: допустимое опоздание сделок в наносекундах
+        """
+        self.symbols = symbols
+        self.index = {symbol: i for i, symbol in enumerate(symbols)}
+        self.tf_ns = tf_ns
+        self.lateness_ns = lateness_ns
+        slots = lateness_ns // tf_ns + 2
+        shape = (slots, len(symbols))
+        self._open = np.zeros(shape)
+        self._high = np.full(shape, -np.inf)
+        self._low = np.full(shape, np.inf)
+        self._close = np.zeros(shape)
+        self._volume = np.zeros(shape)
+        self._pv = np.zeros(shape)  # суммы цена * объём
+        self._count = np.zeros(shape, dtype=np.int64)
+        # время первой и последней сделки - пачки могут пересекаться по времени
+        self._first_time = np.full(shape, np.iinfo(np.int64).max)
+        self._last_time = np.full(shape, np.iinfo(np.int64).min)
+        self._slot_bucket = np.full(slots, -1, dtype=np.int64)  # номер таймфрейма в слоте
+        self.next_bucket: int | None = None  # номер первого незакрытого таймфрейма
+        self.watermark = 0  # время, до которого таймфреймы можно закрывать
+        self.last_close = np.full(len(symbols), np.nan)
+        self.late = 0  # количество отброшенных опоздавших сделок
+
+    def _reset_slot(self, slot: int, bucket: int):
+        self._open[slot] = 0
+        self._high[slot] = -np.inf
+        self._low[slot] = np.inf
+        self._close[slot] = 0
+        self._volume[slot] = 0
+        self._pv[slot] = 0
+        self._count[slot] = 0
+        self._first_time[slot] = np.iinfo(np.int64).max
+        self._last_time[slot] = np.iinfo(np.int64).min
+        self._slot_bucket[slot] = bucket
+
+    def _emit(self) -> Bars:
+        bucket = self.next_bucket
+        slot = bucket % len(self._slot_bucket)
+        if self._slot_bucket[slot] != bucket:
+            self._reset_slot(slot, bucket)
+        traded = self._count[slot] > 0
+        close = np.where(traded, self._close[slot], self.last_close)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vwap = np.where(traded, self._pv[slot] / self._volume[slot], close)
+        bars = Bars(time=bucket * self.tf_ns,
+                    open=np.where(traded, self._open[slot], close),
+                    high=np.where(traded, self._high[slot], close),
+                    low=np.where(traded, self._low[slot], close),
+                    close=close, volume=self._volume[slot].copy(), vwap=vwap, count=self._count[slot].copy())
+        self.last_close = close
+        self._slot_bucket[slot] = -1
+        self.next_bucket += 1
+        return bars
+
+    def advance(self, watermark: int) -> list[Bars]:
+        """
+        закрытие таймфреймов, которые заканчиваются не позже watermark
+        :param watermark: время в наносекундах от эпохи
+        :return: закрытые бары в порядке времени
+        """
+        self.watermark = max(self.watermark, watermark)
+        closed = []
+        if self.next_bucket is not None:
+            while (self.next_bucket + 1) * self.tf_ns <= self.watermark:
+                closed.append(self._emit())
+        return closed
+
+    def add(self, trades: dict[str, Trades]) -> list[Bars]:
+        """
+        добавление пачки сделок
+        :param trades: словарь {символ валюты: сделки}
+        :return: закрытые в результате бары в порядке времени
+        """
+        known = [(self.index[symbol], columns) for symbol, columns in trades.items() if symbol in self.index]
+        if not known:
+            return []
+        # сделки всех валют объединяются и упорядочиваются по биржевому времени
+        sym = np.concatenate([np.full(len(columns.price), i) for i, columns in known])
+        price = np.concatenate([columns.price for _, columns in known])
+        qty = np.concatenate([columns.qty for _, columns in known])
+        ticktime = np.concatenate([columns.time for _, columns in known])
+        order = np.argsort(ticktime, kind='stable')
+        sym, price, qty, ticktime = sym[order], price[order], qty[order], ticktime[order]
+        bucket = ticktime // self.tf_ns
+        if self.next_bucket is None:
+            self.next_bucket = int(bucket[0])
+
+        closed = []
+        # сделки обрабатываются группами по таймфреймам
+        bounds = np.flatnonzero(np.diff(bucket)) + 1
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(bucket)]):
+            b = int(bucket[start])
+            if b < self.next_bucket:
+                self.late += end - start
+                continue
+            closed += self.advance(int(ticktime[end - 1]) - self.lateness_ns)
+            self._accumulate(b, sym[start:end], price[start:end], qty[start:end], ticktime[start:end])
+        return closed
+
+    def _accumulate(self, bucket: int, sym: np.ndarray, price: np.ndarray, qty: np.ndarray, ticktime: np.ndarray):
+        slot = bucket % len(self._slot_bucket)
+        if self._slot_bucket[slot] != bucket:
+            self._reset_slot(slot, bucket)
+        # цена открытия - самая ранняя сделка валюты в таймфрейме, закрытия - самая поздняя
+        _, first = np.unique(sym, return_index=True)
+        first = first[ticktime[first] < self._first_time[slot, sym[first]]]
+        self._open[slot, sym[first]] = price[first]
+        self._first_time[slot, sym[first]] = ticktime[first]
+        _, last = np.unique(sym[::-1], return_index=True)
+        last = len(sym) - 1 - last
+        last = last[ticktime[last] >= self._last_time[slot, sym[last]]]
+        self._close[slot, sym[last]] = price[last]
+        self._last_time[slot, sym[last]] = ticktime[last]
+        np.maximum.at(self._high[slot], sym, price)
+        np.minimum.at(self._low[slot], sym, price)
+        np.add.at(self._volume[slot], sym, qty)
+        np.add.at(self._pv[slot], sym, price * qty)
+        np.add.at(self._count[slot], sym, 1)
@@ -0,0 +1,345 @@
+"""
+Тесты производительности этапов обработки на синтетических данных: коррелированные случайные блуждания цен
+и поток сделок с заданной частотой (генераторы детерминированы, seed задаётся).
+Каждый этап измеряется для разных размеров истории, количества пар и частоты сделок,
+результат - время одной операции в наносекундах (для handle_trades - одной сделки).
+Результаты записываются в JSON и сравниваются с сохранённым базовым прогоном,
+замедление больше допустимого считается регрессией (код завершения 1).
+Базовый прогон зависит от машины, его нужно обновлять при смене окружения (--output bench_baseline.json).
+
+Пример запуска:
+    python -m clear_price.bench --quick --baseline clear_price/bench_baseline.json --output bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from clear_price.alerts import AlertDispatcher
+from clear_price.bars import Bars
+from clear_price.book import OrderBook
+from clear_price.correlation import get_clear_price, lagged_correlation, normalize, pearsons_correlation
+from clear_price.factors import MultiFactorEngine
+from clear_price.ingest import Trades
+from clear_price.pairs import PairEngine, PairRegistry
+from clear_price.pipeline import Pipeline
+from clear_price.prices import Prices
+
+HISTORIES = (60, 3600, 86_400)
+PAIR_COUNTS = (1, 8, 32)
+TRADE_RATES = (100, 1_000, 10_000)  # сделок в секунду на валюту
+BOOK_LEVELS = (5, 20)  # изменённых уровней стакана на сторону в одном сообщении depthUpdate
+
+QUICK_HISTORIES = (60, 3600)
+QUICK_PAIR_COUNTS = (1, 8)
+QUICK_TRADE_RATES = (1_000,)
+
+MIN_TIME = 0.2  # минимальная длительность одного измерения в секундах
+REPEAT = 3  # количество измерений, результат - лучшее из них
+TOLERANCE = 0.3  # допустимое замедление относительно базового прогона
+
+# начало синтетических данных: 2023-10-01 00:00:00 UTC
+START = 1696118400 * 10 ** 9
+
+
+def registry_of(pairs: int) -> PairRegistry:
+    """
+    :param pairs: количество пар
+    :return: реестр из pairs ведомых валют с общей ведущей валютой
+    """
+    return PairRegistry({f'F{i}USDT': 'BTCUSDT' for i in range(pairs)})
+
+
+def correlated_walks(n: int, symbols: int, seed: int = 0) -> np.ndarray:
+    """
+    случайные блуждания цен, первая валюта - ведущая, остальные коррелированы с ней
+    :param n: количество значений
+    :param symbols: количество валют
+    :param seed: начальное значение генератора
+    :return: цены, форма (n, symbols)
+    """
+    rng = np.random.default_rng(seed)
+    leader = rng.normal(0, 10, n)
+    beta = rng.uniform(0.02, 0.1, symbols - 1)
+    steps = np.column_stack([leader, leader[:, None] * beta + rng.normal(0, 0.5, (n, symbols - 1))])
+    base = np.r_[30000, rng.uniform(100, 3000, symbols - 1)]
+    return base + np.cumsum(steps, axis=0)
+
+
+def synthetic_trades(symbols: list[str], seconds: float, rate: float, seed: int = 0,
+                     batch: float = 0.1) -> list[dict[str, Trades]]:
+    """
+    поток сделок всех валют пачками по batch секунд, количество сделок в пачке - по Пуассону
+    :param symbols: символы валют (первая - ведущая)
+    :param seconds: длительность потока в секундах
+    :param rate: средняя частота сделок в секунду на валюту
+    :param seed: начальное значение генератора
+    :param batch: длительность пачки в секундах
+    :return: пачки {символ валюты: сделки}
+    """
+    rng = np.random.default_rng(seed)
+    batches = int(seconds / batch)
+    walks = correlated_walks(batches, len(symbols), seed)
+    batch_ns = int(batch * 1e9)
+    result = []
+    for b in range(batches):
+        trades = {}
+        for i, symbol in enumerate(symbols):
+            if count := rng.poisson(rate * batch):
+                ticktime = START + b * batch_ns + np.sort(rng.integers(0, batch_ns, count))
+                price = walks[b, i] * (1 + rng.normal(0, 1e-4, count))
+                trades[symbol] = Trades(price, rng.exponential(1, count), ticktime)
+        result.append(trades)
+    return result
+
+
+def measure(func: Callable[[], int | None], min_time: float = MIN_TIME, repeat: int = REPEAT) -> float:
+    """
+    :param func: измеряемая функция, может вернуть количество выполненных операций (int), иначе считается одна
+    :return: лучшее из repeat измерений время одной операции в наносекундах
+    """
+    best = np.inf
+    for _ in range(repeat):
+        ops = 0
+        started = time.perf_counter_ns()
+        while (elapsed := time.perf_counter_ns() - started) < min_time * 1e9:
+            ops += result if isinstance(result := func(), int) else 1
+        best = min(best, elapsed / ops)
+    return best
+
+
+def _drain(dispatcher: AlertDispatcher):
+    # очередь без получателей очищается, чтобы не расти во время измерения
+    if dispatcher.queue.qsize() > 10_000:
+        dispatcher.queue = asyncio.Queue()
+
+
+def bench_prices_append(history: int) -> Callable:
+    prices = Prices('BTCUSDT', history)
+    values = itertools.cycle(correlated_walks(10_000, 1)[:, 0].tolist())
+    ticktime = itertools.count(START, 10 ** 9)
+    for _ in range(history):
+        prices.append(next(values), next(ticktime))
+    return lambda: prices.append(next(values), next(ticktime))
+
+
+def bench_normalize(history: int) -> Callable:
+    x = correlated_walks(history, 1)[:, 0]
+    return lambda: normalize(x)
+
+
+def bench_pearsons_correlation(history: int) -> Callable:
+    walks = correlated_walks(history, 2)
+    return lambda: pearsons_correlation(walks[:, 1], walks[:, 0], text=False)
+
+
+def bench_get_clear_price(history: int) -> Callable:
+    walks = correlated_walks(history, 2)
+    return lambda: get_clear_price(walks[:, 1], walks[:, 0])
+
+
+# дополнительные горизонты: 1, 5, 15 минут и 4 часа при таймфрейме 1 секунда
+HORIZONS = (60, 300, 900, 14_400)
+
+
+def bench_on_bar(history: int, pairs: int, horizons: int = 0) -> Callable:
+    engine = PairEngine(registry_of(pairs), window=history, horizons=HORIZONS[:horizons])
+    walks = correlated_walks(max(2 * engine.prices.max_len, 10_000), pairs + 1)
+    rows = itertools.cycle(walks)
+    ticktime = itertools.count(START, 10 ** 9)
+    for _ in range(engine.prices.max_len):
+        engine.on_bar(next(rows), next(ticktime), 1)
+    return lambda: engine.on_bar(next(rows), next(ticktime), 1)
+
+
+def bench_multi_factor(pairs: int, factors: int) -> Callable:
+    # каждая ведомая валюта корректируется по одним и тем же factors ведущим валютам
+    symbols = [f'L{i}USDT' for i in range(factors)] + [f'F{i}USDT' for i in range(pairs)]
+    engine = MultiFactorEngine(symbols, {f'F{i}USDT': symbols[:factors] for i in range(pairs)}, window=3600)
+    rows = itertools.cycle(correlated_walks(10_000, len(symbols)))
+    ticktime = itertools.count(START, 10 ** 9)
+    return lambda: engine.on_bar(next(rows), next(ticktime), 1)
+
+
+def bench_lstsq(history: int, pairs: int, factors: int) -> Callable:
+    # полный пересчёт регрессий по окну на каждом таймфрейме - то, что заменяет MultiFactorEngine
+    walks = correlated_walks(history, factors + pairs)
+    design = np.column_stack([np.ones(history), walks[:, :factors]])
+    return lambda: np.linalg.lstsq(design, walks[:, factors:], rcond=None)
+
+
+def bench_lagged_correlation(history: int, pairs: int, lags: int) -> Callable:
+    returns = np.diff(correlated_walks(history + 1, pairs + 1), axis=0)
+    return lambda: lagged_correlation(returns[:, 1:], np.repeat(returns[:, :1], pairs, axis=1), lags)
+
+
+def bench_corrcoef_lags(history: int, pairs: int, lags: int) -> Callable:
+    # np.corrcoef на каждый сдвиг каждой пары - то, что заменяет lagged_correlation
+    returns = np.diff(correlated_walks(history + 1, pairs + 1), axis=0)
+
+    def run():
+        for i in range(1, pairs + 1):
+            for lag in range(lags + 1):
+                np.corrcoef(returns[lag:, i], returns[:history - lag, 0])
+    return run
+
+
+def bench_check_for_extremum(pairs: int) -> Callable:
+    dispatcher = AlertDispatcher([], queue_size=0)
+    pipeline = Pipeline(registry_of(pairs), history=60, dispatcher=dispatcher)
+    clear = np.full(pairs, 1800.0)
+    # о выходе за экстремум сообщается по половине пар
+    deviation = np.where(np.arange(pairs) % 2, 0.0, 1.5)
+
+    def run():
+        pipeline.check_for_extremum(clear, deviation, START, 0)
+        _drain(dispatcher)
+    return run
+
+
+def bench_write_tf_price(history: int, pairs: int) -> Callable:
+    dispatcher = AlertDispatcher([], queue_size=0)
+    pipeline = Pipeline(registry_of(pairs), history=history, dispatcher=dispatcher)
+    walks = correlated_walks(max(2 * history, 10_000), pairs + 1)
+    rows = itertools.cycle(walks)
+    ticktime = itertools.count(START, 10 ** 9)
+    volume, count = np.ones(pairs + 1), np.ones(pairs + 1, dtype=np.int64)
+
+    def bars():
+        prices = next(rows)
+        return Bars(next(ticktime), prices, prices, prices, prices, volume, prices, count)
+    for _ in range(history):
+        pipeline.write_tf_price(bars())
+
+    def run():
+        pipeline.write_tf_price(bars())
+        _drain(dispatcher)
+    return run
+
+
+def bench_handle_trades(pairs: int, rate: int) -> Callable:
+    dispatcher = AlertDispatcher([], queue_size=0)
+    registry = registry_of(pairs)
+    pipeline = Pipeline(registry, history=3600, dispatcher=dispatcher)
+    seconds = 60
+    batches = synthetic_trades(registry.symbols, seconds, rate)
+    sizes = [sum(len(trades.time) for trades in batch.values()) for batch in batches]
+    position = itertools.count()
+
+    def run() -> int:
+        # поток повторяется со сдвигом времени на его длительность
+        i = next(position)
+        offset = i // len(batches) * seconds * 10 ** 9
+        batch = batches[i % len(batches)]
+        pipeline.handle_trades({symbol: trades._replace(time=trades.time + offset) for symbol, trades in batch.items()})
+        _drain(dispatcher)
+        return sizes[i % len(batches)] or 1
+    return run
+
+
+def bench_book_diff(levels: int) -> Callable:
+    # изменения стакана с levels уровнями на сторону вокруг медленно меняющейся середины
+    rng = np.random.default_rng(0)
+    mids = np.round(correlated_walks(10_000, 1)[:, 0], 1)
+    diffs = []
+    for mid in mids:
+        offsets = rng.integers(1, 50, (2, levels)) * 0.1
+        qty = np.where(rng.random((2, levels)) < 0.3, 0, rng.exponential(1, (2, levels)))
+        diffs.append(([[f'{mid - o:.1f}', f'{q:.3f}'] for o, q in zip(offsets[0], qty[0])],
+                      [[f'{mid + o:.1f}', f'{q:.3f}'] for o, q in zip(offsets[1], qty[1])]))
+    book = OrderBook(tick=0.1)
+    book.load_snapshot(0, [[f'{mids[0] - 0.1:.1f}', '1']], [[f'{mids[0] + 0.1:.1f}', '1']])
+    update_id = itertools.count(1)
+    rows = itertools.cycle(diffs)
+
+    def run():
+        u = next(update_id)
+        book.apply_diff(u - 1, u, u - 1, *next(rows))
+    return run
+
+
+def run_benchmarks(histories=HISTORIES, pair_counts=PAIR_COUNTS, trade_rates=TRADE_RATES,
+                   stages: list[str] | None = None, min_time: float = MIN_TIME) -> dict:
+    """
+    :param stages: названия этапов для измерения (None - все)
+    :return: результаты {название измерения: {'stage', 'params', 'ns_per_op'}}
+    """
+    cases = ([('Prices.append', {'history': h}, bench_prices_append) for h in histories]
+             + [('normalize', {'history': h}, bench_normalize) for h in histories]
+             + [('pearsons_correlation', {'history': h}, bench_pearsons_correlation) for h in histories]
+             + [('get_clear_price', {'history': h}, bench_get_clear_price) for h in histories]
+             + [('PairEngine.on_bar', {'history': h, 'pairs': p}, bench_on_bar)
+                for h in histories for p in pair_counts]
+             + [('PairEngine.on_bar', {'history': 3600, 'pairs': p, 'horizons': len(HORIZONS)}, bench_on_bar)
+                for p in pair_counts]
+             + [('MultiFactorEngine.on_bar', {'pairs': p, 'factors': 3}, bench_multi_factor) for p in pair_counts]
+             + [('lstsq', {'history': 3600, 'pairs': p, 'factors': 3}, bench_lstsq) for p in pair_counts]
+             + [('lagged_correlation', {'history': 3600, 'pairs': p, 'lags': 100}, bench_lagged_correlation)
+                for p in pair_counts]
+             + [('corrcoef_lags', {'history': 3600, 'pairs': p, 'lags': 100}, bench_corrcoef_lags)
+                for p in pair_counts]
+             + [('check_for_extremum', {'pairs': p}, bench_check_for_extremum) for p in pair_counts]
+             + [('write_tf_price', {'history': h, 'pairs': p}, bench_write_tf_price)
+                for h in histories for p in pair_counts]
+             + [('handle_trades', {'pairs': p, 'rate': r}, bench_handle_trades)
+                for p in pair_counts for r in trade_rates]
+             + [('OrderBook.apply_diff', {'levels': n}, bench_book_diff) for n in BOOK_LEVELS])
+    results = {}
+    for stage, params, factory in cases:
+        if stages and stage not in stages:
+            continue
+        name = f"{stage}[{','.join(f'{key}={value}' for key, value in params.items())}]"
+        results[name] = {'stage': stage, 'params': params,
+                         'ns_per_op': measure(factory(**params), min_time=min_time)}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list[tuple[str, float, float]]:
+    """
+    :param results: результаты текущего прогона
+    :param baseline: результаты базового прогона
+    :param tolerance: допустимое относительное замедление
+    :return: регрессии (название измерения, базовое время, текущее время), измерения без базы пропускаются
+    """
+    return [(name, baseline[name]['ns_per_op'], result['ns_per_op']) for name, result in results.items()
+            if name in baseline and result['ns_per_op'] > baseline[name]['ns_per_op'] * (1 + tolerance)]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Тесты производительности этапов обработки')
+    parser.add_argument('--quick', action='store_true', help='сокращённый набор параметров')
+    parser.add_argument('--stage', action='append', help='измерять только этот этап (можно указать несколько)')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='длительность одного измерения в секундах')
+    parser.add_argument('--output', help='файл для записи результатов (JSON)')
+    parser.add_argument('--baseline', help='файл базового прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='допустимое замедление, доля')
+    args = parser.parse_args(argv)
+
+    grid = (QUICK_HISTORIES, QUICK_PAIR_COUNTS, QUICK_TRADE_RATES) if args.quick else (HISTORIES, PAIR_COUNTS, TRADE_RATES)
+    results = run_benchmarks(*grid, stages=args.stage, min_time=args.min_time)
+    for name, result in results.items():
+        print(f"{name:55} {result['ns_per_op'] / 1e3:12.3f} мкс")
+
+    if args.output:
+        report = {'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+                           'numpy': np.__version__, 'platform': platform.platform()},
+                  'results': results}
+        Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text())['results'], args.tolerance)
+        for name, base, current in regressions:
+            print(f'РЕГРЕССИЯ {name}: {base / 1e3:.3f} -> {current / 1e3:.3f} мкс ({current / base:.2f}x)')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,395 @@
+"""
+Стакан заявок (L2) по потокам depth@100ms и bookTicker фьючерсов Binance.
+Уровни цен стакана хранятся в предвыделенных массивах объёмов по сетке шага цены: индекс уровня -
+номер шага цены относительно базы, поэтому обновление уровня - запись одного элемента массива
+без вставок, удалений и выделения памяти. Лучшие цены отслеживаются индексами, при приближении цены
+к краю сетки сетка сдвигается (редкая операция). Уровни за пределами сетки (далеко от середины) не хранятся.
+Синхронизация - снимок REST плюс изменения из потока по правилам Binance:
+изменения с u < lastUpdateId снимка отбрасываются, первое применяемое изменение должно содержать lastUpdateId
+(U <= lastUpdateId <= u), у каждого следующего pu равен u предыдущего, иначе стакан загружается заново.
+По стаканам всех валют считаются бары: середина спреда, microprice и дисбаланс потока заявок (OFI)
+на конец каждого таймфрейма.
+"""
+import asyncio
+import json
+import logging
+import math
+import urllib.parse
+import urllib.request
+from typing import NamedTuple
+
+import numpy as np
+import websockets
+
+from clear_price.ingest import BINANCE_FUTURES_URL
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# адрес REST API фьючерсов Binance (снимки стакана и шаги цен)
+BINANCE_FUTURES_REST = 'https://fapi.binance.com'
+
+# размер сетки уровней стакана в шагах цены
+LEVELS = 1 << 14
+
+# количество хранимых закрытых баров стаканов, ещё не запрошенных расчётом
+MAX_CLOSED = 64
+
+
+class BookBars(NamedTuple):
+    """
+    бары стаканов всех валют за один таймфрейм, массивы в порядке символов
+    """
+    time: int  # время начала таймфрейма в наносекундах от эпохи
+    mid: np.ndarray  # середина спреда на конец таймфрейма (nan, если стакан не загружен)
+    microprice: np.ndarray  # цена, взвешенная объёмами лучших заявок противоположных сторон
+    ofi: np.ndarray  # дисбаланс потока заявок за таймфрейм (положительный - давление покупателей)
+    buys: np.ndarray  # суммарный объём заявок на покупку в стакане на конец таймфрейма
+    sells: np.ndarray  # суммарный объём заявок на продажу
+
+
+class OrderBook:
+    """
+    стакан одной валюты
+    """
+    def __init__(self, tick: float, levels: int = LEVELS):
+        """
+        :param tick: шаг цены
+        :param levels: размер сетки уровней в шагах цены
+        """
+        self.tick = tick
+        # количество знаков цены после запятой, цены уровней округляются до шага без ошибки умножения
+        self._decimals = len(f'{tick:.10f}'.rstrip('0').split('.')[1])
+        self.levels = levels
+        self.bids = np.zeros(levels)  # объёмы заявок на покупку по уровням сетки
+        self.asks = np.zeros(levels)  # объёмы заявок на продажу
+        self.base = 0  # номер шага цены нулевого уровня сетки
+        self.best_bid = -1  # индекс лучшей покупки (-1 - нет заявок)
+        self.best_ask = levels  # индекс лучшей продажи (levels - нет заявок)
+        self.update_id = 0  # u последнего применённого изменения стакана
+        self.synced = False
+        self._after_snapshot = False
+        self.quote: tuple | None = None  # (u, bid, bid_qty, ask, ask_qty) последнего bookTicker
+        self.ofi = 0.0  # накопленный дисбаланс потока заявок
+
+    def _set_levels(self, side: np.ndarray, levels: list, is_bid: bool):
+        for price, qty in levels:
+            i = round(float(price) / self.tick) - self.base
+            if 0 <= i < self.levels:
+                qty = float(qty)
+                side[i] = qty
+                if qty > 0:
+                    if is_bid and i > self.best_bid:
+                        self.best_bid = i
+                    elif not is_bid and i < self.best_ask:
+                        self.best_ask = i
+        # лучшая цена могла быть удалена - поиск следующего непустого уровня
+        while self.best_bid >= 0 and self.bids[self.best_bid] == 0:
+            self.best_bid -= 1
+        while self.best_ask < self.levels and self.asks[self.best_ask] == 0:
+            self.best_ask += 1
+
+    def _recenter(self):
+        if self.best_bid < 0 or self.best_ask >= self.levels:
+            return
+        margin = self.levels // 8
+        if margin <= self.best_bid and self.best_ask < self.levels - margin:
+            return
+        shift = (self.best_bid + self.best_ask) // 2 - self.levels // 2
+        for side in (self.bids, self.asks):
+            if shift > 0:
+                side[:-shift] = side[shift:]
+                side[-shift:] = 0
+            elif shift < 0:
+                side[-shift:] = side[:shift]
+                side[:-shift] = 0
+        self.base += shift
+        self.best_bid -= shift
+        self.best_ask -= shift
+
+    def load_snapshot(self, update_id: int, bids: list, asks: list):
+        """
+        загрузка снимка стакана
+        :param update_id: lastUpdateId снимка
+        :param bids: заявки на покупку [[цена, объём], ...] в порядке убывания цены
+        :param asks: заявки на продажу [[цена, объём], ...] в порядке возрастания цены
+        """
+        self.bids.fill(0)
+        self.asks.fill(0)
+        self.best_bid, self.best_ask = -1, self.levels
+        top = [float(side[0][0]) for side in (bids, asks) if side]
+        if top:
+            self.base = round(sum(top) / len(top) / self.tick) - self.levels // 2
+        self._set_levels(self.bids, bids, True)
+        self._set_levels(self.asks, asks, False)
+        self.update_id = update_id
+        self.synced = True
+        self._after_snapshot = True
+
+    def apply_diff(self, first_id: int, last_id: int, prev_id: int, bids: list, asks: list) -> bool:
+        """
+        применение изменения стакана из потока depthUpdate
+        :param first_id: U - первый номер изменения
+        :param last_id: u - последний номер изменения
+        :param prev_id: pu - последний номер предыдущего изменения
+        :param bids: изменённые уровни покупок [[цена, объём], ...], нулевой объём - удаление уровня
+        :param asks: изменённые уровни продаж
+        :return: False, если стакан не синхронизирован и его нужно загрузить заново
+        """
+        if not self.synced:
+            return False
+        if last_id < self.update_id:
+            return True  # изменение старше снимка
+        if self._after_snapshot:
+            in_sequence = first_id <= self.update_id <= last_id
+        else:
+            in_sequence = prev_id == self.update_id
+        if not in_sequence:
+            self.synced = False
+            return False
+        before = self.top()
+        self._set_levels(self.bids, bids, True)
+        self._set_levels(self.asks, asks, False)
+        self._recenter()
+        self.update_id = last_id
+        self._after_snapshot = False
+        self._flow(before)
+        return True
+
+    def on_ticker(self, update_id: int, bid: float, bid_qty: float, ask: float, ask_qty: float):
+        """
+        лучшие цены из потока bookTicker, используются, пока они новее стакана
+        """
+        if self.quote is not None and update_id < self.quote[0]:
+            return
+        before = self.top()
+        self.quote = (update_id, bid, bid_qty, ask, ask_qty)
+        self._flow(before)
+
+    def top(self) -> tuple[float, float, float, float]:
+        """
+        :return: лучшая цена и объём покупки, лучшая цена и объём продажи (nan и 0, если заявок нет)
+        """
+        if self.quote is not None and (not self.synced or self.quote[0] > self.update_id):
+            return self.quote[1:]
+        bid, bid_qty, ask, ask_qty = math.nan, 0.0, math.nan, 0.0
+        if self.synced and self.best_bid >= 0:
+            bid, bid_qty = round((self.base + self.best_bid) * self.tick, self._decimals), float(self.bids[self.best_bid])
+        if self.synced and self.best_ask < self.levels:
+            ask, ask_qty = round((self.base + self.best_ask) * self.tick, self._decimals), float(self.asks[self.best_ask])
+        return bid, bid_qty, ask, ask_qty
+
+    def _flow(self, before: tuple[float, float, float, float]):
+        # OFI по лучшим ценам (Cont, Kukanov, Stoikov): рост покупок и снижение продаж - положительный вклад
+        bid0, bid_qty0, ask0, ask_qty0 = before
+        bid, bid_qty, ask, ask_qty = self.top()
+        if math.isnan(bid0) or math.isnan(ask0) or math.isnan(bid) or math.isnan(ask):
+            return
+        self.ofi += ((bid_qty if bid >= bid0 else 0) - (bid_qty0 if bid <= bid0 else 0)
+                     - (ask_qty if ask <= ask0 else 0) + (ask_qty0 if ask >= ask0 else 0))
+
+    @property
+    def depth(self) -> tuple[float, float]:
+        """
+        :return: суммарные объёмы заявок на покупку и на продажу (nan, если стакан не загружен)
+        """
+        if not self.synced:
+            return math.nan, math.nan
+        return float(self.bids.sum()), float(self.asks.sum())
+
+    @property
+    def mid(self) -> float:
+        bid, _, ask, _ = self.top()
+        return (bid + ask) / 2
+
+    @property
+    def microprice(self) -> float:
+        bid, bid_qty, ask, ask_qty = self.top()
+        if bid_qty + ask_qty == 0:
+            return math.nan
+        return (bid * ask_qty + ask * bid_qty) / (bid_qty + ask_qty)
+
+
+class OrderBooks:
+    """
+    стаканы нескольких валют и их бары по таймфреймам: бар таймфрейма фиксируется по первому событию
+    стаканов с биржевым временем после его конца
+    """
+    def __init__(self, symbols: list[str], tf_ns: int, ticks: dict[str, float] | None = None, levels: int = LEVELS):
+        """
+        :param symbols: символы валют
+        :param tf_ns: размер таймфрейма в наносекундах
+        :param ticks: шаги цен валют {символ: шаг}, отсутствующие загружаются BookStream
+        :param levels: размер сетки уровней стаканов
+        """
+        self.symbols = symbols
+        self.tf_ns = tf_ns
+        self.levels = levels
+        self.books = {symbol: OrderBook(tick, levels) for symbol, tick in (ticks or {}).items() if symbol in symbols}
+        self.bucket: int | None = None  # номер текущего таймфрейма
+        self.closed: dict[int, BookBars] = {}  # зафиксированные бары {время: бары}
+
+    def __getitem__(self, symbol: str) -> OrderBook:
+        return self.books[symbol]
+
+    def set_tick(self, symbol: str, tick: float):
+        self.books[symbol] = OrderBook(tick, self.levels)
+
+    def advance(self, ticktime: int):
+        """
+        :param ticktime: биржевое время события стакана в наносекундах от эпохи
+        """
+        bucket = ticktime // self.tf_ns
+        if self.bucket is None:
+            self.bucket = bucket
+        elif bucket > self.bucket:
+            self.closed[self.bucket * self.tf_ns] = self._sample(self.bucket * self.tf_ns)
+            self.bucket = bucket
+            if len(self.closed) > MAX_CLOSED:
+                del self.closed[min(self.closed)]
+
+    def _sample(self, time: int, reset: bool = True) -> BookBars:
+        """
+        :param time: время начала таймфрейма в наносекундах от эпохи
+        :param reset: обнулить накопленный дисбаланс потока заявок (таймфрейм закрыт)
+        """
+        books = [self.books.get(symbol) for symbol in self.symbols]
+        ofi = np.array([book.ofi if book is not None else 0.0 for book in books])
+        if reset:
+            for book in books:
+                if book is not None:
+                    book.ofi = 0.0
+        depth = np.array([book.depth if book is not None else (np.nan, np.nan) for book in books]).reshape(-1, 2)
+        return BookBars(time=time,
+                        mid=np.array([book.mid if book is not None else np.nan for book in books]),
+                        microprice=np.array([book.microprice if book is not None else np.nan for book in books]),
+                        ofi=ofi, buys=depth[:, 0], sells=depth[:, 1])
+
+    def bar(self, time: int) -> BookBars:
+        """
+        :param time: время начала таймфрейма в наносекундах от эпохи
+        :return: бары стаканов за таймфрейм; если событий стаканов после его конца ещё не было - текущее состояние
+                 (дисбаланс потока заявок - накопленный с начала таймфрейма, накопление продолжается)
+        """
+        for older in [closed for closed in self.closed if closed < time]:
+            del self.closed[older]
+        bars = self.closed.pop(time, None)
+        return bars if bars is not None else self._sample(time, reset=False)
+
+
+def _loads(frame):
+    return orjson.loads(frame) if orjson is not None else json.loads(frame)
+
+
+class BookStream:
+    """
+    Получение потоков depth@100ms и bookTicker и синхронизация стаканов со снимками REST.
+    Изменения валюты, стакан которой загружается, накапливаются и применяются после загрузки снимка
+    """
+    def __init__(self, books: OrderBooks, url: str = BINANCE_FUTURES_URL, rest_url: str = BINANCE_FUTURES_REST,
+                 depth: int = 1000, ticker: bool = True):
+        """
+        :param books: стаканы валют
+        :param url: адрес комбинированных потоков
+        :param rest_url: адрес REST API
+        :param depth: количество уровней снимка стакана
+        :param ticker: получать ли поток bookTicker
+        """
+        self.books = books
+        streams = [f'{symbol.lower()}@depth@100ms' for symbol in books.symbols]
+        if ticker:
+            streams += [f'{symbol.lower()}@bookTicker' for symbol in books.symbols]
+        self.url = f'{url}?streams={"/".join(streams)}'
+        self.rest_url = rest_url
+        self.depth = depth
+        self._pending: dict[str, list] = {}  # изменения валют, стаканы которых загружаются
+        self._tasks: set[asyncio.Task] = set()
+        self.snapshots = 0  # количество загруженных снимков
+
+    def _get(self, path: str, params: dict) -> dict:
+        with urllib.request.urlopen(f'{self.rest_url}{path}?{urllib.parse.urlencode(params)}', timeout=10) as response:
+            return _loads(response.read())
+
+    async def load_ticks(self):
+        """
+        загрузка шагов цен валют, для которых они не заданы
+        """
+        missing = [symbol for symbol in self.books.symbols if symbol not in self.books.books]
+        if not missing:
+            return
+        info = await asyncio.to_thread(self._get, '/fapi/v1/exchangeInfo', {})
+        for item in info['symbols']:
+            if item['symbol'] in missing:
+                price_filter = next(f for f in item['filters'] if f['filterType'] == 'PRICE_FILTER')
+                self.books.set_tick(item['symbol'], float(price_filter['tickSize']))
+
+    def _resync(self, symbol: str, pending: list):
+        self._pending[symbol] = pending
+        task = asyncio.create_task(self._snapshot(symbol))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _snapshot(self, symbol: str):
+        try:
+            data = await asyncio.to_thread(self._get, '/fapi/v1/depth', {'symbol': symbol, 'limit': self.depth})
+        except Exception as ex:
+            logger.warning(f'Не удалось загрузить стакан {symbol}: {ex!r}')
+            await asyncio.sleep(1)
+            self._resync(symbol, self._pending.pop(symbol, []))
+            return
+        book = self.books[symbol]
+        book.load_snapshot(data['lastUpdateId'], data['bids'], data['asks'])
+        self.snapshots += 1
+        pending = self._pending.pop(symbol, [])
+        for i, event in enumerate(pending):
+            if not self._apply(book, event):
+                logger.warning(f'Пропуск изменений стакана {symbol}, повторная загрузка')
+                self._resync(symbol, pending[i:])
+                return
+
+    @staticmethod
+    def _apply(book: OrderBook, event: dict) -> bool:
+        return book.apply_diff(event['U'], event['u'], event['pu'], event['b'], event['a'])
+
+    def handle(self, data: dict):
+        """
+        обработка сообщения depthUpdate или bookTicker
+        """
+        symbol = data['s']
+        if symbol not in self.books.books:
+            return
+        self.books.advance(data.get('T', data.get('E', 0)) * 1_000_000)
+        if data.get('e') == 'depthUpdate':
+            if symbol in self._pending:
+                self._pending[symbol].append(data)
+            elif not self._apply(self.books[symbol], data):
+                self._resync(symbol, [data])
+        else:
+            self.books[symbol].on_ticker(data['u'], float(data['b']), float(data['B']),
+                                         float(data['a']), float(data['A']))
+
+    async def run(self):
+        """
+        получение потоков стаканов, при разрыве соединения стаканы загружаются заново
+        """
+        await self.load_ticks()
+        try:
+            async for ws in websockets.connect(self.url, max_queue=None):
+                # изменения накапливаются с начала соединения, снимки загружаются параллельно
+                for symbol, book in self.books.books.items():
+                    book.synced = False
+                    if symbol not in self._pending:
+                        self._resync(symbol, [])
+                try:
+                    async for frame in ws:
+                        data = _loads(frame)
+                        self.handle(data.get('data', data))
+                except websockets.ConnectionClosed as ex:
+                    logger.warning(f'Соединение с {self.url} разорвано: {ex}')
+        finally:
+            for task in self._tasks:
+                task.cancel()
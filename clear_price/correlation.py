@@ -0,0 +1,387 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# относительное среднеквадратичное отклонение, ниже которого ряд считается постоянным
+FLAT_STD = 1e-9
+
+
+def pearsons_correlation(x1: np.array, x2: np.array, text: bool = 'True'):
+    """
+    Функция рассчитывает коэффициент корреляции Пирсона, для определения зависимости векторов двнных
+    ! Недостаток 1 - анализируется вся история длиной HISTORY_LENGTH, т.е. если именно в текущий момент движение цены
+                     BTC не влияет на ETH, функция это не учтёт, будет возвращён результат влияния за всю историю
+    ! Недостаток 2 - чем больше накопившаяся история, тем точнее коэффициент корреляции и эффективнее коррекция, т.к.
+                     программа начинает с нулевой истории, поначалу коррекция недостаточно эффективная
+    :param x1: первый вектор значений
+    :param x2: второй вектор значений
+    :param text: вернуть текстовый результат или числовой
+    :return: коэффициент корреляции
+    """
+    pearsons_correlation_result = '' if text else 0
+    try:
+        len_x1, len_x2 = len(x1), len(x2)
+        # из-за асинхронного обращения к данным, возможна ситуация, когда векторы разной длинны,
+        # в таком случае последнее значение большего вектора не учитывается
+        if len_x1 != len_x2:
+            len_x1 = len_x2 = min(len_x1, len_x2)
+        if len_x1:  # в самом начале работы программы одного из векторов может ещё не быть
+            pearsons_correlation_result = f"Pearson's correlation\n{np.corrcoef(x1[:len_x1], x2[:len_x1])[0, 1]}" if text \
+                    else np.corrcoef(x1[:len_x1], x2[:len_x1])[0, 1]
+    except Exception:
+        logger.exception('При расчёте коэффициента корреляции возникла ошибка')
+
+    return pearsons_correlation_result
+
+
+def normalize(x: np.array) -> np.array:
+    """
+    Функция нормализует график. Среднее значение графика приблизительно становится равным 0,
+    движения оотносительно оси x нормализуются
+    :param x:  массив цен
+    :return: нормализованный массив цен
+    """
+    normalized_x = np.ones(len(x))
+    if(std := x.std()) != 0:
+        normalized_x = (x - x.mean()) / std
+    return normalized_x
+
+
+def get_clear_price(main_x: list, influenced_x: list) -> float:
+    """
+    Функция корректировки цены
+    :param main_x: список цен валюты, подлежащей корректировке
+    :param influenced_x: список цен валюты, оказывающей влияние
+    :return: скорректированное значение последней цены из списка
+    """
+    clear_price = None
+    try:
+        std_main = np.std(main_x)  # среднеквадратичное отклонение основного графика
+        len_ = min(len(main_x), len(influenced_x))  # выравнивание длин списков
+        if len_ and std_main != 0:
+            """
+            вычисление размера коррекции:
+            1. нормализация второго (влияющего) графика
+            2. умножение нормализованного графика на среднеквадратичное отклонение первого гафика, т.е.
+               приведение его к 'масштабу' первого графика
+            3. умножение 'отмасштабированного' графика на коэффициент корреляции (если графики не зависимые,
+               тогда корректировка не требуется и коррекция будет равна 0 или близка к 0)
+            4. Вычитание из последней цены первого графика величины коррекции
+            """
+            norm_correction = normalize(np.array(influenced_x)) * std_main * pearsons_correlation(main_x, influenced_x, False)
+            clear_price = main_x[-1] - norm_correction[-1]
+    except Exception:
+        logger.exception('При корректировке цены возникла ошибка')
+    return clear_price
+
+
+def lagged_correlation(x: np.ndarray, y: np.ndarray, max_lag: int) -> np.ndarray:
+    """
+    Функция рассчитывает корреляцию ряда x с рядом y, сдвинутым на 0..max_lag значений в прошлое
+    (y опережает x на lag): r[lag] = sum(dx[t] * dy[t - lag]) / sqrt(sum(dx²) * sum(dy²)), dx, dy - отклонения от средних.
+    Все сдвиги считаются одним преобразованием Фурье за O(n log n) вместо np.corrcoef на каждый сдвиг,
+    ряды дополняются нулями, поэтому значения с начала и конца рядов не смешиваются
+    :param x: значения ведомого ряда (первая ось - время, остальные - например пары)
+    :param y: значения ведущего ряда той же формы
+    :param max_lag: наибольший сдвиг
+    :return: коэффициенты корреляции, форма (max_lag + 1, *x.shape[1:]), nan - если один из рядов постоянный
+    """
+    n = len(x)
+    dx, dy = x - x.mean(axis=0), y - y.mean(axis=0)
+    size = 1 << int(np.ceil(np.log2(n + max_lag)))
+    r = np.fft.irfft(np.fft.rfft(dx, size, axis=0) * np.conj(np.fft.rfft(dy, size, axis=0)), size, axis=0)
+    norm = np.sqrt((dx * dx).sum(axis=0) * (dy * dy).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return r[:max_lag + 1] / np.where(norm > 0, norm, np.nan)
+
+
+class RollingCorrelation:
+    """
+    Потоковый расчёт статистик пары рядов x (основной) и y (влияющий) в скользящем окне.
+    Хранятся среднее, сумма квадратов отклонений и сумма произведений отклонений (алгоритм Уэлфорда),
+    которые обновляются за O(1) при добавлении новой пары значений и при вытеснении старой,
+    поэтому стоимость одного тика не зависит от длины окна.
+
+    Коэффициент корреляции, среднеквадратичное отклонение и скорректированная цена совпадают с
+    pearsons_correlation, np.std и get_clear_price с относительной погрешностью порядка 1e-9:
+    накопление ошибок округления ограничивается пересчётом статистик по окну (resync) каждые
+    resync_every обновлений, что в среднем тоже даёт O(1) на тик.
+
+    Все операции поэлементные, поэтому x и y могут быть как числами, так и массивами NumPy
+    одинаковой формы (по одному элементу на пару валют).
+    """
+    def __init__(self, window: int, resync_every: int | None = None):
+        """
+        :param window: длина скользящего окна
+        :param resync_every: периодичность полного пересчёта статистик (по умолчанию - длина окна)
+        """
+        self.window = window
+        self.resync_every = resync_every or window
+        self.n = 0  # количество значений в окне
+        self.mean_x = self.mean_y = 0.0
+        self.m2_x = self.m2_y = 0.0  # суммы квадратов отклонений от среднего
+        self.c_xy = 0.0  # сумма произведений отклонений x и y
+        self.__updates = 0  # количество обновлений после последнего пересчёта
+
+    @property
+    def stale(self) -> bool:
+        """
+        :return: пора ли пересчитать статистики по окну для сброса накопленной ошибки
+        """
+        return self.__updates >= self.resync_every
+
+    def add(self, x, y):
+        """
+        добавление пары значений в окно
+        """
+        self.n += 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x = self.mean_x + dx / self.n
+        self.mean_y = self.mean_y + dy / self.n
+        self.m2_x = self.m2_x + dx * (x - self.mean_x)
+        self.m2_y = self.m2_y + dy * (y - self.mean_y)
+        self.c_xy = self.c_xy + dx * (y - self.mean_y)
+
+    def remove(self, x, y):
+        """
+        удаление из окна пары значений, добавленной ранее
+        """
+        if self.n <= 1:
+            self.__init__(self.window, self.resync_every)
+            return
+        self.n -= 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x = self.mean_x - dx / self.n
+        self.mean_y = self.mean_y - dy / self.n
+        self.m2_x = self.m2_x - dx * (x - self.mean_x)
+        self.m2_y = self.m2_y - dy * (y - self.mean_y)
+        self.c_xy = self.c_xy - (x - self.mean_x) * dy
+
+    def update(self, x, y, x_out=None, y_out=None):
+        """
+        сдвиг окна на одно значение
+        :param x: новое значение основного ряда
+        :param y: новое значение влияющего ряда
+        :param x_out: вытесненное из окна значение основного ряда (None, если окно ещё не заполнено)
+        :param y_out: вытесненное из окна значение влияющего ряда
+        """
+        if x_out is not None:
+            self.remove(x_out, y_out)
+        self.add(x, y)
+        self.__updates += 1
+
+    def resync(self, xs: np.ndarray, ys: np.ndarray):
+        """
+        пересчёт статистик по всему окну
+        :param xs: значения основного ряда в окне (первая ось - время)
+        :param ys: значения влияющего ряда в окне
+        """
+        self.n = len(xs)
+        self.__updates = 0
+        if not self.n:
+            self.__init__(self.window, self.resync_every)
+            return
+        self.mean_x = xs.mean(axis=0)
+        self.mean_y = ys.mean(axis=0)
+        dx = xs - self.mean_x
+        dy = ys - self.mean_y
+        self.m2_x = (dx * dx).sum(axis=0)
+        self.m2_y = (dy * dy).sum(axis=0)
+        self.c_xy = (dx * dy).sum(axis=0)
+
+    def __flat(self, m2, mean):
+        return m2 <= self.n * (FLAT_STD * mean) ** 2
+
+    @property
+    def std_x(self):
+        """
+        :return: среднеквадратичное отклонение основного ряда (как np.std)
+        """
+        return np.sqrt(np.maximum(self.m2_x, 0) / max(self.n, 1))
+
+    @property
+    def std_y(self):
+        """
+        :return: среднеквадратичное отклонение влияющего ряда
+        """
+        return np.sqrt(np.maximum(self.m2_y, 0) / max(self.n, 1))
+
+    @property
+    def correlation(self):
+        """
+        :return: коэффициент корреляции Пирсона (nan, если один из рядов постоянный)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.__flat(self.m2_x, self.mean_x) | self.__flat(self.m2_y, self.mean_y), np.nan,
+                            self.c_xy / np.sqrt(np.maximum(self.m2_x * self.m2_y, 0)))[()]
+
+    def clear_price(self, x, y):
+        """
+        скорректированная цена последнего значения, аналог get_clear_price:
+        x - normalize(y) * std_x * r = x - (y - mean_y) * c_xy / m2_y
+        :param x: последнее значение основного ряда
+        :param y: последнее значение влияющего ряда
+        :return: скорректированная цена (nan, если корректировка невозможна)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.__flat(self.m2_x, self.mean_x) | self.__flat(self.m2_y, self.mean_y), np.nan,
+                            x - (y - self.mean_y) * self.c_xy / self.m2_y)[()]
+
+
+class HorizonCorrelation:
+    """
+    Статистики нескольких скользящих окон разной длины (горизонтов) по общей истории цен.
+    Статистики всех горизонтов хранятся в массивах формы (горизонты, пары) и обновляются
+    теми же формулами Уэлфорда, что и RollingCorrelation, одной векторной операцией:
+    новое значение добавляется во все окна, из заполненных окон вытесняется значение,
+    отстоящее от нового на длину окна. Окно пересчитывается по истории каждые window обновлений.
+    """
+    def __init__(self, windows: tuple[int, ...], shape: tuple = ()):
+        """
+        :param windows: длины окон
+        :param shape: форма одного значения (количество пар)
+        """
+        self.windows = np.asarray(windows)
+        full = (len(windows), *shape)
+        self.n = np.zeros((len(windows), *[1] * len(shape)))  # количество значений в каждом окне
+        self.mean_x, self.mean_y = np.zeros(full), np.zeros(full)
+        self.m2_x, self.m2_y = np.zeros(full), np.zeros(full)
+        self.c_xy = np.zeros(full)
+        self._updates = np.zeros(len(windows), dtype=np.int64)
+
+    @property
+    def stale(self) -> np.ndarray:
+        """
+        :return: номера окон, которые пора пересчитать по истории
+        """
+        return np.flatnonzero(self._updates >= self.windows)
+
+    def update(self, x, y, x_out, y_out, evict: np.ndarray):
+        """
+        сдвиг всех окон на одно значение
+        :param x: новые значения основного ряда (пары)
+        :param y: новые значения влияющего ряда
+        :param x_out: вытесняемые значения основного ряда для каждого окна, форма (окна, пары)
+        :param y_out: вытесняемые значения влияющего ряда
+        :param evict: заполнено ли окно (вытесняется ли значение), форма (окна,)
+        """
+        if evict.all() and (self.n > 1).all():
+            # обычный случай после заполнения истории - вытеснение из всех окон, без выборки по маске
+            self.n -= 1
+            dx = x_out - self.mean_x
+            dy = y_out - self.mean_y
+            self.mean_x -= dx / self.n
+            self.mean_y -= dy / self.n
+            self.m2_x -= dx * (x_out - self.mean_x)
+            self.m2_y -= dy * (y_out - self.mean_y)
+            self.c_xy -= (x_out - self.mean_x) * dy
+        elif evict.any():
+            keep = self.n[evict] > 1
+            n = np.where(keep, self.n[evict] - 1, 1)
+            dx = x_out[evict] - self.mean_x[evict]
+            dy = y_out[evict] - self.mean_y[evict]
+            mean_x = self.mean_x[evict] - dx / n
+            mean_y = self.mean_y[evict] - dy / n
+            # окно длины 1 после вытеснения пустое
+            self.m2_x[evict] = np.where(keep, self.m2_x[evict] - dx * (x_out[evict] - mean_x), 0)
+            self.m2_y[evict] = np.where(keep, self.m2_y[evict] - dy * (y_out[evict] - mean_y), 0)
+            self.c_xy[evict] = np.where(keep, self.c_xy[evict] - (x_out[evict] - mean_x) * dy, 0)
+            self.mean_x[evict] = np.where(keep, mean_x, 0)
+            self.mean_y[evict] = np.where(keep, mean_y, 0)
+            self.n[evict] -= 1
+        self.n += 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += dx / self.n
+        self.mean_y += dy / self.n
+        self.m2_x += dx * (x - self.mean_x)
+        self.m2_y += dy * (y - self.mean_y)
+        self.c_xy += dx * (y - self.mean_y)
+        self._updates += 1
+
+    def resync(self, k: int, xs: np.ndarray, ys: np.ndarray):
+        """
+        пересчёт статистик окна k по истории
+        :param k: номер окна
+        :param xs: значения основного ряда в окне (первая ось - время)
+        :param ys: значения влияющего ряда в окне
+        """
+        self._updates[k] = 0
+        self.n[k] = len(xs)
+        if not len(xs):
+            for array in (self.mean_x, self.mean_y, self.m2_x, self.m2_y, self.c_xy):
+                array[k] = 0
+            return
+        self.mean_x[k], self.mean_y[k] = xs.mean(axis=0), ys.mean(axis=0)
+        dx, dy = xs - self.mean_x[k], ys - self.mean_y[k]
+        self.m2_x[k], self.m2_y[k] = (dx * dx).sum(axis=0), (dy * dy).sum(axis=0)
+        self.c_xy[k] = (dx * dy).sum(axis=0)
+
+    def _flat(self) -> np.ndarray:
+        return ((self.m2_x <= self.n * (FLAT_STD * self.mean_x) ** 2)
+                | (self.m2_y <= self.n * (FLAT_STD * self.mean_y) ** 2))
+
+    @property
+    def correlation(self) -> np.ndarray:
+        """
+        :return: коэффициенты корреляции Пирсона, форма (окна, пары) (nan, если один из рядов постоянный)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self._flat(), np.nan, self.c_xy / np.sqrt(np.maximum(self.m2_x * self.m2_y, 0)))
+
+    def clear_price(self, x, y) -> np.ndarray:
+        """
+        :return: скорректированные цены для каждого окна, форма (окна, пары) (nan, если корректировка невозможна)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self._flat(), np.nan, x - (y - self.mean_y) * self.c_xy / self.m2_y)
+
+
+class EwCorrelation(HorizonCorrelation):
+    """
+    Экспоненциально взвешенный вариант HorizonCorrelation: вес значения убывает с возрастом,
+    коэффициент сглаживания окна длиной window - 2 / (window + 1). Вытесняемые значения не нужны,
+    обновление - O(1) на окно без обращения к истории, пересчёт не требуется
+    """
+    def __init__(self, windows: tuple[int, ...], shape: tuple = ()):
+        super().__init__(windows, shape)
+        self.alpha = (2 / (self.windows + 1)).reshape(self.n.shape)
+
+    @property
+    def stale(self) -> np.ndarray:
+        return np.empty(0, dtype=np.int64)
+
+    def update(self, x, y, x_out=None, y_out=None, evict=None):
+        if not self.n.all():
+            # первое значение - начальное среднее
+            self.mean_x[...] = x
+            self.mean_y[...] = y
+            self.n += 1
+            return
+        a = self.alpha
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += a * dx
+        self.mean_y += a * dy
+        # m2 и c_xy - взвешенные дисперсии и ковариация (а не суммы, как в скользящем окне)
+        self.m2_x[...] = (1 - a) * (self.m2_x + a * dx * dx)
+        self.m2_y[...] = (1 - a) * (self.m2_y + a * dy * dy)
+        self.c_xy[...] = (1 - a) * (self.c_xy + a * dx * dy)
+        self.n = np.minimum(self.n + 1, self.windows.reshape(self.n.shape))
+
+    def resync(self, k: int, xs: np.ndarray, ys: np.ndarray):
+        # статистики восстанавливаются последовательным проходом по истории (при загрузке)
+        single = EwCorrelation(self.windows[k:k + 1], self.mean_x.shape[1:])
+        for x, y in zip(xs, ys):
+            single.update(x, y)
+        for array, values in ((self.n, single.n), (self.mean_x, single.mean_x), (self.mean_y, single.mean_y),
+                              (self.m2_x, single.m2_x), (self.m2_y, single.m2_y), (self.c_xy, single.c_xy)):
+            array[k] = values[0]
+
+    def _flat(self) -> np.ndarray:
+        # дисперсии уже нормированы, поэтому сравниваются без умножения на количество значений
+        return (self.m2_x <= (FLAT_STD * self.mean_x) ** 2) | (self.m2_y <= (FLAT_STD * self.mean_y) ** 2)
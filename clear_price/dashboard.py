@@ -0,0 +1,370 @@
+"""
+Графики скорректированных цен, отделённые от расчёта.
+Расчёт после каждого таймфрейма только отмечает, что данные изменились (O(1) на таймфрейм), а неизменяемый снимок
+(копии историй и корреляции) строится, когда его запрашивают графики, т.е. не чаще их перерисовки;
+графики читают снимок целиком, поэтому между перерисовками блокировки не нужны.
+Перерисовываются только линии и подписи (blitting), оси и фон - лишь при выходе данных за пределы осей.
+Графики можно запустить в отдельном процессе, тогда снимки передаются через разделяемую память
+и отрисовка не конкурирует с расчётом за GIL.
+"""
+import multiprocessing
+import time
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from clear_price.correlation import RollingCorrelation, normalize
+from clear_price.pairs import PairEngine
+
+# наибольшее количество точек линии на графике, длинная история прореживается
+MAX_POINTS = 2000
+
+
+def _frozen(array: np.ndarray) -> np.ndarray:
+    array = np.array(array)
+    array.flags.writeable = False
+    return array
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    состояние пары для графиков, массивы только для чтения
+    """
+    version: int  # номер снимка, растёт с каждой публикацией
+    follower: str
+    leader: str
+    time: np.ndarray  # время таймфреймов, datetime64[ns]
+    follower_prices: np.ndarray
+    leader_prices: np.ndarray
+    clear_prices: np.ndarray
+    normalized_leader: np.ndarray
+    # корреляции графиков с ценами ведущей валюты: скорректированные, ведущая, нормализованная ведущая, ведомая
+    correlations: tuple[float, float, float, float]
+
+
+class SnapshotPublisher:
+    """
+    Снимки пары для графиков. on_bar вызывается из потока расчёта после каждого таймфрейма и не копирует историю:
+    корреляция скорректированных цен с ведущей валютой обновляется скользящими статистиками, снимок строится
+    при чтении latest (под блокировкой расчёта) или передаётся получателям sinks не чаще раза в interval секунд
+    """
+    def __init__(self, engine: PairEngine, follower: str, every: int = 1, interval: float = 1, lock=None):
+        """
+        :param engine: расчёт скорректированных цен
+        :param follower: ведомая валюта отображаемой пары
+        :param every: обновлять снимок раз в every таймфреймов
+        :param interval: наименьший период передачи снимков получателям sinks в секундах (период перерисовки графиков)
+        :param lock: блокировка расчёта, под которой строится снимок при чтении latest из другого потока
+        """
+        self.engine = engine
+        self.follower = follower
+        self.leader = engine.registry.leader_of(follower)
+        self.every = every
+        self.interval = interval
+        self.lock = lock
+        self.version = 0  # номер данных, растёт раз в every таймфреймов
+        self.sinks = []  # дополнительные получатели снимков (например, SharedSnapshots.write)
+        self._latest: Snapshot | None = None
+        self._bars = 0
+        self._pushed = -np.inf  # время последней передачи снимка получателям
+        # корреляция скорректированных цен с ценами ведущей валюты в окне расчёта
+        self._clear_stats = RollingCorrelation(engine.window)
+        self._count = engine.count  # количество таймфреймов расчёта, учтённых в _clear_stats
+        self._oldest = None  # первые значения окна после прошлого таймфрейма (вытесняются следующим)
+
+    def _resync(self):
+        clear, leader = self.engine.clear_series(self.follower), self.engine.series(self.leader)
+        n = min(len(clear), len(leader))
+        self._clear_stats.resync(clear[len(clear) - n:], leader[len(leader) - n:])
+
+    def _track(self):
+        """
+        обновление корреляции скорректированных цен с ведущей валютой за O(1)
+        """
+        engine = self.engine
+        clear, leader = engine.clear_series(self.follower), engine.series(self.leader)
+        if engine.count != self._count + 1 or self._clear_stats.stale:
+            # история загружена заново (warm_start) или пора сбросить накопленную ошибку
+            self._resync()
+        elif self._oldest is not None and len(clear) == engine.window:
+            self._clear_stats.update(clear[-1], leader[-1], *self._oldest)
+        else:
+            self._clear_stats.update(clear[-1], leader[-1])
+        self._count = engine.count
+        self._oldest = (clear[0], leader[0]) if len(clear) == engine.window else None
+
+    def on_bar(self):
+        """
+        вызывается после обработки таймфрейма (под той же блокировкой, что и расчёт)
+        """
+        self._bars += 1
+        self._track()
+        if self._bars % self.every == 0 and self.engine.time.len:
+            self.version += 1
+            if self.sinks and time.monotonic() - self._pushed >= self.interval:
+                self.publish()
+
+    @property
+    def latest(self) -> Snapshot | None:
+        """
+        :return: снимок последних данных (None, если данных ещё нет), строится только при изменении данных
+        """
+        if self._latest is None or self._latest.version != self.version:
+            if self.lock is None:
+                self.publish()
+            else:
+                with self.lock:
+                    self.publish()
+        return self._latest
+
+    def publish(self) -> Snapshot | None:
+        """
+        построение снимка и передача получателям (вызывается под блокировкой расчёта или из его потока)
+        """
+        engine = self.engine
+        if not engine.time.len:
+            return None
+        if engine.count != self._count:
+            self._resync()
+            self._count, self._oldest = engine.count, None
+        pair = engine.registry.followers.index(self.follower)
+        leader_prices = engine.series(self.leader)
+        # корреляции уже посчитаны скользящими статистиками,
+        # корреляция ряда с собой и с его нормализацией равна 1, если ряд не постоянный
+        self_correlation = 1.0 if np.ptp(leader_prices) else np.nan
+        correlations = (float(self._clear_stats.correlation), self_correlation, self_correlation,
+                        float(np.atleast_1d(engine.stats.correlation)[pair]))
+        self._latest = Snapshot(version=self.version, follower=self.follower, leader=self.leader,
+                                time=_frozen(engine.time.view().view('datetime64[ns]')),
+                                follower_prices=_frozen(engine.series(self.follower)),
+                                leader_prices=_frozen(leader_prices),
+                                clear_prices=_frozen(engine.clear_series(self.follower)),
+                                normalized_leader=_frozen(normalize(leader_prices)),
+                                correlations=correlations)
+        self._pushed = time.monotonic()
+        for sink in self.sinks:
+            sink(self._latest)
+        return self._latest
+
+
+class SharedSnapshots:
+    """
+    Передача снимков между процессами через разделяемую память.
+    Заголовок: номер снимка и длина истории. Запись выполняется по протоколу seqlock:
+    на время записи номер нечётный, читатель повторяет чтение, если номер изменился или нечётный
+    """
+    HEADER = 2 + 4  # номер, длина, четыре корреляции
+    COLUMNS = 5  # время, ведомая, ведущая, скорректированная, нормализованная ведущая
+
+    def __init__(self, max_len: int, follower: str, leader: str, name: str | None = None):
+        """
+        :param max_len: размер истории
+        :param follower: ведомая валюта
+        :param leader: ведущая валюта
+        :param name: имя существующего блока памяти (None - создать новый)
+        """
+        self.max_len, self.follower, self.leader = max_len, follower, leader
+        self._owner = name is None
+        self.memory = shared_memory.SharedMemory(name, create=self._owner,
+                                                 size=8 * (self.HEADER + self.COLUMNS * max_len))
+        self._header = np.ndarray(2, dtype=np.int64, buffer=self.memory.buf)
+        self._correlations = np.ndarray(4, dtype=np.float64, buffer=self.memory.buf, offset=16)
+        self._time = np.ndarray(max_len, dtype=np.int64, buffer=self.memory.buf, offset=8 * self.HEADER)
+        self._columns = np.ndarray((self.COLUMNS - 1, max_len), dtype=np.float64, buffer=self.memory.buf,
+                                   offset=8 * (self.HEADER + max_len))
+        if self._owner:
+            self._header[:] = 0
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def write(self, snapshot: Snapshot):
+        n = len(snapshot.time)
+        self._header[0] += 1
+        self._header[1] = n
+        self._correlations[:] = snapshot.correlations
+        self._time[:n] = snapshot.time.view(np.int64)
+        for row, values in enumerate((snapshot.follower_prices, snapshot.leader_prices,
+                                      snapshot.clear_prices, snapshot.normalized_leader)):
+            self._columns[row, :n] = values
+        self._header[0] += 1
+
+    def read(self) -> Snapshot | None:
+        """
+        :return: последний записанный снимок (копия) или None, если снимков ещё нет
+        """
+        while True:
+            version = int(self._header[0])
+            if not version:
+                return None
+            if version % 2:
+                continue
+            n = int(self._header[1])
+            correlations = tuple(float(value) for value in self._correlations)
+            time = self._time[:n].copy()
+            columns = self._columns[:, :n].copy()
+            if int(self._header[0]) == version:
+                break
+        return Snapshot(version=version // 2, follower=self.follower, leader=self.leader,
+                        time=_frozen(time.view('datetime64[ns]')), follower_prices=_frozen(columns[0]),
+                        leader_prices=_frozen(columns[1]), clear_prices=_frozen(columns[2]),
+                        normalized_leader=_frozen(columns[3]), correlations=correlations)
+
+    def close(self):
+        self.memory.close()
+        if self._owner:
+            self.memory.unlink()
+
+
+def decimate(x: np.ndarray, y: np.ndarray, max_points: int = MAX_POINTS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Прореживание длинного ряда для отображения: ряд делится на группы, из каждой берутся минимум и максимум,
+    поэтому экстремумы не теряются
+    :param x: значения по оси x
+    :param y: значения ряда
+    :param max_points: наибольшее количество точек
+    :return: прореженные x и y
+    """
+    n = len(y)
+    if n <= max_points:
+        return x, y
+    group = -(-n // (max_points // 2))
+    grouped = np.arange(n - n % group).reshape(-1, group)
+    values = y[grouped]
+    rows = np.arange(len(grouped))
+    # nan не выбираются, если в группе есть другие значения
+    low = grouped[rows, np.argmin(np.where(np.isnan(values), np.inf, values), axis=1)]
+    high = grouped[rows, np.argmax(np.where(np.isnan(values), -np.inf, values), axis=1)]
+    index = np.concatenate([np.sort(np.stack([low, high], axis=1), axis=1).ravel(), np.arange(n - n % group, n)])
+    return x[index], y[index]
+
+
+class Dashboard:
+    """
+    четыре графика пары, обновляемые по снимкам с помощью blitting
+    """
+    def __init__(self, source, interval: int = 1000, max_points: int = MAX_POINTS):
+        """
+        :param source: функция без аргументов, возвращающая последний снимок или None
+        :param interval: период проверки новых снимков в миллисекундах
+        :param max_points: наибольшее количество точек линии
+        """
+        import matplotlib.pyplot as plt
+        from matplotlib.dates import AutoDateFormatter, AutoDateLocator
+        from matplotlib.ticker import FuncFormatter
+
+        self.source = source
+        self.max_points = max_points
+        self.version = 0
+        self.fig = plt.figure(figsize=(12, 9))
+        self.axes = [self.fig.add_subplot(2, 2, i) for i in range(1, 5)]
+        formatter = FuncFormatter(lambda y, _: '{:.3f}'.format(y))
+        for i, ax in enumerate(self.axes):
+            ax.tick_params(axis='x', labelsize=6, labelrotation=90)
+            ax.yaxis.set_major_formatter(formatter)
+            if i != 2:  # нормализованные цены отображаются по номеру таймфрейма
+                locator = AutoDateLocator()
+                ax.xaxis.set_major_locator(locator)
+                ax.xaxis.set_major_formatter(AutoDateFormatter(locator))
+        self.lines = [ax.plot([], [], animated=True)[0] for ax in self.axes]
+        self.texts = [ax.text(0.1, 0.1, '', horizontalalignment='left', verticalalignment='bottom',
+                              transform=ax.transAxes, animated=True) for ax in self.axes]
+        self._background = None
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.timer = self.fig.canvas.new_timer(interval=interval)
+        self.timer.add_callback(self.update)
+
+    def _on_draw(self, event):
+        # после полной перерисовки сохраняется фон без линий
+        canvas = self.fig.canvas
+        self._background = canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self.lines + self.texts:
+            self.fig.draw_artist(artist)
+
+    @staticmethod
+    def _fit(ax, x: np.ndarray, y: np.ndarray) -> bool:
+        """
+        расширение пределов оси, если данные за них выходят
+        :return: изменились ли пределы (нужна полная перерисовка)
+        """
+        if not len(x) or np.isnan(y).all():
+            return False
+        (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+        low, high = np.nanmin(y), np.nanmax(y)
+        changed = False
+        if x[0] < x0 or x[-1] > x1:
+            # запас по времени, чтобы пределы менялись не на каждом таймфрейме
+            span = max(x[-1] - x[0], 1e-9)
+            ax.set_xlim(x[0], x[-1] + 0.1 * span)
+            changed = True
+        if low < y0 or high > y1 or low < high and (high - low) < 0.25 * (y1 - y0):
+            margin = max(0.05 * (high - low), 1e-9 * abs(high))
+            ax.set_ylim(low - margin, high + margin)
+            changed = True
+        return changed
+
+    def update(self):
+        snapshot = self.source()
+        if snapshot is None or snapshot.version == self.version:
+            return
+        from matplotlib.dates import date2num
+
+        self.version = snapshot.version
+        time = date2num(snapshot.time)
+        series = [(time, snapshot.clear_prices, f'{snapshot.follower}(CLEAR)'),
+                  (time, snapshot.leader_prices, snapshot.leader),
+                  (np.arange(len(time), dtype=np.float64), snapshot.normalized_leader, f'{snapshot.leader} normalized'),
+                  (time, snapshot.follower_prices, snapshot.follower)]
+        redraw = False
+        for ax, line, text, (x, y, title), correlation in zip(self.axes, self.lines, self.texts, series,
+                                                               snapshot.correlations):
+            x, y = decimate(x, y, self.max_points)
+            line.set_data(x, y)
+            text.set_text(f"Pearson's correlation\n{correlation}")
+            if ax.get_title() != title:
+                ax.set_title(title)
+                redraw = True
+            redraw |= self._fit(ax, x, y)
+
+        canvas = self.fig.canvas
+        if redraw or self._background is None:
+            canvas.draw()
+        else:
+            canvas.restore_region(self._background)
+            self._draw_animated()
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def show(self):
+        import matplotlib.pyplot as plt
+
+        self.timer.start()
+        plt.show()
+
+
+def _show_shared(name: str, max_len: int, follower: str, leader: str, interval: int):
+    shared = SharedSnapshots(max_len, follower, leader, name=name)
+    try:
+        Dashboard(shared.read, interval=interval).show()
+    finally:
+        shared.close()
+
+
+def start_dashboard_process(publisher: SnapshotPublisher, interval: int = 1000) -> tuple[multiprocessing.Process, SharedSnapshots]:
+    """
+    запуск графиков в отдельном процессе, снимки публикатора передаются через разделяемую память
+    :return: процесс графиков и блок разделяемой памяти (закрыть после остановки процесса)
+    """
+    shared = SharedSnapshots(publisher.engine.window, publisher.follower, publisher.leader)
+    publisher.interval = interval / 1000
+    publisher.sinks.append(shared.write)
+    process = multiprocessing.Process(target=_show_shared, daemon=True,
+                                      args=(shared.name, shared.max_len, shared.follower, shared.leader, interval))
+    process.start()
+    return process, shared
@@ -0,0 +1,172 @@
+"""
+Многофакторная корректировка цен: цена ведомой валюты очищается сразу от нескольких ведущих
+(например BTC, SOL и индекса), а не только от одной, как в get_clear_price.
+Коэффициенты регрессии находятся рекурсивным методом наименьших квадратов с экспоненциальным забыванием:
+каждый таймфрейм обновляет обратную ковариационную матрицу одним обновлением ранга 1 (формула Шермана - Моррисона),
+т.е. O(k²) на ведомую валюту при k факторах без пересчёта регрессии по всей истории.
+Ряды центрируются экспоненциальными средними с тем же забыванием, поэтому свободный член не нужен,
+а скорректированная цена - цена ведомой валюты за вычетом влияния отклонений факторов от их средних:
+clear = x - beta · (y - mean_y), аналогично RollingCorrelation.clear_price для одного фактора.
+"""
+import numpy as np
+
+from clear_price.pairs import RollingExtrema, extremum_deviation
+from clear_price.prices import RingBuffer
+
+# начальная обратная ковариационная матрица - DELTA * I (слабая априорная уверенность в нулевых коэффициентах)
+DELTA = 1e4
+
+# наибольший след обратной ковариационной матрицы на используемый фактор в единицах delta
+MAX_TRACE = 1e8
+
+
+class RecursiveLeastSquares:
+    """
+    Рекурсивный МНК для нескольких независимых регрессий одинаковой размерности (по одной на ведомую валюту).
+    Коэффициенты после n обновлений минимизируют sum(forgetting ** (n - t) * (y_t - x_t · beta) ** 2)
+    + forgetting ** n / delta * |beta|².
+    Забывание применяется только к используемым факторам (mask): иначе ковариация по неиспользуемому
+    (всегда нулевому) фактору растёт как forgetting ** -n и через ~700 тысяч таймфреймов переполняется.
+    След матрицы ограничен (MAX_TRACE * delta на фактор): по факторам, которые долго не меняются,
+    неопределённость не растёт неограниченно, а матрица с нечисловыми значениями сбрасывается в начальную.
+    Матрицы симметризуются на каждом обновлении
+    """
+    def __init__(self, regressions: int, factors: int, forgetting: float = 0.999, delta: float = DELTA,
+                 mask: np.ndarray | None = None):
+        """
+        :param regressions: количество регрессий
+        :param factors: количество факторов (k)
+        :param forgetting: коэффициент забывания (0 < forgetting <= 1), эффективная длина истории 1 / (1 - forgetting)
+        :param delta: начальная обратная ковариационная матрица delta * I
+        :param mask: используемые факторы регрессий, форма (регрессии, факторы) (None - все)
+        """
+        self.forgetting = forgetting
+        self.delta = delta
+        mask = np.ones((regressions, factors)) if mask is None else np.asarray(mask, dtype=np.float64)
+        # делители обратных ковариационных матриц: забывание только в блоке используемых факторов
+        self.scale = np.where(mask[:, :, None] * mask[:, None, :] > 0, forgetting, 1.0)
+        self.max_trace = MAX_TRACE * delta * mask.sum(axis=1)
+        self.active = mask[:, :, None] * np.eye(factors)  # диагонали блоков используемых факторов
+        self.beta = np.zeros((regressions, factors))  # коэффициенты регрессий
+        self.p = np.tile(np.eye(factors) * delta, (regressions, 1, 1))  # обратные ковариационные матрицы
+        self.n = 0
+
+    def update(self, x: np.ndarray, y: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """
+        обновление ранга 1 всех регрессий
+        :param x: значения факторов, форма (регрессии, факторы), неиспользуемые факторы - нули
+        :param y: значения зависимых переменных, форма (регрессии,)
+        :param rows: обновляемые регрессии, форма (регрессии,) (None - все), остальные не изменяются
+        :return: априорные остатки y - x · beta (до обновления коэффициентов)
+        """
+        if rows is not None and not rows.all():
+            p, beta = self.p.copy(), self.beta.copy()
+            residual = self.update(np.where(rows[:, None], x, 0), np.where(rows, y, 0))
+            self.p[~rows], self.beta[~rows] = p[~rows], beta[~rows]
+            return np.where(rows, residual, np.nan)
+        px = np.einsum('rij,rj->ri', self.p, x)
+        gain = px / (self.forgetting + np.einsum('ri,ri->r', x, px))[:, None]
+        residual = y - np.einsum('ri,ri->r', x, self.beta)
+        self.beta += gain * residual[:, None]
+        self.p -= gain[:, :, None] * px[:, None, :]
+        # симметризация: иначе ошибка округления в несимметричной части растёт как forgetting ** -n
+        self.p = (self.p + self.p.transpose(0, 2, 1)) / (2 * self.scale)
+        # ограничение следа блока используемых факторов, нечисловой след - сброс матрицы в начальную
+        trace = np.einsum('rii->r', self.p * self.active)
+        over = ~(trace <= self.max_trace)
+        if over.any():
+            for r in np.flatnonzero(over):
+                if np.isfinite(self.p[r]).all():
+                    self.p[r] *= self.max_trace[r] / trace[r]
+                else:
+                    self.p[r] = np.eye(self.p.shape[1]) * self.delta
+                    self.beta[r] = np.nan_to_num(self.beta[r], nan=0, posinf=0, neginf=0)
+        self.n += 1
+        return residual
+
+
+class MultiFactorEngine:
+    """
+    Многофакторный расчёт скорректированных цен для нескольких ведомых валют сразу.
+    Наборы факторов ведомых валют могут различаться по составу и длине: недостающие факторы
+    заполняются нулями и не влияют на регрессию. Ведомая валюта, цена которой или цена одного из её факторов
+    неизвестна (nan), пропускает таймфрейм (скорректированная цена - nan), остальные считаются как обычно
+    """
+    def __init__(self, symbols: list[str], factors: dict[str, list[str]], window: int, forgetting: float = 0.999,
+                 delta: float = DELTA):
+        """
+        :param symbols: символы валют в порядке массива цен on_bar
+        :param factors: словарь {ведомая валюта: [ведущие валюты]}, например {'ETHUSDT': ['BTCUSDT', 'SOLUSDT']}
+        :param window: размер истории скорректированных цен и окна экстремумов (в таймфреймах)
+        :param forgetting: коэффициент забывания регрессий и средних
+        :param delta: начальная обратная ковариационная матрица
+        """
+        if not factors:
+            raise ValueError('Не задано ни одной ведомой валюты')
+        index = {symbol: i for i, symbol in enumerate(symbols)}
+        missing = {symbol for symbol in [*factors, *sum(factors.values(), [])] if symbol not in index}
+        if missing:
+            raise ValueError(f'Нет цен валют: {", ".join(sorted(missing))}')
+        self.followers = list(factors)
+        self.factors = factors
+        k = max(len(leaders) for leaders in factors.values())
+        self.follower_idx = np.array([index[symbol] for symbol in self.followers])
+        # индексы факторов каждой ведомой валюты, форма (ведомые, k), отсутствующие факторы - маска
+        self.factor_idx = np.zeros((len(factors), k), dtype=np.int64)
+        self.factor_mask = np.zeros((len(factors), k))
+        for i, leaders in enumerate(factors.values()):
+            self.factor_idx[i, :len(leaders)] = [index[symbol] for symbol in leaders]
+            self.factor_mask[i, :len(leaders)] = 1
+        self.alpha = 1 - forgetting
+        self.rls = RecursiveLeastSquares(len(factors), k, forgetting, delta, self.factor_mask)
+        self.mean_x = np.zeros(len(factors))  # экспоненциальные средние ведомых валют
+        self.mean_y = np.zeros((len(factors), k))  # экспоненциальные средние факторов
+        self.updates = np.zeros(len(factors), dtype=np.int64)  # количество обновлений регрессий
+        self.residuals = np.full(len(factors), np.nan)  # остатки регрессий за последний таймфрейм
+        self.window = window
+        self.time = RingBuffer(window, dtype=np.int64)
+        self.clear = RingBuffer(window, (len(factors),))
+        self.extrema = RollingExtrema(window, (len(factors),))
+
+    @property
+    def betas(self) -> np.ndarray:
+        """
+        :return: коэффициенты влияния факторов, форма (ведомые, факторы), порядок - как в словаре factors
+        """
+        return self.rls.beta * self.factor_mask
+
+    def on_bar(self, prices: np.ndarray, ticktime: int, percent: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        обработка цен всех валют за очередной таймфрейм
+        :param prices: цены валют в порядке symbols
+        :param ticktime: время таймфрейма в наносекундах от эпохи
+        :param percent: необходимый процент выхода за экстремум
+        :return: скорректированные цены ведомых валют (nan в начале истории) и их выход за экстремумы в процентах
+        """
+        x = prices[self.follower_idx]
+        y = np.where(self.factor_mask > 0, prices[self.factor_idx], 0)
+        # ведомые валюты, цены которых или их факторов неизвестны (nan), в этом таймфрейме не обновляются
+        valid = np.isfinite(x) & np.isfinite(y).all(axis=1)
+        first = valid & (self.updates == 0)
+        self.mean_x = np.where(first, x, np.where(valid, self.mean_x + self.alpha * (x - self.mean_x), self.mean_x))
+        self.mean_y = np.where(first[:, None], y, np.where(valid[:, None], self.mean_y + self.alpha * (y - self.mean_y),
+                                                           self.mean_y))
+        dy = np.where(valid[:, None], y - self.mean_y, 0)
+        self.residuals = self.rls.update(dy, np.where(valid, x - self.mean_x, 0), valid)
+        self.updates += valid
+        # пока регрессия не накопила истории по числу факторов, корректировка невозможна
+        with np.errstate(invalid='ignore'):
+            clear = np.where(valid & (self.updates > self.factor_idx.shape[1]),
+                             x - np.einsum('ri,ri->r', self.betas, dy), np.nan)
+        deviation = extremum_deviation(clear, self.extrema.max, self.extrema.min, percent)
+        self.time.append(ticktime)
+        self.clear.append(clear)
+        self.extrema.append(clear)
+        return clear, deviation
+
+    def clear_series(self, follower: str) -> np.ndarray:
+        """
+        :param follower: символ ведомой валюты
+        :return: история скорректированных цен валюты (view без копирования)
+        """
+        return self.clear.view()[:, self.followers.index(follower)]
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import re
+from typing import Callable, NamedTuple
+
+import numpy as np
+import websockets
+
+try:
+    import orjson
+except ImportError:  # без orjson используется разбор регулярным выражением (или json, если оно не подходит)
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# адрес комбинированных потоков фьючерсов Binance
+BINANCE_FUTURES_URL = 'wss://fstream.binance.com/stream'
+
+# поля символа, цены, объёма и времени сделки в сообщении aggTrade в том виде, в котором их отправляет Binance
+# (без пробелов, поля в этом порядке):
+# {"stream":"btcusdt@aggTrade","data":{"e":"aggTrade","E":...,"a":...,"s":"BTCUSDT","p":"...","q":"...",...,"T":...}}
+_AGG_TRADE_RE = re.compile(rb'"s":"([^"]+)".*?"p":"([^"]+)","q":"([^"]+)".*?"T":(\d+)')
+
+
+class Trades(NamedTuple):
+    """
+    сделки одной валюты в виде столбцов
+    """
+    price: np.ndarray
+    qty: np.ndarray
+    time: np.ndarray  # биржевое время сделок в наносекундах от эпохи
+
+
+def _load_fields(frames: list[bytes], loads: Callable) -> tuple[list, list, list, list]:
+    symbols, prices, qtys, times = [], [], [], []
+    for frame in frames:
+        data = loads(frame)
+        data = data.get('data', data)  # сообщение комбинированного потока или отдельного
+        symbols.append(data['s'])
+        prices.append(data['p'])
+        qtys.append(data['q'])
+        times.append(data['T'])
+    return symbols, prices, qtys, times
+
+
+def _extract_fields(frames: list[bytes]) -> tuple[list, list, list, list]:
+    if orjson is not None:
+        return _load_fields(frames, orjson.loads)
+    # все сообщения пачки разбираются одним проходом регулярного выражения,
+    # если оно нашло не все сообщения (другое форматирование JSON, например json.dumps) - разбор json
+    matches = _AGG_TRADE_RE.findall(b'\n'.join(frames))
+    if len(matches) != len(frames):
+        return _load_fields(frames, json.loads)
+    if not matches:
+        return [], [], [], []
+    symbols, prices, qtys, times = zip(*matches)
+    return [symbol.decode() for symbol in symbols], prices, qtys, times
+
+
+def parse_trades(frames: list[bytes | str]) -> dict[str, Trades]:
+    """
+    Функция разбирает пачку сообщений aggTrade комбинированного (или отдельного) потока Binance,
+    из сообщений извлекаются только символ, цена, объём и время сделки
+    :param frames: сообщения сокета
+    :return: словарь {символ валюты: сделки}
+    """
+    frames = [frame.encode() if isinstance(frame, str) else frame for frame in frames]
+    symbols, prices, qtys, times = _extract_fields(frames)
+    if not symbols:
+        return {}
+    # строки цен и объёмов преобразуются в числа векторно
+    prices = np.array(prices).astype(np.float64)
+    qtys = np.array(qtys).astype(np.float64)
+    times = np.array(times).astype(np.int64) * 1_000_000
+    if len(set(symbols)) == 1:
+        return {symbols[0]: Trades(prices, qtys, times)}
+    # группировка сделок по валютам с сохранением порядка
+    names, inverse = np.unique(np.array(symbols), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(1, len(names)))
+    return {str(name): Trades(prices[idx], qtys[idx], times[idx])
+            for name, idx in zip(names, np.split(order, bounds))}
+
+
+class TradeStream:
+    """
+    Получение сделок из комбинированного потока Binance в цикле событий asyncio.
+    Сообщения складываются в очередь без разбора, обработчик получает их пачками:
+    всё, что накопилось в очереди за время обработки предыдущей пачки, разбирается за один вызов parse_trades
+    """
+    def __init__(self, streams: list[str], url: str = BINANCE_FUTURES_URL, max_batch: int = 5000,
+                 queue_size: int = 100_000):
+        """
+        :param streams: названия потоков, например ['btcusdt@aggTrade']
+        :param url: адрес комбинированных потоков
+        :param max_batch: максимальное количество сообщений в пачке
+        :param queue_size: размер очереди необработанных сообщений
+        """
+        self.url = f'{url}?streams={"/".join(streams)}'
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    async def receive(self):
+        """
+        чтение сообщений сокета в очередь, при разрыве соединения выполняется переподключение
+        """
+        async for ws in websockets.connect(self.url, max_queue=None):
+            try:
+                async for frame in ws:
+                    await self.queue.put(frame)
+            except websockets.ConnectionClosed as ex:
+                logger.warning(f'Соединение с {self.url} разорвано: {ex}')
+
+    async def next_batch(self, timeout: float | None = None) -> list:
+        """
+        :param timeout: время ожидания первого сообщения в секундах (None - без ограничения)
+        :return: все накопившиеся в очереди сообщения (не более max_batch) или пустой список,
+                 если за время ожидания сообщений не было
+        """
+        try:
+            frames = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(frames) < self.max_batch and not self.queue.empty():
+            frames.append(self.queue.get_nowait())
+        return frames
+
+    async def run(self, handler: Callable[[dict[str, Trades]], None], idle: float | None = None,
+                  on_idle: Callable[[], None] | None = None):
+        """
+        получение сделок и передача их обработчику пачками
+        :param handler: обработчик пачки сделок {символ валюты: сделки}
+        :param idle: время без сообщений в секундах, после которого вызывается on_idle
+        :param on_idle: обработчик отсутствия сообщений
+        :raises: ошибка получения сообщений, если оно завершилось (например, неверный адрес)
+        """
+        receiver = asyncio.create_task(self.receive())
+        try:
+            while True:
+                if frames := await self.next_batch(idle):
+                    if trades := parse_trades(frames):
+                        handler(trades)
+                elif receiver.done():
+                    # получение сообщений завершилось - ошибка передаётся вызывающему, а не скрывается за простоем
+                    receiver.result()
+                    raise ConnectionError(f'Получение сообщений {self.url} завершилось')
+                elif on_idle is not None:
+                    on_idle()
+        finally:
+            receiver.cancel()
@@ -0,0 +1,99 @@
+"""
+Гистограммы задержек этапов обработки:
+receive - от биржевого времени сделки до её обработки,
+bar - от конца таймфрейма до закрытия бара,
+clear - от закрытия бара до расчёта скорректированных цен,
+alert - от расчёта до отправки сообщения о выходе за экстремум.
+Корзины гистограмм логарифмические (BUCKETS_PER_OCTAVE на каждое удвоение), поэтому запись - O(1)
+на значение без хранения самих значений, а ошибка квантилей не превышает ширины корзины (~19%).
+"""
+import math
+
+import numpy as np
+
+STAGES = ('receive', 'bar', 'clear', 'alert')
+
+BUCKETS_PER_OCTAVE = 4
+# корзины от 1 нс до 2 ** 40 нс (~18 минут), большие значения попадают в последнюю корзину
+OCTAVES = 40
+
+
+class LatencyHistogram:
+    """
+    гистограмма задержек в наносекундах
+    """
+    def __init__(self):
+        self.counts = np.zeros(OCTAVES * BUCKETS_PER_OCTAVE + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0  # сумма задержек для среднего
+        self.max = 0
+
+    def record(self, latency_ns):
+        """
+        :param latency_ns: задержка или массив задержек в наносекундах (отрицательные считаются нулевыми)
+        """
+        if isinstance(latency_ns, (int, np.integer)):
+            # одно значение записывается без операций над массивами
+            latency = max(int(latency_ns), 0)
+            self.counts[min(int(math.log2(max(latency, 1)) * BUCKETS_PER_OCTAVE), len(self.counts) - 1)] += 1
+            self.count += 1
+            self.total += latency
+            self.max = max(self.max, latency)
+            return
+        latency = np.maximum(np.atleast_1d(latency_ns).astype(np.int64), 0)
+        if not len(latency):
+            return
+        with np.errstate(divide='ignore'):
+            bucket = np.floor(np.log2(np.maximum(latency, 1)) * BUCKETS_PER_OCTAVE).astype(np.int64)
+        self.counts += np.bincount(np.minimum(bucket, len(self.counts) - 1), minlength=len(self.counts))
+        self.count += len(latency)
+        self.total += int(latency.sum())
+        self.max = max(self.max, int(latency.max()))
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else np.nan
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: уровень квантиля от 0 до 1
+        :return: верхняя граница корзины, в которую попадает квантиль (nan, если значений нет)
+        """
+        if not self.count:
+            return np.nan
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return min(2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE), self.max)
+
+    def reset(self):
+        self.counts.fill(0)
+        self.count = self.total = self.max = 0
+
+
+class LatencyMetrics:
+    """
+    гистограммы задержек всех этапов
+    """
+    def __init__(self, stages: tuple[str, ...] = STAGES):
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+
+    def record(self, stage: str, latency_ns):
+        self.histograms[stage].record(latency_ns)
+
+    def __getitem__(self, stage: str) -> LatencyHistogram:
+        return self.histograms[stage]
+
+    def summary(self) -> str:
+        """
+        :return: строка со средней задержкой, медианой, 99-м процентилем и максимумом этапов в миллисекундах
+        """
+        parts = []
+        for stage, histogram in self.histograms.items():
+            if histogram.count:
+                parts.append(f'{stage}: n={histogram.count} mean={histogram.mean / 1e6:.3f} '
+                             f'p50={histogram.quantile(0.5) / 1e6:.3f} p99={histogram.quantile(0.99) / 1e6:.3f} '
+                             f'max={histogram.max / 1e6:.3f}')
+        return ', '.join(parts) + ' мс' if parts else 'нет данных'
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
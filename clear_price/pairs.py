@@ -0,0 +1,323 @@
+import numpy as np
+
+from clear_price.correlation import EwCorrelation, HorizonCorrelation, RollingCorrelation, lagged_correlation
+from clear_price.prices import RingBuffer
+
+
+class PairRegistry:
+    """
+    реестр анализируемых пар: каждая ведомая валюта (follower) корректируется
+    относительно своей ведущей валюты (leader)
+    """
+    def __init__(self, pairs: dict[str, str], extra: list[str] = ()):
+        """
+        :param pairs: словарь {ведомая валюта: ведущая валюта}, например {'ETHUSDT': 'BTCUSDT'}
+        :param extra: другие валюты, цены которых нужно получать (например, факторы MultiFactorEngine)
+        """
+        if not pairs:
+            raise ValueError('Не задано ни одной пары валют')
+        self.followers: list[str] = list(pairs)
+        self.leaders: list[str] = list(dict.fromkeys(pairs.values()))
+        # все валюты, цены которых нужно получать, без повторов
+        self.symbols: list[str] = list(dict.fromkeys(self.leaders + self.followers + list(extra)))
+        self.index: dict[str, int] = {symbol: i for i, symbol in enumerate(self.symbols)}
+        # индексы валют пар в массиве цен всех валют
+        self.follower_idx = np.array([self.index[symbol] for symbol in self.followers])
+        self.leader_idx = np.array([self.index[pairs[symbol]] for symbol in self.followers])
+
+    def __len__(self):
+        return len(self.followers)
+
+    @property
+    def streams(self) -> list[str]:
+        """
+        :return: названия потоков сделок Binance для всех валют
+        """
+        return [f'{symbol.lower()}@aggTrade' for symbol in self.symbols]
+
+    def leader_of(self, follower: str) -> str:
+        return self.symbols[self.leader_idx[self.followers.index(follower)]]
+
+
+class RollingExtrema:
+    """
+    Минимум и максимум скользящего окна сразу для всех столбцов (алгоритм ван Херка - Гил-Вермана).
+    Поток делится на блоки длиной window: для текущего блока хранятся накопленные max/min с начала блока,
+    для предыдущего - max/min от каждой позиции до конца блока, которые пересчитываются векторно
+    один раз за блок. Экстремум окна - max/min из этих двух значений, т.е. O(1) на значение
+    в среднем без цикла по столбцам. Значения nan игнорируются.
+    """
+    def __init__(self, window: int, shape: tuple):
+        """
+        :param window: длина окна
+        :param shape: форма одного значения (количество столбцов)
+        """
+        self.window = window
+        self._block = np.full((window, *shape), np.nan)  # значения текущего блока
+        self._suffix_max = np.full((window, *shape), np.nan)  # max от позиции до конца предыдущего блока
+        self._suffix_min = np.full((window, *shape), np.nan)
+        self._prefix_max = np.full(shape, np.nan)  # max с начала текущего блока
+        self._prefix_min = np.full(shape, np.nan)
+        self._pos = 0  # позиция в текущем блоке
+
+    @property
+    def max(self) -> np.ndarray:
+        """
+        :return: максимумы последних window значений (nan, если значений нет)
+        """
+        return np.fmax(self._suffix_max[self._pos], self._prefix_max)
+
+    @property
+    def min(self) -> np.ndarray:
+        """
+        :return: минимумы последних window значений (nan, если значений нет)
+        """
+        return np.fmin(self._suffix_min[self._pos], self._prefix_min)
+
+    def reset(self):
+        for array in (self._block, self._suffix_max, self._suffix_min, self._prefix_max, self._prefix_min):
+            array.fill(np.nan)
+        self._pos = 0
+
+    def append(self, values: np.ndarray):
+        self._block[self._pos] = values
+        np.fmax(self._prefix_max, values, out=self._prefix_max)
+        np.fmin(self._prefix_min, values, out=self._prefix_min)
+        self._pos += 1
+        if self._pos == self.window:
+            # блок заполнен - он становится предыдущим
+            self._suffix_max[::-1] = np.fmax.accumulate(self._block[::-1], axis=0)
+            self._suffix_min[::-1] = np.fmin.accumulate(self._block[::-1], axis=0)
+            self._prefix_max.fill(np.nan)
+            self._prefix_min.fill(np.nan)
+            self._pos = 0
+
+
+def extremum_deviation(prices: np.ndarray, max_: np.ndarray, min_: np.ndarray, percent: float) -> np.ndarray:
+    """
+    Векторная проверка цен на выход за экстремумы (по правилам check_for_extremum)
+    :param prices: цены
+    :param max_: максимальные цены за историю
+    :param min_: минимальные цены за историю
+    :param percent: необходимый процент превышения
+    :return: процент выхода за максимум (положительный) или за минимум (отрицательный), 0 - выхода нет
+    """
+    # нулевые экстремумы заменяются на nan, тогда деление не выдаёт предупреждений и сравнения ложны
+    max_ = np.where(max_ != 0, max_, np.nan)
+    min_ = np.where(min_ != 0, min_, np.nan)
+    over_percent = (prices - max_) * 100 / max_
+    under_percent = (min_ - prices) * 100 / min_
+    # выход за максимум проверяется первым, за минимум - только если цена не выше максимума более чем на 1%
+    limit = max(1, percent)
+    below = ~(over_percent > 1) & (under_percent > limit)
+    return np.where(over_percent > limit, over_percent, np.where(below, -under_percent, 0.0))
+
+
+class PairEngine:
+    """
+    Расчёт скорректированных цен всех пар реестра. История цен всех валют и скорректированных цен
+    всех пар хранится в двумерных кольцевых буферах (время x валюта), статистики пар - в массивах,
+    поэтому обработка нового таймфрейма - несколько векторных операций над всеми парами сразу.
+
+    Кроме основного окна window можно задать дополнительные горизонты (например 1 минута - 4 часа):
+    их статистики хранятся в массивах (горизонты, пары) и обновляются вместе по общей истории цен,
+    скорректированные цены и выходы за экстремумы горизонтов после каждого таймфрейма
+    доступны в horizon_clear и horizon_deviation.
+
+    При max_lag > 0 цена ведомой валюты в основном окне сопоставляется с ценой ведущей, запаздывающей
+    на lags таймфреймов: каждые lag_every таймфреймов запаздывание каждой пары выбирается по наибольшей
+    по модулю корреляции приращений цен со сдвигами 0..max_lag (lagged_correlation), при его изменении
+    статистики окна пересчитываются. Горизонты считаются без запаздывания.
+
+    Цена валюты может быть nan (таймфреймы до первой сделки или неизвестный стакан): скорректированные цены
+    пар с такой валютой - nan, остальные пары считаются как обычно. Статистики пары пересчитываются по истории,
+    как только таймфрейм с nan выходит из окна
+    """
+    def __init__(self, registry: PairRegistry, window: int, horizons: tuple[int, ...] = (), ew: bool = False,
+                 max_lag: int = 0, lag_every: int = 60):
+        """
+        :param registry: реестр пар
+        :param window: размер анализируемой истории (в таймфреймах)
+        :param horizons: длины дополнительных окон (в таймфреймах)
+        :param ew: считать статистики горизонтов с экспоненциальными весами вместо скользящих окон
+        :param max_lag: наибольшее запаздывание ведомой валюты за ведущей (в таймфреймах), 0 - не учитывать
+        :param lag_every: периодичность оценки запаздывания (в таймфреймах)
+        """
+        self.registry = registry
+        self.window = window
+        self.horizons = tuple(horizons)
+        self.max_lag = max_lag
+        self.lag_every = lag_every
+        self.lags = np.zeros(len(registry), dtype=np.int64)  # запаздывания пар в таймфреймах
+        self.lag_correlation = np.full(len(registry), np.nan)  # корреляция приращений при выбранном запаздывании
+        self.count = 0  # количество обработанных таймфреймов
+        # количество таймфреймов, при котором последний таймфрейм с nan выходит из основного окна и окон горизонтов
+        self._recover_at = -1
+        self._horizon_recover_at = np.full(len(self.horizons), -1)
+        self.time = RingBuffer(window, dtype=np.int64)  # время таймфреймов в наносекундах от эпохи
+        # цены всех валют, история общая для основного окна и горизонтов,
+        # при учёте запаздывания в истории есть и цены ведущих валют на max_lag таймфреймов раньше окна
+        self.prices = RingBuffer(max((window + (max_lag + 1 if max_lag else 0), *self.horizons)),
+                                 (len(registry.symbols),))
+        self.clear = RingBuffer(window, (len(registry),))  # скорректированные цены ведомых валют
+        self.stats = RollingCorrelation(window)
+        self.extrema = RollingExtrema(window, (len(registry),))
+        shape = (len(self.horizons), len(registry))
+        self.horizon_stats = (EwCorrelation if ew else HorizonCorrelation)(self.horizons, (len(registry),))
+        self.horizon_extrema = [RollingExtrema(horizon, (len(registry),)) for horizon in self.horizons]
+        self.horizon_clear = np.full(shape, np.nan)  # скорректированные цены горизонтов за последний таймфрейм
+        self.horizon_deviation = np.zeros(shape)  # выходы за экстремумы горизонтов
+
+    def on_bar(self, prices: np.ndarray, ticktime: int, percent: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        обработка цен всех валют за очередной таймфрейм
+        :param prices: цены валют в порядке registry.symbols
+        :param ticktime: время таймфрейма в наносекундах от эпохи
+        :param percent: необходимый процент выхода за экстремум
+        :return: скорректированные цены пар (nan, если корректировка невозможна)
+                 и их выход за экстремумы в процентах (см. extremum_deviation)
+        """
+        fi, li = self.registry.follower_idx, self.registry.leader_idx
+        history = self.prices.view()
+        n = len(history)
+        if np.isnan(prices[fi]).any() or np.isnan(prices[li]).any():
+            self._recover_at = self.count + self.window + self.max_lag + 1
+            self._horizon_recover_at = self.count + np.asarray(self.horizons, dtype=np.int64) + 1
+        if self.horizons:
+            # значения, вытесняемые из окон горизонтов, берутся из общей истории до добавления новой цены
+            windows = self.horizon_stats.windows
+            evict = n >= windows
+            out = history[np.where(evict, n - windows, 0)] if n else np.zeros((len(windows), len(prices)))
+            self.horizon_stats.update(prices[fi], prices[li], out[:, fi], out[:, li], evict)
+        if self.max_lag:
+            clear = self._on_lagged(prices)
+        else:
+            if n >= self.window:
+                evicted = history[n - self.window].copy()
+                self.stats.update(prices[fi], prices[li], evicted[fi], evicted[li])
+            else:
+                self.stats.update(prices[fi], prices[li])
+            self.prices.append(prices)
+            self.count += 1
+            if self.stats.stale or self.count == self._recover_at:
+                history = self.prices.view()[-self.window:]
+                self.stats.resync(history[:, fi], history[:, li])
+            clear = np.atleast_1d(self.stats.clear_price(prices[fi], prices[li]))
+        self.time.append(ticktime)
+
+        deviation = extremum_deviation(clear, self.extrema.max, self.extrema.min, percent)
+        self.clear.append(clear)
+        self.extrema.append(clear)
+        if self.horizons:
+            self._on_horizons(prices, percent)
+        return clear, deviation
+
+    def _leader_at(self, history: np.ndarray, times: np.ndarray) -> np.ndarray:
+        """
+        :param history: история цен (view)
+        :param times: номера таймфреймов от начала обработки (по паре или форма (..., пары)),
+                      номера до начала обработки заменяются первым таймфреймом
+        :return: цены ведущих валют пар в эти таймфреймы
+        """
+        return history[np.maximum(times, 0) - (self.count - len(history)), self.registry.leader_idx]
+
+    def _resync_lagged(self):
+        history = self.prices.view()
+        times = np.arange(max(self.count - self.window, 0), self.count)
+        self.stats.resync(history[times - (self.count - len(history))][:, self.registry.follower_idx],
+                          self._leader_at(history, times[:, None] - self.lags))
+
+    def _on_lagged(self, prices: np.ndarray) -> np.ndarray:
+        fi = self.registry.follower_idx
+        self.prices.append(prices)
+        self.count += 1
+        history = self.prices.view()
+        t = self.count - 1
+        leader = self._leader_at(history, t - self.lags)
+        if t >= self.window:
+            out = t - self.window
+            self.stats.update(prices[fi], leader, history[out - (self.count - len(history)), fi],
+                              self._leader_at(history, out - self.lags))
+        else:
+            self.stats.update(prices[fi], leader)
+        if self.count % self.lag_every == 0 and self.estimate_lags():
+            self._resync_lagged()
+        elif self.stats.stale or self.count == self._recover_at:
+            self._resync_lagged()
+        return np.atleast_1d(self.stats.clear_price(prices[fi], self._leader_at(history, t - self.lags)))
+
+    def estimate_lags(self) -> bool:
+        """
+        оценка запаздывания ведомых валют за ведущими по приращениям цен основного окна
+        :return: изменилось ли запаздывание хотя бы одной пары
+        """
+        history = self.prices.view()[-self.window:]
+        if len(history) <= self.max_lag + 2:
+            return False
+        returns = np.diff(history, axis=0)
+        correlation = lagged_correlation(returns[:, self.registry.follower_idx], returns[:, self.registry.leader_idx],
+                                         self.max_lag)
+        lags = np.argmax(np.nan_to_num(np.abs(correlation), nan=-1), axis=0)
+        self.lag_correlation = correlation[lags, np.arange(len(lags))]
+        changed = not np.array_equal(lags, self.lags)
+        self.lags = lags
+        return changed
+
+    def _on_horizons(self, prices: np.ndarray, percent: float):
+        fi, li = self.registry.follower_idx, self.registry.leader_idx
+        stale = self.horizon_stats.stale
+        if (self._horizon_recover_at == self.count).any():
+            stale = np.union1d(stale, np.flatnonzero(self._horizon_recover_at == self.count))
+        for k in stale:
+            history = self.prices.view()[-self.horizons[k]:]
+            self.horizon_stats.resync(k, history[:, fi], history[:, li])
+        self.horizon_clear = self.horizon_stats.clear_price(prices[fi], prices[li])
+        # экстремумы всех горизонтов проверяются одной векторной операцией
+        self.horizon_deviation = extremum_deviation(self.horizon_clear,
+                                                    np.array([extrema.max for extrema in self.horizon_extrema]),
+                                                    np.array([extrema.min for extrema in self.horizon_extrema]),
+                                                    percent)
+        for k, extrema in enumerate(self.horizon_extrema):
+            extrema.append(self.horizon_clear[k])
+
+    def load(self, times: np.ndarray, prices: np.ndarray, clear: np.ndarray):
+        """
+        заполнение истории ранее сохранёнными данными (например, при перезапуске)
+        :param times: время таймфреймов в наносекундах от эпохи
+        :param prices: цены валют, форма (таймфреймы, валюты)
+        :param clear: скорректированные цены пар, форма (таймфреймы, пары)
+        """
+        fi, li = self.registry.follower_idx, self.registry.leader_idx
+        self.time.load(times)
+        self.prices.load(prices)
+        self.clear.load(clear)
+        history = self.prices.view()
+        self.count = len(history)
+        self._recover_at = -1
+        self._horizon_recover_at.fill(-1)
+        if self.max_lag:
+            self.estimate_lags()
+            self._resync_lagged()
+        else:
+            self.stats.resync(history[-self.window:, fi], history[-self.window:, li])
+        self.extrema.reset()
+        for values in self.clear.view():
+            self.extrema.append(values)
+        # экстремумы горизонтов накапливаются заново с первого таймфрейма после загрузки
+        for k, horizon in enumerate(self.horizons):
+            self.horizon_stats.resync(k, history[-horizon:, fi], history[-horizon:, li])
+            self.horizon_extrema[k].reset()
+
+    def series(self, symbol: str) -> np.ndarray:
+        """
+        :param symbol: символ валюты
+        :return: история цен валюты за основное окно (view без копирования)
+        """
+        return self.prices.view()[-self.window:, self.registry.index[symbol]]
+
+    def clear_series(self, follower: str) -> np.ndarray:
+        """
+        :param follower: символ ведомой валюты
+        :return: история скорректированных цен валюты (view без копирования)
+        """
+        return self.clear.view()[:, self.registry.followers.index(follower)]
@@ -0,0 +1,167 @@
+"""
+Обработка сделок от получения до сообщений о выходе за экстремумы: агрегация в бары,
+сохранение баров, расчёт скорректированных цен, публикация снимков для графиков и постановка сообщений в очередь.
+Не зависит от сети и графиков, поэтому используется и в программе, и в тестах производительности.
+"""
+import logging
+import time
+from threading import Lock
+
+import numpy as np
+
+from clear_price.alerts import Alert, AlertDispatcher
+from clear_price.bars import BarAggregator, Bars
+from clear_price.book import BookBars, OrderBooks
+from clear_price.dashboard import SnapshotPublisher
+from clear_price.factors import MultiFactorEngine
+from clear_price.ingest import Trades
+from clear_price.metrics import LatencyMetrics
+from clear_price.pairs import PairEngine, PairRegistry
+from clear_price.store import BarStore, TradeStore
+from clear_price.timeseries import TimeSeriesPublisher, bar_samples
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """
+    обработка сделок всех пар реестра
+    """
+    def __init__(self, registry: PairRegistry, tf: float = 1, lateness: float = 0, history: int = 3600,
+                 percent: float = 1, horizons: tuple[int, ...] = (), ew: bool = False,
+                 max_lag: int = 0, lag_every: int = 60,
+                 factors: dict[str, list[str]] | None = None, forgetting: float = 0.999,
+                 books: OrderBooks | None = None, price: str = 'vwap',
+                 bar_store: BarStore | None = None, trade_store: TradeStore | None = None,
+                 dispatcher: AlertDispatcher | None = None, timeseries: TimeSeriesPublisher | None = None,
+                 metrics: LatencyMetrics | None = None):
+        """
+        :param registry: реестр пар
+        :param tf: размер таймфрейма в секундах
+        :param lateness: допустимое опоздание сделок в секундах
+        :param history: размер анализируемой истории в таймфреймах
+        :param percent: процент выхода скорректированной цены за экстремум, о котором нужно сообщить
+        :param horizons: длины дополнительных окон в таймфреймах (см. PairEngine)
+        :param ew: статистики дополнительных окон с экспоненциальными весами
+        :param max_lag: наибольшее запаздывание ведомых валют за ведущими в таймфреймах (0 - не учитывать)
+        :param lag_every: периодичность оценки запаздывания в таймфреймах
+        :param factors: многофакторная корректировка {ведомая валюта: [ведущие валюты]} (None - не выполнять),
+                        все валюты должны быть в реестре (см. PairRegistry extra)
+        :param forgetting: коэффициент забывания многофакторной регрессии
+        :param books: стаканы валют реестра (None - не использовать)
+        :param price: цена валюты за таймфрейм для расчёта: vwap - средневзвешенная цена сделок,
+                      mid - середина спреда, microprice - microprice стакана (mid и microprice требуют books)
+        :param bar_store: хранилище баров (None - не сохранять)
+        :param trade_store: хранилище сделок (None - не сохранять)
+        :param dispatcher: очередь сообщений о выходе за экстремумы (None - не сообщать)
+        :param timeseries: запись баров и скорректированных цен в Redis TimeSeries (None - не записывать)
+        :param metrics: гистограммы задержек этапов
+        """
+        self.registry = registry
+        self.percent = percent
+        # агрегация сделок всех валют в бары таймфрейма
+        self.aggregator = BarAggregator(registry.symbols, tf_ns=int(tf * 1e9), lateness_ns=int(lateness * 1e9))
+        # расчёт скорректированных цен всех пар, блокировка - для чтения истории из других потоков
+        self.engine = PairEngine(registry, window=history, horizons=horizons, ew=ew, max_lag=max_lag,
+                                 lag_every=lag_every)
+        self.factor_engine = MultiFactorEngine(registry.symbols, factors, window=history, forgetting=forgetting) \
+            if factors else None
+        self.lock = Lock()
+        if price not in ('vwap', 'mid', 'microprice'):
+            raise ValueError(f'Неизвестная цена таймфрейма: {price}')
+        if price != 'vwap' and books is None:
+            raise ValueError(f'Для цены {price} нужны стаканы')
+        self.books = books
+        self.price = price
+        self.book_bars: BookBars | None = None  # бары стаканов последнего таймфрейма
+        self.bar_store = bar_store
+        self.trade_store = trade_store
+        self.dispatcher = dispatcher
+        self.timeseries = timeseries
+        self.metrics = metrics or LatencyMetrics()
+        self.publisher: SnapshotPublisher | None = None  # снимки для графиков
+
+    def check_for_extremum(self, clear: np.ndarray, deviation: np.ndarray, ticktime: int, created: int,
+                           horizon: int | None = None, followers: list[str] | None = None):
+        """
+        постановка в очередь сообщений о выходе скорректированных цен за экстремумы
+        :param clear: скорректированные цены пар
+        :param deviation: выход цен пар за экстремумы в процентах (см. extremum_deviation)
+        :param ticktime: время таймфрейма в наносекундах от эпохи
+        :param created: время расчёта скорректированных цен (time.time_ns())
+        :param horizon: длина дополнительного окна (None - основное окно)
+        :param followers: названия ведомых валют в порядке clear (None - ведомые валюты реестра)
+        """
+        if self.dispatcher is None:
+            return
+        followers = followers or self.registry.followers
+        try:
+            for i in np.flatnonzero(deviation):
+                self.dispatcher.emit(Alert(time=ticktime, follower=followers[i],
+                                           deviation=float(deviation[i]), clear_price=float(clear[i]),
+                                           created=created, horizon=horizon))
+        except Exception:
+            logger.exception('При проверке цены на экстремум возникла ошибка')
+
+    def write_tf_price(self, bars: Bars):
+        """
+        запись цен закрытого таймфрейма и расчёт скорректированных цен
+        :param bars: бары всех валют за таймфрейм
+        """
+        try:
+            closed = time.time_ns()
+            self.metrics.record('bar', closed - bars.time - self.aggregator.tf_ns)
+            # цена валюты за таймфрейм - средневзвешенная по объёму цена сделок или цена стакана;
+            # до первой сделки (или пока стакан неизвестен) цена - nan, и считаются только пары без таких валют
+            prices = bars.vwap
+            if self.books is not None:
+                self.book_bars = self.books.bar(bars.time)
+                if self.price != 'vwap':
+                    prices = getattr(self.book_bars, self.price)
+            if self.bar_store is not None:
+                self.bar_store.append(bars, self.registry.symbols, prices)
+
+            # расчёт скорректированных цен всех пар и проверка на экстремум
+            with self.lock:
+                clear, deviation = self.engine.on_bar(prices, bars.time, self.percent)
+                if self.factor_engine is not None:
+                    factor_clear, factor_deviation = self.factor_engine.on_bar(prices, bars.time, self.percent)
+                if self.publisher is not None:
+                    self.publisher.on_bar()
+            created = time.time_ns()
+            self.metrics.record('clear', created - closed)
+            self.check_for_extremum(clear, deviation, bars.time, created)
+            for k, horizon in enumerate(self.engine.horizons):
+                if self.engine.horizon_deviation[k].any():
+                    self.check_for_extremum(self.engine.horizon_clear[k], self.engine.horizon_deviation[k],
+                                            bars.time, created, horizon)
+            if self.factor_engine is not None and factor_deviation.any():
+                self.check_for_extremum(factor_clear, factor_deviation, bars.time, created, followers=[
+                    f'{follower}[{",".join(leaders)}]' for follower, leaders in self.factor_engine.factors.items()])
+            if self.timeseries is not None:
+                self.timeseries.emit(*bar_samples(self.registry.symbols, bars, prices, clear, self.registry.followers,
+                                                  self.book_bars))
+        except Exception:
+            logger.exception('При записи цен возникла ошибка')
+
+    def handle_trades(self, trades: dict[str, Trades]):
+        """
+        агрегация пачки сделок в бары и обработка закрытых таймфреймов
+        :param trades: словарь {символ валюты: сделки}
+        """
+        received = time.time_ns()
+        for columns in trades.values():
+            self.metrics.record('receive', received - columns.time)
+        if self.trade_store is not None:
+            self.trade_store.append(trades)
+        for bars in self.aggregator.add(trades):
+            self.write_tf_price(bars)
+
+    def close_idle_bars(self, now: int | None = None):
+        """
+        если сделок нет, таймфреймы закрываются по локальному времени с запасом в один таймфрейм
+        :param now: текущее время в наносекундах от эпохи (None - time.time_ns())
+        """
+        now = time.time_ns() if now is None else now
+        for bars in self.aggregator.advance(now - self.aggregator.lateness_ns - self.aggregator.tf_ns):
+            self.write_tf_price(bars)
@@ -0,0 +1,154 @@
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    кольцевой буфер фиксированного размера на предвыделенном массиве NumPy.
+    Каждое значение записывается дважды - в позицию i и i + max_len ("зеркальный" буфер),
+    поэтому упорядоченная от старых к новым история всегда является непрерывным срезом массива
+    и возвращается как view без копирования
+    """
+    def __init__(self, max_len: int, shape: tuple = (), dtype=np.float64):
+        """
+        :param max_len: максимальное количество хранимых значений
+        :param shape: форма одного значения (например (n,) для n валют)
+        :param dtype: тип значений
+        """
+        if max_len <= 0:
+            raise ValueError(f'Размер буфера должен быть положительным: {max_len}')
+        self.max_len = max_len
+        self._data = np.zeros((2 * max_len, *shape), dtype=dtype)
+        self._pos = 0  # позиция следующей записи
+        self.len = 0  # текущее количество значений
+
+    @property
+    def full(self) -> bool:
+        return self.len == self.max_len
+
+    def append(self, value):
+        """
+        добавляет значение в буфер за O(1)
+        :param value: добавляемое значение
+        :return: вытесненное из буфера значение или None, если буфер ещё не заполнен
+        """
+        evicted = self._data[self._pos].copy() if self.full else None
+        self._data[self._pos] = value
+        self._data[self._pos + self.max_len] = value
+        self._pos = (self._pos + 1) % self.max_len
+        if not self.full:
+            self.len += 1
+        return evicted
+
+    def view(self) -> np.ndarray:
+        """
+        :return: view упорядоченной от старых к новым истории (без копирования)
+        """
+        start = (self._pos - self.len) % self.max_len
+        return self._data[start:start + self.len]
+
+    def load(self, values: np.ndarray):
+        """
+        заменяет содержимое буфера последними max_len значениями
+        :param values: значения, упорядоченные от старых к новым
+        """
+        values = values[len(values) - min(len(values), self.max_len):]
+        self.len = len(values)
+        self._data[:self.len] = values
+        self._data[self.max_len:self.max_len + self.len] = values
+        self._pos = self.len % self.max_len
+
+
+class Prices:
+    """
+    класс для хранения котировок валют
+    """
+    def __init__(self, symbol: str, max_len: int):
+        """
+        :param symbol: символ валюты
+        :param max_len: максимальный размер хранимой истории цен
+        """
+        self.symbol: str = symbol
+        self.__prices = RingBuffer(max_len)
+        self.__time = RingBuffer(max_len, dtype=np.int64)  # время цен в наносекундах от эпохи
+        # монотонные очереди (номер цены, цена) для минимума и максимума скользящего окна:
+        # в очереди минимумов цены возрастают, в очереди максимумов - убывают,
+        # первый элемент очереди - экстремум текущего окна
+        self.__min_deque: deque[tuple[int, float]] = deque()
+        self.__max_deque: deque[tuple[int, float]] = deque()
+        self.__count = 0  # количество цен, добавленных за всё время
+        self.__max_len = max_len
+
+    @property
+    def len(self) -> int:
+        """
+        :return: текущая длина истории
+        """
+        return self.__prices.len
+
+    @property
+    def prices(self) -> np.ndarray:
+        """
+        :return: упорядоченная история цен (view без копирования)
+        """
+        return self.__prices.view()
+
+    @property
+    def time_ns(self) -> np.ndarray:
+        """
+        :return: упорядоченная история времени цен в наносекундах от эпохи (view без копирования)
+        """
+        return self.__time.view()
+
+    @property
+    def time(self) -> np.ndarray:
+        """
+        :return: упорядоченная история времени цен в виде datetime64[ns] (view без копирования)
+        """
+        return self.__time.view().view('datetime64[ns]')
+
+    @property
+    def min(self) -> float:
+        """
+        :return: минимальная цена за всю хранимую историю
+        """
+        return self.__min_deque[0][1] if self.__min_deque else 0
+
+    @property
+    def max(self) -> float:
+        """
+        :return: максимальная цена за всю хранимую историю
+        """
+        return self.__max_deque[0][1] if self.__max_deque else 0
+
+    def append(self, price: float, ticktime: int | datetime):
+        """
+        метод добавляет в историю цену, амортизированная сложность O(1)
+        :param price: добавляемая цена
+        :param ticktime: время цены (наносекунды от эпохи или datetime)
+        :return: вытесненная из истории цена или None, если история ещё не заполнена
+        """
+        if isinstance(ticktime, datetime):
+            ticktime = int(ticktime.timestamp() * 1e9)
+
+        evicted = self.__prices.append(price)
+        self.__time.append(ticktime)
+
+        seq = self.__count
+        self.__count += 1
+        while self.__min_deque and self.__min_deque[-1][1] >= price:
+            self.__min_deque.pop()
+        self.__min_deque.append((seq, price))
+        while self.__max_deque and self.__max_deque[-1][1] <= price:
+            self.__max_deque.pop()
+        self.__max_deque.append((seq, price))
+        # удаление цен, вышедших за пределы окна
+        oldest = seq - self.__max_len
+        if self.__min_deque[0][0] <= oldest:
+            self.__min_deque.popleft()
+        if self.__max_deque[0][0] <= oldest:
+            self.__max_deque.popleft()
+
+        return None if evicted is None else float(evicted)
@@ -0,0 +1,264 @@
+"""
+Воспроизведение записанных сделок через агрегацию в бары и расчёт скорректированных цен
+быстрее реального времени. Поддерживаемые файлы:
+- CSV выгрузки aggTrades Binance (data.binance.vision), в том числе упакованные в zip,
+  символ валюты берётся из имени файла: BTCUSDT-aggTrades-2023-10-01.csv;
+- Parquet с теми же столбцами (нужен pyarrow);
+- JSONL с сообщениями aggTrade (комбинированного или отдельного потока), по сообщению в строке.
+
+Пример запуска:
+    python -m clear_price.replay --pair ETHUSDT:BTCUSDT --speed 60 ETHUSDT-aggTrades-2023-10-01.zip BTCUSDT-aggTrades-2023-10-01.zip
+"""
+import argparse
+import io
+import itertools
+import time
+import zipfile
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Iterable, Iterator
+
+import numpy as np
+
+from clear_price.bars import BarAggregator
+from clear_price.ingest import Trades, parse_trades
+from clear_price.pairs import PairEngine, PairRegistry
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # файлы Parquet читаются только при установленном pyarrow
+    pq = None
+
+# количество строк, читаемых из файла за один раз
+CHUNK_SIZE = 100_000
+
+# столбцы цены, объёма и времени сделки в выгрузках aggTrades
+# (agg_trade_id, price, quantity, first_trade_id, last_trade_id, transact_time, is_buyer_maker)
+AGG_TRADES_COLUMNS = (1, 2, 5)
+
+
+def _to_ns(ticktime: np.ndarray) -> np.ndarray:
+    # в выгрузках время в миллисекундах, в новых выгрузках spot - в микросекундах
+    if len(ticktime) and ticktime[0] > 10 ** 17:
+        return ticktime
+    return ticktime * (1_000 if len(ticktime) and ticktime[0] > 10 ** 14 else 1_000_000)
+
+
+def symbol_from_path(path: Path) -> str:
+    """
+    :param path: путь к файлу выгрузки, например BTCUSDT-aggTrades-2023-10-01.csv
+    :return: символ валюты
+    """
+    return path.name.split('-')[0].upper()
+
+
+def _open_text(path: Path) -> IO[str]:
+    # выгрузки Binance упакованы в zip с одним CSV внутри
+    if path.suffix == '.zip':
+        archive = zipfile.ZipFile(path)
+        return io.TextIOWrapper(archive.open(archive.namelist()[0]))
+    return open(path)
+
+
+def read_csv(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[dict[str, Trades]]:
+    """
+    чтение выгрузки aggTrades в формате CSV (или zip с одним CSV) частями
+    """
+    symbol = symbol_from_path(path)
+    with _open_text(path) as file:
+        lines = iter(file)
+        first = next(lines, '')
+        # в выгрузках фьючерсов первая строка - заголовок
+        if first[:1].isdigit():
+            lines = itertools.chain([first], lines)
+        while chunk := list(itertools.islice(lines, chunk_size)):
+            rows = np.loadtxt(chunk, delimiter=',', usecols=AGG_TRADES_COLUMNS, dtype=np.float64, ndmin=2)
+            yield {symbol: Trades(rows[:, 0], rows[:, 1], _to_ns(rows[:, 2].astype(np.int64)))}
+
+
+def read_parquet(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[dict[str, Trades]]:
+    """
+    чтение выгрузки aggTrades в формате Parquet частями
+    """
+    if pq is None:
+        raise ImportError(f'Для чтения {path} нужен pyarrow')
+    symbol = symbol_from_path(path)
+    for batch in pq.ParquetFile(path).iter_batches(chunk_size, columns=['price', 'quantity', 'transact_time']):
+        yield {symbol: Trades(batch.column(0).to_numpy().astype(np.float64),
+                              batch.column(1).to_numpy().astype(np.float64),
+                              _to_ns(batch.column(2).to_numpy().astype(np.int64)))}
+
+
+def read_jsonl(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[dict[str, Trades]]:
+    """
+    чтение записанных сообщений aggTrade частями
+    """
+    with open(path, 'rb') as file:
+        while chunk := list(itertools.islice(file, chunk_size)):
+            yield parse_trades([line for line in chunk if line.strip()])
+
+
+def read_trades(path: str | Path, chunk_size: int = CHUNK_SIZE) -> Iterator[dict[str, Trades]]:
+    """
+    :param path: путь к файлу сделок
+    :param chunk_size: количество сделок в одной части
+    :return: итератор частей файла {символ валюты: сделки}
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        return read_parquet(path, chunk_size)
+    if path.suffix in ('.jsonl', '.json'):
+        return read_jsonl(path, chunk_size)
+    return read_csv(path, chunk_size)
+
+
+def _next_chunk(source: Iterator[dict[str, Trades]]) -> dict[str, Trades] | None:
+    # пропуск частей без сделок
+    for chunk in source:
+        if chunk := {symbol: trades for symbol, trades in chunk.items() if len(trades.time)}:
+            return chunk
+    return None
+
+
+def merge_by_time(sources: list[Iterator[dict[str, Trades]]]) -> Iterator[dict[str, Trades]]:
+    """
+    Слияние нескольких упорядоченных по времени источников сделок.
+    На каждом шаге выдаются сделки всех источников до наименьшего из времён последних сделок
+    текущих частей, поэтому пачки следуют друг за другом без пересечения по времени
+    :param sources: источники частей сделок
+    :return: итератор пачек {символ валюты: сделки}
+    """
+    current = [_next_chunk(source) for source in sources]
+    while active := [i for i, chunk in enumerate(current) if chunk is not None]:
+        cutoff = min(max(int(trades.time[-1]) for trades in current[i].values()) for i in active)
+        batch: dict[str, list[Trades]] = {}
+        for i in active:
+            rest = {}
+            for symbol, trades in current[i].items():
+                split = np.searchsorted(trades.time, cutoff, side='right')
+                if split:
+                    batch.setdefault(symbol, []).append(Trades(*(column[:split] for column in trades)))
+                if split < len(trades.time):
+                    rest[symbol] = Trades(*(column[split:] for column in trades))
+            current[i] = rest or _next_chunk(sources[i])
+        yield {symbol: parts[0] if len(parts) == 1 else Trades(*map(np.concatenate, zip(*parts)))
+               for symbol, parts in batch.items()}
+
+
+@dataclass
+class ReplayReport:
+    """
+    результат воспроизведения
+    """
+    trades: int = 0  # количество обработанных сделок
+    bars: int = 0  # количество закрытых таймфреймов
+    late: int = 0  # количество отброшенных опоздавших сделок
+    elapsed: float = 0.0  # длительность воспроизведения в секундах
+    # выходы скорректированных цен за экстремумы: (время таймфрейма в нс, ведомая валюта, процент)
+    alerts: list[tuple[int, str, float]] = field(default_factory=list)
+
+    @property
+    def trades_per_second(self) -> float:
+        return self.trades / self.elapsed if self.elapsed else 0.0
+
+
+def paced(batches: Iterable[dict[str, Trades]], tf_ns: int, speed: float) -> Iterator[dict[str, Trades]]:
+    """
+    Воспроизведение пачек сделок со скоростью speed относительно реального времени:
+    пачки делятся на части длительностью в один таймфрейм, перед каждой частью выполняется ожидание
+    :param batches: пачки сделок в порядке времени
+    :param tf_ns: размер таймфрейма в наносекундах
+    :param speed: во сколько раз быстрее реального времени воспроизводить
+    :return: итератор пачек
+    """
+    started = time.perf_counter()
+    first_time = None
+    for batch in batches:
+        batch_time = min(int(trades.time[0]) for trades in batch.values())
+        first_time = batch_time if first_time is None else first_time
+        end_time = max(int(trades.time[-1]) for trades in batch.values())
+        for bucket in range(batch_time // tf_ns, end_time // tf_ns + 1):
+            part = {}
+            for symbol, trades in batch.items():
+                start, end = np.searchsorted(trades.time, [bucket * tf_ns, (bucket + 1) * tf_ns])
+                if end > start:
+                    part[symbol] = Trades(*(column[start:end] for column in trades))
+            if not part:
+                continue
+            part_time = max(bucket * tf_ns, first_time)
+            if (delay := (part_time - first_time) / 1e9 / speed - (time.perf_counter() - started)) > 0:
+                time.sleep(delay)
+            yield part
+
+
+def replay(batches: Iterable[dict[str, Trades]], registry: PairRegistry, tf: float = 1, history: int = 3600,
+           percent: float = 1, lateness: float = 0, speed: float | None = None) -> ReplayReport:
+    """
+    Воспроизведение сделок через агрегацию в бары и расчёт скорректированных цен
+    :param batches: пачки сделок в порядке времени
+    :param registry: реестр пар
+    :param tf: размер таймфрейма в секундах
+    :param history: размер анализируемой истории в таймфреймах
+    :param percent: процент выхода за экстремум
+    :param lateness: допустимое опоздание сделок в секундах
+    :param speed: во сколько раз быстрее реального времени воспроизводить (None - без ожидания)
+    :return: результат воспроизведения
+    """
+    aggregator = BarAggregator(registry.symbols, tf_ns=int(tf * 1e9), lateness_ns=int(lateness * 1e9))
+    engine = PairEngine(registry, window=history)
+    report = ReplayReport()
+    started = time.perf_counter()
+
+    def on_bars(closed):
+        for bars in closed:
+            report.bars += 1
+            _, deviation = engine.on_bar(bars.vwap, bars.time, percent)
+            for i in np.flatnonzero(deviation):
+                report.alerts.append((bars.time, registry.followers[i], float(deviation[i])))
+
+    batches = (batch for batch in batches if batch)
+    if speed:
+        batches = paced(batches, aggregator.tf_ns, speed)
+    last_time = None  # время самой поздней сделки
+    for batch in batches:
+        report.trades += sum(len(trades.time) for trades in batch.values())
+        latest = max(int(trades.time.max()) for trades in batch.values() if len(trades.time))
+        last_time = latest if last_time is None else max(last_time, latest)
+        on_bars(aggregator.add(batch))
+    # закрытие всех оставшихся таймфреймов (при опоздании открытыми могут остаться несколько)
+    if last_time is not None:
+        on_bars(aggregator.advance(last_time + aggregator.lateness_ns + aggregator.tf_ns))
+
+    report.late = aggregator.late
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных сделок Binance')
+    parser.add_argument('files', nargs='+', help='файлы сделок (csv, zip, parquet, jsonl)')
+    parser.add_argument('--pair', action='append', required=True,
+                        help='пара ВЕДОМАЯ:ВЕДУЩАЯ, например ETHUSDT:BTCUSDT (можно указать несколько)')
+    parser.add_argument('--tf', type=float, default=1, help='размер таймфрейма в секундах')
+    parser.add_argument('--history', type=int, default=3600, help='размер истории в таймфреймах')
+    parser.add_argument('--percent', type=float, default=1, help='процент выхода за экстремум')
+    parser.add_argument('--lateness', type=float, default=0, help='допустимое опоздание сделок в секундах')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='скорость относительно реального времени (по умолчанию - максимальная)')
+    args = parser.parse_args(argv)
+
+    registry = PairRegistry(dict(pair.upper().split(':') for pair in args.pair))
+    report = replay(merge_by_time([read_trades(path) for path in args.files]), registry,
+                    tf=args.tf, history=args.history, percent=args.percent, lateness=args.lateness,
+                    speed=args.speed)
+    for ticktime, follower, deviation in report.alerts:
+        direction = 'превысила максимальную' if deviation > 0 else 'уменьшилась от минимальной'
+        print(f'{datetime.fromtimestamp(ticktime / 1e9)} цена {follower}(CLEAR) {direction} '
+              f'за прошедшую историю на {abs(deviation)}')
+    print(f'сделок: {report.trades}, таймфреймов: {report.bars}, опоздавших сделок: {report.late}, '
+          f'время: {report.elapsed:.3f} с, {report.trades_per_second:.0f} сделок/с')
+
+
+if __name__ == '__main__':
+    main()
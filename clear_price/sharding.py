@@ -0,0 +1,318 @@
+"""
+Многопроцессный режим: получение сделок, агрегация и расчёт выполняются в разных процессах
+и не конкурируют за один GIL.
+Процессы получения сделок (ingest) делят между собой потоки валют, разбирают сообщения и пишут сделки
+в кольцевые буферы в разделяемой памяти (TradeRing) - по буферу на каждую пару (процесс получения, процесс расчёта).
+Процессы расчёта (analytics) делят между собой пары валют: каждый читает сделки своих валют
+из буферов и обрабатывает их своим Pipeline.
+Остановка: главный процесс по Ctrl+C / SIGTERM выставляет событие stop, дочерние процессы игнорируют SIGINT,
+завершают циклы по событию, процессы расчёта дорабатывают прочитанные сделки, затем буферы удаляются.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from multiprocessing import shared_memory
+from typing import Callable
+
+import numpy as np
+
+from clear_price.ingest import BINANCE_FUTURES_URL, Trades, TradeStream
+from clear_price.pairs import PairRegistry
+from clear_price.pipeline import Pipeline
+from clear_price.store import warm_start
+
+logger = logging.getLogger(__name__)
+
+# запись сделки в буфере, symbol - номер валюты в общем списке символов
+TRADE_RECORD = np.dtype([('time', np.int64), ('price', np.float64), ('qty', np.float64), ('symbol', np.int64)])
+
+# размер буфера по умолчанию (сделок), около 32 МБ
+RING_CAPACITY = 1 << 20
+
+# пауза процесса расчёта, если новых сделок нет, в секундах
+POLL_INTERVAL = 0.001
+
+
+class TradeRing:
+    """
+    Кольцевой буфер сделок в разделяемой памяти с одним писателем и одним читателем.
+    Заголовок - два счётчика: всего записано и всего прочитано; писатель меняет только первый,
+    читатель - только второй, поэтому блокировки не нужны. Счётчик записанных сделок обновляется
+    после записи самих сделок. Если места нет, лишние сделки отбрасываются (счётчик dropped писателя)
+    """
+    HEADER = 64  # байт, счётчики в отдельной строке кэша от данных
+
+    def __init__(self, capacity: int = RING_CAPACITY, name: str | None = None):
+        """
+        :param capacity: размер буфера в сделках
+        :param name: имя существующего буфера (None - создать новый)
+        """
+        self.capacity = capacity
+        self._owner = name is None
+        self.memory = shared_memory.SharedMemory(name, create=self._owner,
+                                                 size=self.HEADER + capacity * TRADE_RECORD.itemsize)
+        self._counters = np.ndarray(2, dtype=np.int64, buffer=self.memory.buf)
+        self._records = np.ndarray(capacity, dtype=TRADE_RECORD, buffer=self.memory.buf, offset=self.HEADER)
+        if self._owner:
+            self._counters[:] = 0
+        self.dropped = 0
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def __len__(self):
+        return int(self._counters[0] - self._counters[1])
+
+    def write(self, records: np.ndarray) -> int:
+        """
+        :param records: сделки TRADE_RECORD
+        :return: количество записанных сделок
+        """
+        written, read = int(self._counters[0]), int(self._counters[1])
+        n = min(len(records), self.capacity - (written - read))
+        self.dropped += len(records) - n
+        start = written % self.capacity
+        first = min(n, self.capacity - start)
+        self._records[start:start + first] = records[:first]
+        self._records[:n - first] = records[first:n]
+        self._counters[0] = written + n
+        return n
+
+    def read(self, max_records: int | None = None) -> np.ndarray:
+        """
+        :param max_records: наибольшее количество сделок (None - все доступные)
+        :return: копия прочитанных сделок
+        """
+        written, read = int(self._counters[0]), int(self._counters[1])
+        n = written - read if max_records is None else min(written - read, max_records)
+        start = read % self.capacity
+        first = min(n, self.capacity - start)
+        records = np.concatenate([self._records[start:start + first], self._records[:n - first]])
+        self._counters[1] = read + n
+        return records
+
+    def close(self):
+        self.memory.close()
+        if self._owner:
+            self.memory.unlink()
+
+
+def to_records(symbol: int, trades: Trades) -> np.ndarray:
+    records = np.empty(len(trades.time), dtype=TRADE_RECORD)
+    records['time'], records['price'], records['qty'], records['symbol'] = trades.time, trades.price, trades.qty, symbol
+    return records
+
+
+def from_records(records: np.ndarray, symbols: list[str]) -> dict[str, Trades]:
+    """
+    :param records: сделки TRADE_RECORD
+    :param symbols: общий список символов
+    :return: словарь {символ валюты: сделки}
+    """
+    result = {}
+    for symbol in np.unique(records['symbol']):
+        part = records[records['symbol'] == symbol]
+        result[symbols[symbol]] = Trades(part['price'], part['qty'], part['time'])
+    return result
+
+
+def shard_pairs(pairs: dict[str, str], shards: int) -> list[dict[str, str]]:
+    """
+    Разделение пар между процессами расчёта: пары упорядочиваются по ведущей валюте и делятся
+    на части почти равного размера, поэтому пары с общей ведущей валютой по возможности попадают в один процесс
+    :return: непустые части словаря пар
+    """
+    ordered = sorted(pairs.items(), key=lambda pair: pair[1])
+    bounds = np.linspace(0, len(ordered), min(shards, len(ordered)) + 1).round().astype(int)
+    return [dict(ordered[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _ignore_sigint():
+    # дочерние процессы останавливаются событием stop главного процесса
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _ingest(symbols: list[str], own: list[str], routes: dict[str, list[str]], capacity: int, url: str, stop):
+    """
+    процесс получения сделок валют own
+    :param routes: {символ валюты: имена буферов процессов расчёта, которым нужны её сделки}
+    """
+    _ignore_sigint()
+    index = {symbol: i for i, symbol in enumerate(symbols)}
+    rings = {name: TradeRing(capacity, name) for name in {name for names in routes.values() for name in names}}
+
+    def handle(trades: dict[str, Trades]):
+        for symbol, columns in trades.items():
+            if names := routes.get(symbol):
+                records = to_records(index[symbol], columns)
+                for name in names:
+                    rings[name].write(records)
+
+    async def run():
+        stream = TradeStream([f'{symbol.lower()}@aggTrade' for symbol in own], url=url)
+        task = asyncio.create_task(stream.run(handle))
+        while not stop.is_set() and not task.done():
+            await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    try:
+        asyncio.run(run())
+    finally:
+        dropped = sum(ring.dropped for ring in rings.values())
+        if dropped:
+            logger.warning(f'Буферы сделок переполнены, отброшено сделок: {dropped}')
+        for ring in rings.values():
+            ring.close()
+
+
+class AnalyticsWorker:
+    """
+    обработка сделок пар одной части: чтение буферов и передача сделок в Pipeline
+    """
+    def __init__(self, pipeline: Pipeline, symbols: list[str], rings: list[TradeRing], tf: float,
+                 metrics_interval: float = 60):
+        """
+        :param pipeline: обработка сделок пар части
+        :param symbols: общий список символов (номера валют в буферах)
+        :param rings: буферы процессов получения сделок
+        :param tf: размер таймфрейма в секундах (при отсутствии сделок таймфреймы закрываются по времени)
+        :param metrics_interval: период вывода гистограмм задержек в секундах
+        """
+        self.pipeline = pipeline
+        self.symbols = symbols
+        self.rings = rings
+        self.tf = tf
+        self.metrics_interval = metrics_interval
+        self._last_trade = self._last_metrics = time.monotonic()
+
+    def poll(self) -> int:
+        """
+        :return: количество обработанных сделок
+        """
+        records = [ring.read() for ring in self.rings]
+        count = sum(len(part) for part in records)
+        if count:
+            self.pipeline.handle_trades(from_records(np.concatenate(records), self.symbols))
+            self._last_trade = time.monotonic()
+        elif time.monotonic() - self._last_trade >= self.tf:
+            self.pipeline.close_idle_bars()
+            self._last_trade = time.monotonic()
+        if time.monotonic() - self._last_metrics >= self.metrics_interval:
+            logger.info(f'Задержки {self.pipeline.registry.followers}: {self.pipeline.metrics.summary()}')
+            self.pipeline.metrics.reset()
+            self._last_metrics = time.monotonic()
+        return count
+
+    async def run(self, stop):
+        # очереди, которые при остановке дорабатываются: сообщения о выходе за экстремумы и запись в Redis
+        writers = [(writer, asyncio.create_task(writer.run()), message) for writer, message in [
+            (self.pipeline.dispatcher, 'Не отправлено сообщений о выходе за экстремумы'),
+            (self.pipeline.timeseries, 'Не записано в Redis таймфреймов')] if writer is not None]
+        while not stop.is_set():
+            if not self.poll():
+                await asyncio.sleep(POLL_INTERVAL)
+        # сделки, записанные до остановки, дорабатываются
+        while self.poll():
+            pass
+        for writer, task, message in writers:
+            try:
+                await asyncio.wait_for(writer.queue.join(), timeout=5)
+            except asyncio.TimeoutError:
+                logger.warning(f'{message}: {writer.queue.qsize()}')
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self.pipeline.bar_store is not None:
+            self.pipeline.bar_store.flush()
+
+
+def _analytics(shard: int, pairs: dict[str, str], make_pipeline: Callable[[PairRegistry, int], Pipeline],
+               symbols: list[str], ring_names: list[str], capacity: int, tf: float, metrics_interval: float, stop):
+    """
+    процесс расчёта пар pairs
+    """
+    _ignore_sigint()
+    rings = [TradeRing(capacity, name) for name in ring_names]
+    try:
+        pipeline = make_pipeline(PairRegistry(pairs), shard)
+        if pipeline.bar_store is not None:
+            warm_start(pipeline.engine, pipeline.bar_store, end=time.time_ns())
+        asyncio.run(AnalyticsWorker(pipeline, symbols, rings, tf, metrics_interval).run(stop))
+    finally:
+        for ring in rings:
+            ring.close()
+
+
+class ShardedRunner:
+    """
+    запуск и остановка процессов получения сделок и расчёта
+    """
+    def __init__(self, pairs: dict[str, str], make_pipeline: Callable[[PairRegistry, int], Pipeline],
+                 ingest_processes: int = 1, analytics_processes: int = 1, tf: float = 1,
+                 capacity: int = RING_CAPACITY, url: str = BINANCE_FUTURES_URL, metrics_interval: float = 60):
+        """
+        :param pairs: словарь {ведомая валюта: ведущая валюта}
+        :param make_pipeline: функция (реестр пар части, номер части) -> Pipeline, вызывается в процессе расчёта
+        :param ingest_processes: количество процессов получения сделок
+        :param analytics_processes: наибольшее количество процессов расчёта
+        :param tf: размер таймфрейма в секундах
+        :param capacity: размер каждого буфера сделок
+        :param url: адрес сокета Binance
+        :param metrics_interval: период вывода гистограмм задержек процессов расчёта в секундах
+        """
+        self.shards = shard_pairs(pairs, analytics_processes)
+        registries = [PairRegistry(shard) for shard in self.shards]
+        self.symbols = list(dict.fromkeys(symbol for registry in registries for symbol in registry.symbols))
+        # валюты делятся между процессами получения по очереди
+        owners = [self.symbols[i::ingest_processes] for i in range(min(ingest_processes, len(self.symbols)))]
+        self.rings = [[TradeRing(capacity) for _ in self.shards] for _ in owners]
+        self.stop_event = multiprocessing.Event()
+        self.processes = []
+        for i, own in enumerate(owners):
+            routes = {symbol: [self.rings[i][j].name for j, registry in enumerate(registries)
+                               if symbol in registry.index] for symbol in own}
+            self.processes.append(multiprocessing.Process(
+                target=_ingest, name=f'ingest-{i}', args=(self.symbols, own, routes, capacity, url, self.stop_event)))
+        for j, shard in enumerate(self.shards):
+            self.processes.append(multiprocessing.Process(
+                target=_analytics, name=f'analytics-{j}',
+                args=(j, shard, make_pipeline, self.symbols, [rings[j].name for rings in self.rings], capacity, tf,
+                      metrics_interval, self.stop_event)))
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self, timeout: float = 10):
+        """
+        остановка всех процессов и удаление буферов
+        :param timeout: время ожидания завершения процессов, после него процессы завершаются принудительно
+        """
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f'Процесс {process.name} не завершился, принудительная остановка')
+                process.terminate()
+                process.join()
+        for rings in self.rings:
+            for ring in rings:
+                ring.close()
+
+    def run(self):
+        """
+        запуск и ожидание Ctrl+C, SIGTERM или завершения одного из процессов
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self.stop_event.set())
+        self.start()
+        try:
+            while not self.stop_event.is_set() and all(process.is_alive() for process in self.processes):
+                self.stop_event.wait(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
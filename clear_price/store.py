@@ -0,0 +1,213 @@
+"""
+Хранение баров (и, при необходимости, сделок) на диске в файлах NumPy, отображаемых в память.
+Бары каждой валюты за сутки лежат в одном файле root/SYMBOL/YYYY-MM-DD.npy фиксированного размера:
+номер строки - номер таймфрейма от начала суток, поэтому запись и поиск бара не требуют индекса,
+а незаполненные строки имеют время -1. Кроме баров сделок хранится цена, по которой выполнялся расчёт
+(vwap, середина спреда или microprice стакана), - по ней история загружается при перезапуске.
+Другие процессы могут читать те же файлы без копирования: np.load(path, mmap_mode='r')['vwap'].
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from clear_price.backtest import clear_price_series
+from clear_price.bars import Bars
+from clear_price.ingest import Trades
+from clear_price.pairs import PairEngine
+
+DAY_NS = 86_400 * 10 ** 9
+
+BAR_DTYPE = np.dtype([('time', np.int64), ('open', np.float64), ('high', np.float64), ('low', np.float64),
+                      ('close', np.float64), ('volume', np.float64), ('vwap', np.float64), ('price', np.float64),
+                      ('count', np.int64)])
+
+# поля цен и объёмов баров, незаполненные строки - nan
+FLOAT_FIELDS = list(BAR_DTYPE.names[1:-1])
+
+TRADE_DTYPE = np.dtype([('time', np.int64), ('price', np.float64), ('qty', np.float64)])
+
+
+def _day_name(day: int) -> str:
+    return datetime.fromtimestamp(day * 86_400, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _upgrade(records: np.ndarray) -> np.ndarray:
+    """
+    бары файлов, записанных до появления цены расчёта: цена расчёта - vwap
+    """
+    if records.dtype == BAR_DTYPE:
+        return records
+    upgraded = np.empty(len(records), dtype=BAR_DTYPE)
+    for name in records.dtype.names:
+        upgraded[name] = records[name]
+    upgraded['price'] = records['vwap']
+    return upgraded
+
+
+class BarStore:
+    """
+    хранилище баров валют по суткам
+    """
+    def __init__(self, root: str | Path, tf_ns: int):
+        """
+        :param root: каталог хранилища
+        :param tf_ns: размер таймфрейма в наносекундах (должен делить сутки без остатка)
+        """
+        if DAY_NS % tf_ns:
+            raise ValueError(f'Таймфрейм {tf_ns} нс не делит сутки без остатка')
+        self.root = Path(root)
+        self.tf_ns = tf_ns
+        self.rows = DAY_NS // tf_ns  # количество таймфреймов в сутках
+        self._files: dict[tuple[str, int], np.memmap] = {}  # открытые на запись файлы текущих суток
+
+    def path(self, symbol: str, day: int) -> Path:
+        """
+        :param symbol: символ валюты
+        :param day: номер суток от эпохи
+        :return: путь к файлу баров
+        """
+        return self.root / symbol / f'{_day_name(day)}.npy'
+
+    def _open(self, symbol: str, day: int) -> np.memmap:
+        if (file := self._files.get((symbol, day))) is None:
+            # при смене суток файлы прошедших суток закрываются
+            for key in [key for key in self._files if key[1] != day]:
+                self._files.pop(key).flush()
+            path = self.path(symbol, day)
+            if path.exists():
+                file = np.load(path, mmap_mode='r+')
+                if file.dtype != BAR_DTYPE:
+                    records = _upgrade(file)
+                    del file
+                    file = np.lib.format.open_memmap(path, mode='w+', dtype=BAR_DTYPE, shape=(self.rows,))
+                    file[:] = records
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                file = np.lib.format.open_memmap(path, mode='w+', dtype=BAR_DTYPE, shape=(self.rows,))
+                file['time'] = -1
+                file[FLOAT_FIELDS] = (np.nan,) * len(FLOAT_FIELDS)
+            self._files[symbol, day] = file
+        return file
+
+    def append(self, bars: Bars, symbols: list[str], prices: np.ndarray | None = None):
+        """
+        запись баров всех валют за таймфрейм
+        :param bars: бары
+        :param symbols: символы валют в порядке массивов bars
+        :param prices: цены валют, по которым выполнялся расчёт (None - vwap)
+        """
+        prices = bars.vwap if prices is None else prices
+        day, row = divmod(bars.time // self.tf_ns, self.rows)
+        for i, symbol in enumerate(symbols):
+            self._open(symbol, day)[row] = (bars.time, bars.open[i], bars.high[i], bars.low[i], bars.close[i],
+                                            bars.volume[i], bars.vwap[i], prices[i], bars.count[i])
+
+    def flush(self):
+        for file in self._files.values():
+            file.flush()
+
+    def read(self, symbol: str, start: int, end: int) -> np.ndarray:
+        """
+        чтение баров валюты за период; если период не выходит за одни сутки, возвращается view файла без копирования
+        :param symbol: символ валюты
+        :param start: начало периода в наносекундах от эпохи
+        :param end: конец периода (не включительно)
+        :return: бары BAR_DTYPE по одному на таймфрейм периода (незаполненные - со временем -1)
+        """
+        first, last = start // self.tf_ns, -(-end // self.tf_ns)
+        parts = []
+        for day in range(first // self.rows, (last - 1) // self.rows + 1):
+            lo, hi = max(first - day * self.rows, 0), min(last - day * self.rows, self.rows)
+            path = self.path(symbol, day)
+            if path.exists():
+                parts.append(_upgrade(np.load(path, mmap_mode='r')[lo:hi]))
+            else:
+                empty = np.full(hi - lo, -1, dtype=BAR_DTYPE)
+                empty[FLOAT_FIELDS] = (np.nan,) * len(FLOAT_FIELDS)
+                parts.append(empty)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def history(self, symbols: list[str], end: int, count: int, max_days: int = 7) -> tuple[np.ndarray, np.ndarray]:
+        """
+        последние таймфреймы до end, по которым есть цены расчёта всех валют
+        (бары до первой сделки валюты или до загрузки стакана записываются с ценой nan и пропускаются)
+        :param symbols: символы валют
+        :param end: конец периода в наносекундах от эпохи (не включительно)
+        :param count: необходимое количество таймфреймов
+        :param max_days: глубина поиска в сутках
+        :return: время таймфреймов (count,) и цены расчёта (count, валюты), может быть меньше count строк
+        """
+        times, prices = np.empty(0, dtype=np.int64), np.empty((0, len(symbols)))
+        start = end
+        while len(times) < count and end - start < max_days * DAY_NS:
+            # чтение сутками от конца периода
+            start, stop = max(start - DAY_NS, end - max_days * DAY_NS), start
+            bars = [self.read(symbol, start, stop) for symbol in symbols]
+            complete = np.logical_and.reduce([(part['time'] >= 0) & np.isfinite(part['price']) for part in bars])
+            times = np.concatenate([bars[0]['time'][complete], times])
+            prices = np.concatenate([np.column_stack([part['price'][complete] for part in bars]), prices])
+        return times[-count:], prices[-count:]
+
+
+class TradeStore:
+    """
+    хранилище сделок: сделки валюты за сутки дописываются в конец файла root/SYMBOL/YYYY-MM-DD.trades
+    (массив TRADE_DTYPE без заголовка, читается через np.memmap)
+    """
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+
+    def path(self, symbol: str, day: int) -> Path:
+        return self.root / symbol / f'{_day_name(day)}.trades'
+
+    def append(self, trades: dict[str, Trades]):
+        """
+        :param trades: словарь {символ валюты: сделки}
+        """
+        for symbol, columns in trades.items():
+            records = np.empty(len(columns.time), dtype=TRADE_DTYPE)
+            records['time'], records['price'], records['qty'] = columns.time, columns.price, columns.qty
+            days = columns.time // DAY_NS
+            for day in np.unique(days):
+                path = self.path(symbol, int(day))
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(path, 'ab') as file:
+                    file.write(records[days == day].tobytes())
+
+    def read(self, symbol: str, day: int) -> np.ndarray:
+        """
+        :return: сделки валюты за сутки (отображение файла в память без копирования)
+        """
+        path = self.path(symbol, day)
+        if not path.exists() or not path.stat().st_size:
+            return np.empty(0, dtype=TRADE_DTYPE)
+        return np.memmap(path, dtype=TRADE_DTYPE, mode='r')
+
+
+def warm_start(engine: PairEngine, store: BarStore, end: int) -> int:
+    """
+    Заполнение истории расчёта сохранёнными барами. Для корректных статистик и экстремумов
+    первых таймфреймов читается двойная длина истории и max_lag таймфреймов запаздывания
+    (но не меньше самого длинного горизонта), скорректированные цены пересчитываются векторно
+    (при учёте запаздывания - с запаздыванием, оценённым по загруженной истории)
+    :param engine: расчёт скорректированных цен
+    :param store: хранилище баров
+    :param end: время, до которого брать бары (наносекунды от эпохи)
+    :return: количество загруженных таймфреймов
+    """
+    registry = engine.registry
+    times, prices = store.history(registry.symbols, end,
+                                  max(2 * engine.window + engine.max_lag, engine.prices.max_len))
+    if not len(times):
+        return 0
+    leaders = prices[:, registry.leader_idx]
+    if engine.max_lag:
+        # запаздывание оценивается по загруженной истории (как после перезапуска оценил бы расчёт),
+        # скорректированные цены считаются по ценам ведущих валют с этим запаздыванием
+        engine.load(times, prices, np.full((len(times), len(registry)), np.nan))
+        rows = np.maximum(np.arange(len(times))[:, None] - engine.lags, 0)
+        leaders = leaders[rows, np.arange(len(registry))]
+    clear = clear_price_series(prices[:, registry.follower_idx], leaders, engine.window)
+    engine.load(times, prices, clear)
+    return engine.time.len
@@ -0,0 +1,1119 @@
+import asyncio
+import http.server
+import io
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+import websockets
+
+from clear_price import ingest
+from clear_price.alerts import Alert, AlertDispatcher, JsonlSink, StdoutSink
+from clear_price.bench import compare, run_benchmarks, synthetic_trades
+from clear_price.backtest import backtest, rolling_max, rolling_sum, sweep
+from clear_price.bars import BarAggregator, Bars
+from clear_price.book import BookStream, OrderBook, OrderBooks
+from clear_price.replay import merge_by_time, read_trades, replay
+from clear_price.dashboard import Dashboard, SharedSnapshots, SnapshotPublisher, decimate
+from clear_price.factors import MultiFactorEngine, RecursiveLeastSquares
+from clear_price.correlation import RollingCorrelation, get_clear_price, lagged_correlation, pearsons_correlation
+from clear_price.metrics import LatencyHistogram, LatencyMetrics
+from clear_price.pairs import PairEngine, PairRegistry, RollingExtrema, extremum_deviation
+from clear_price.pipeline import Pipeline
+from clear_price.prices import Prices, RingBuffer
+from clear_price.sharding import TRADE_RECORD, AnalyticsWorker, TradeRing, from_records, shard_pairs, to_records
+from clear_price.store import BAR_DTYPE, BarStore, TradeStore, warm_start
+from clear_price import timeseries
+from clear_price.timeseries import TimeSeriesPublisher, bar_samples, series_labels
+
+# записанные сообщения потоков btcusdt@aggTrade и ethusdt@aggTrade
+AGG_TRADE_FRAMES = Path(__file__).parent / 'test_data' / 'aggTrade.jsonl'
+
+
+def random_walks(n: int, seed: int = 0):
+    """
+    коррелированные случайные блуждания цен влияющей (btc) и основной (eth) валют
+    """
+    rng = np.random.default_rng(seed)
+    btc_steps = rng.normal(0, 10, n)
+    eth_steps = 0.05 * btc_steps + rng.normal(0, 0.5, n)
+    return 1800 + np.cumsum(eth_steps), 30000 + np.cumsum(btc_steps)
+
+
+class TestPrices:
+
+    def test_ring_buffer_view(self):
+        buffer = RingBuffer(max_len=3)
+        assert buffer.append(1.0) is None
+        buffer.append(2.0)
+        buffer.append(3.0)
+        assert buffer.append(4.0) == 1.0
+        assert buffer.view().tolist() == [2.0, 3.0, 4.0]
+        # view ссылается на внутренний массив, а не на копию
+        assert np.shares_memory(buffer.view(), buffer._data)
+
+    def test_min_max_sliding_window(self):
+        rng = np.random.default_rng(1)
+        prices = Prices(symbol='TEST', max_len=50)
+        assert prices.min == prices.max == 0
+        history = []
+        for i, price in enumerate(rng.normal(100, 5, 500)):
+            prices.append(float(price), i)
+            history = (history + [float(price)])[-50:]
+            assert prices.min == min(history)
+            assert prices.max == max(history)
+        assert prices.prices.tolist() == history
+        assert prices.time_ns.tolist() == list(range(450, 500))
+        assert prices.len == 50
+
+
+class TestRollingCorrelation:
+
+    def test_matches_batch(self):
+        window = 300
+        eth, btc = random_walks(2000)
+        stats = RollingCorrelation(window=window, resync_every=700)
+        for i in range(len(eth)):
+            eth_out = eth[i - window] if i >= window else None
+            btc_out = btc[i - window] if i >= window else None
+            stats.update(eth[i], btc[i], eth_out, btc_out)
+            if stats.stale:
+                stats.resync(eth[i + 1 - window:i + 1], btc[i + 1 - window:i + 1])
+            if i < 2:
+                continue
+            eth_window, btc_window = eth[max(0, i + 1 - window):i + 1], btc[max(0, i + 1 - window):i + 1]
+            assert np.isclose(stats.correlation, pearsons_correlation(eth_window, btc_window, False), rtol=1e-9)
+            assert np.isclose(stats.std_x, np.std(eth_window), rtol=1e-9)
+            assert np.isclose(stats.clear_price(eth[i], btc[i]), get_clear_price(eth_window, btc_window), rtol=1e-12)
+
+    def test_vectorized_pairs(self):
+        eth, btc = random_walks(100)
+        stats = RollingCorrelation(window=100)
+        for x, y in zip(eth, btc):
+            stats.update(np.array([x, x]), np.array([y, 5.0]))
+        # корреляция с постоянным рядом не определена
+        assert np.isclose(stats.correlation[0], np.corrcoef(eth, btc)[0, 1])
+        assert np.isnan(stats.correlation[1])
+        assert np.isnan(stats.clear_price(np.array([1.0, 1.0]), np.array([1.0, 5.0]))[1])
+
+
+class TestPairEngine:
+
+    def test_registry(self):
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT', 'SOLUSDT': 'ETHUSDT', 'XRPUSDT': 'BTCUSDT'})
+        assert registry.symbols == ['BTCUSDT', 'ETHUSDT', 'SOLUSDT', 'XRPUSDT']
+        assert registry.follower_idx.tolist() == [1, 2, 3]
+        assert registry.leader_idx.tolist() == [0, 1, 0]
+        assert registry.leader_of('SOLUSDT') == 'ETHUSDT'
+        assert registry.streams[0] == 'btcusdt@aggTrade'
+
+    def test_rolling_extrema(self):
+        rng = np.random.default_rng(2)
+        values = rng.normal(0, 1, (300, 3))
+        values[5:15, 1] = np.nan
+        extrema = RollingExtrema(window=17, shape=(3,))
+        for i, row in enumerate(values):
+            extrema.append(row)
+            window = values[max(0, i - 16):i + 1]
+            assert np.array_equal(extrema.max, np.nanmax(window, axis=0), equal_nan=True)
+            assert np.array_equal(extrema.min, np.nanmin(window, axis=0), equal_nan=True)
+
+    def test_extremum_deviation(self):
+        deviation = extremum_deviation(np.array([103.0, 95.0, 100.5, 50.0]), np.array([100.0, 100.0, 100.0, np.nan]),
+                                       np.array([98.0, 98.0, 98.0, np.nan]), 1)
+        assert np.isclose(deviation[0], 3)
+        assert np.isclose(deviation[1], -300 / 98)
+        assert deviation[2] == deviation[3] == 0
+
+    def test_matches_single_pair(self):
+        window = 200
+        eth, btc = random_walks(1000)
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT', 'BTCUSDT(COPY)': 'BTCUSDT'})
+        engine = PairEngine(registry, window=window)
+        for i in range(len(eth)):
+            clear, _ = engine.on_bar(np.array([btc[i], eth[i], btc[i]]), i, 1)
+            if i >= 2:
+                eth_window, btc_window = eth[max(0, i + 1 - window):i + 1], btc[max(0, i + 1 - window):i + 1]
+                assert np.isclose(clear[0], get_clear_price(eth_window, btc_window), rtol=1e-12)
+                # ряд, полностью совпадающий с ведущим, после корректировки становится постоянным
+                assert np.isclose(clear[1], btc_window.mean())
+        assert np.array_equal(engine.series('ETHUSDT'), eth[-window:])
+        assert np.nanmax(engine.clear_series('ETHUSDT')) == engine.extrema.max[0]
+
+
+    def test_horizons_match_separate_engines(self):
+        eth, btc = random_walks(400, seed=11)
+        sol, _ = random_walks(400, seed=12)
+        eth[250:] += 30
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT', 'SOLUSDT': 'BTCUSDT'})
+        horizons = (1, 20, 75, 200)
+        engine = PairEngine(registry, window=50, horizons=horizons)
+        separate = [PairEngine(registry, window=horizon) for horizon in horizons]
+        primary = PairEngine(registry, window=50)
+        # 200 значений - больше основного окна, история общая
+        assert engine.prices.max_len == 200
+        for i in range(400):
+            prices = np.array([btc[i], eth[i], sol[i]])
+            engine.on_bar(prices, i, 0.5)
+            expected = [other.on_bar(prices, i, 0.5) for other in separate]
+            primary.on_bar(prices, i, 0.5)
+            assert np.allclose(engine.horizon_clear, [e[0] for e in expected], rtol=1e-10, equal_nan=True)
+            assert np.array_equal(engine.horizon_deviation != 0, [e[1] != 0 for e in expected])
+        # основное окно считается так же, как без горизонтов
+        assert len(engine.series('ETHUSDT')) == 50
+        assert np.allclose(engine.clear_series('ETHUSDT'), primary.clear_series('ETHUSDT'), rtol=1e-10)
+
+    @pytest.mark.parametrize('max_lag', [0, 3])
+    def test_missing_prices_block_only_their_pairs(self, max_lag):
+        eth, btc = random_walks(600, seed=17)
+        sol, _ = random_walks(600, seed=18)
+        # SOLUSDT без сделок первые 200 таймфреймов
+        sol[:200] = np.nan
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT', 'SOLUSDT': 'BTCUSDT'})
+        engine = PairEngine(registry, window=60, horizons=(30,), max_lag=max_lag, lag_every=1000)
+        eth_only = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT'}), window=60, horizons=(30,), max_lag=max_lag,
+                              lag_every=1000)
+        sol_late = PairEngine(PairRegistry({'SOLUSDT': 'BTCUSDT'}), window=60, horizons=(30,), max_lag=max_lag,
+                              lag_every=1000)
+        for i in range(600):
+            clear, _ = engine.on_bar(np.array([btc[i], eth[i], sol[i]]), i, 1)
+            expected, _ = eth_only.on_bar(np.array([btc[i], eth[i]]), i, 1)
+            assert np.allclose(clear[0], expected, rtol=1e-10, equal_nan=True)
+            if i >= 200 - max_lag:
+                late, _ = sol_late.on_bar(np.array([btc[i], sol[i]]), i, 1)
+            # после выхода таймфреймов без цены из окна пара считается так же, как начатая с первой сделки
+            if i < 200:
+                assert np.isnan(clear[1])
+            elif i >= 260 + max_lag:
+                assert np.allclose(clear[1], late, rtol=1e-9)
+            if i >= 230:
+                assert np.allclose(engine.horizon_clear[0, 1], sol_late.horizon_clear[0, 0], rtol=1e-9)
+
+    def test_exponential_horizons(self):
+        eth, btc = random_walks(300, seed=13)
+        engine = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT'}), window=50, horizons=(10, 100), ew=True)
+        for i in range(300):
+            engine.on_bar(np.array([btc[i], eth[i]]), i, 1)
+        # экспоненциально взвешенные статистики, посчитанные напрямую по весам
+        for k, horizon in enumerate((10, 100)):
+            a = 2 / (horizon + 1)
+            weights = a * (1 - a) ** np.arange(299)[::-1]
+            weights = np.r_[(1 - a) ** 299, weights]
+            mean_x, mean_y = weights @ eth, weights @ btc
+            # веса дисперсии со сдвигом на один шаг относительно весов среднего
+            var_y = (1 - a) * (weights[1:] @ (btc[1:] - mean_y) ** 2 + weights[0] * (btc[0] - mean_y) ** 2)
+            cov = (1 - a) * (weights[1:] @ ((eth[1:] - mean_x) * (btc[1:] - mean_y))
+                             + weights[0] * (eth[0] - mean_x) * (btc[0] - mean_y))
+            assert np.isclose(engine.horizon_clear[k, 0], eth[-1] - (btc[-1] - mean_y) * cov / var_y, rtol=1e-6)
+
+
+class TestMultiFactor:
+
+    def test_recursive_least_squares(self):
+        rng = np.random.default_rng(14)
+        x = rng.normal(0, 1, (2, 300, 3))
+        y = np.stack([x[0] @ [1, -2, 0.5], x[1] @ [0.3, 0, 4]]) + rng.normal(0, 0.1, (2, 300))
+        rls = RecursiveLeastSquares(2, 3, forgetting=0.98, delta=10)
+        for t in range(300):
+            rls.update(x[:, t], y[:, t])
+        # совпадает с взвешенным МНК с регуляризацией начальной матрицей
+        weights = 0.98 ** np.arange(299, -1, -1)
+        for r in range(2):
+            a = (x[r] * weights[:, None]).T @ x[r] + 0.98 ** 300 / 10 * np.eye(3)
+            assert np.allclose(rls.beta[r], np.linalg.solve(a, (x[r] * weights[:, None]).T @ y[r]))
+
+    def test_long_run_with_unequal_factors(self):
+        # как DOGEUSDT с одним фактором рядом с ETHUSDT с двумя: второй фактор регрессии не используется
+        rng = np.random.default_rng(16)
+        mask = np.array([[1, 1], [1, 0]])
+        rls = RecursiveLeastSquares(2, 2, forgetting=0.999, mask=mask)
+        n = 1_000_100
+        with np.errstate(all='raise'):
+            for start in range(0, n, 100_000):
+                x = rng.normal(0, 1, (min(100_000, n - start), 2, 2)) * mask
+                y = x @ [1.0, -2.0] + rng.normal(0, 0.1, x.shape[:2])
+                for t in range(len(x)):
+                    rls.update(x[t], y[t])
+        assert np.isfinite(rls.p).all()
+        assert np.allclose(rls.beta, [[1, -2], [1, 0]], atol=0.05)
+        # неиспользуемый фактор не забывается, используемые - не накапливают неопределённость
+        assert rls.p[1, 1, 1] == rls.delta and np.trace(rls.p[0]) < 0.01
+        # при сильном забывании то же переполнение наступало бы через ~7 тысяч таймфреймов
+        engine = MultiFactorEngine(['BTCUSDT', 'SOLUSDT', 'ETHUSDT', 'DOGEUSDT'],
+                                   {'ETHUSDT': ['BTCUSDT', 'SOLUSDT'], 'DOGEUSDT': ['BTCUSDT']}, window=100,
+                                   forgetting=0.9)
+        prices = 100 + np.cumsum(rng.normal(0, 1, (10_000, 4)), axis=0)
+        with np.errstate(all='raise'):
+            for i, bar in enumerate(prices):
+                clear, _ = engine.on_bar(bar, i, 1)
+        assert np.isfinite(clear).all()
+
+    def test_missing_prices(self):
+        eth, btc = random_walks(300, seed=19)
+        symbols = ['BTCUSDT', 'ETHUSDT', 'XRPUSDT']
+        # у XRPUSDT не было сделок: её корректировка невозможна, корректировка ETHUSDT не меняется
+        engine = MultiFactorEngine(symbols, {'ETHUSDT': ['BTCUSDT'], 'XRPUSDT': ['BTCUSDT']}, window=50)
+        eth_only = MultiFactorEngine(symbols, {'ETHUSDT': ['BTCUSDT']}, window=50)
+        with np.errstate(all='raise'):
+            for i in range(300):
+                prices = np.array([btc[i], eth[i], np.nan])
+                clear, _ = engine.on_bar(prices, i, 1)
+                expected, _ = eth_only.on_bar(prices, i, 1)
+                assert np.isnan(clear[1])
+                assert np.allclose(clear[0], expected[0], equal_nan=True)
+        assert np.isfinite(clear[0])
+        # в Pipeline пары без сделок одной из валют не останавливают расчёт остальных
+        pipeline = Pipeline(PairRegistry({'ETHUSDT': 'BTCUSDT', 'XRPUSDT': 'BTCUSDT'}), history=20)
+        for batch in synthetic_trades(['BTCUSDT', 'ETHUSDT'], seconds=30, rate=50, seed=7):
+            pipeline.handle_trades(batch)
+        assert np.isfinite(pipeline.engine.clear_series('ETHUSDT')[-1])
+        assert np.isnan(pipeline.engine.clear_series('XRPUSDT')).all()
+
+    def test_engine(self):
+        rng = np.random.default_rng(15)
+        n = 5000
+        btc = 30000 + np.cumsum(rng.normal(0, 10, n))
+        sol = 100 + np.cumsum(rng.normal(0, 0.3, n))
+        eth = 1800 + 0.05 * (btc - 30000) + 2 * (sol - 100) + rng.normal(0, 0.2, n)
+        doge = 0.1 + 1e-6 * (btc - 30000) + rng.normal(0, 1e-4, n)
+        # у ведомых валют разное количество факторов
+        engine = MultiFactorEngine(['BTCUSDT', 'SOLUSDT', 'ETHUSDT', 'DOGEUSDT'],
+                                   {'ETHUSDT': ['BTCUSDT', 'SOLUSDT'], 'DOGEUSDT': ['BTCUSDT']}, window=100)
+        clear = np.array([engine.on_bar(np.array([btc[i], sol[i], eth[i], doge[i]]), i, 1)[0] for i in range(n)])
+        assert np.isnan(clear[:2]).all()
+        assert np.allclose(engine.betas, [[0.05, 2], [1e-6, 0]], rtol=0.05, atol=1e-9)
+        # после корректировки в изменениях цены остаётся в основном собственный шум валюты
+        assert np.std(np.diff(clear[1000:, 0])) < 0.4 < 0.7 < np.std(np.diff(eth[1000:]))
+        assert engine.clear_series('DOGEUSDT').shape == (100,)
+        with pytest.raises(ValueError):
+            MultiFactorEngine(['BTCUSDT'], {'ETHUSDT': ['BTCUSDT']}, window=10)
+
+
+class TestIngest:
+
+    frames = AGG_TRADE_FRAMES.read_text().splitlines()
+
+    def test_parse_trades(self, monkeypatch):
+        trades = ingest.parse_trades(self.frames)
+        data = [json.loads(frame)['data'] for frame in self.frames]
+        eth = [item for item in data if item['s'] == 'ETHUSDT']
+        assert sorted(trades) == ['BTCUSDT', 'ETHUSDT']
+        assert trades['ETHUSDT'].price.tolist() == [float(item['p']) for item in eth]
+        assert trades['ETHUSDT'].qty.tolist() == [float(item['q']) for item in eth]
+        assert trades['ETHUSDT'].time.tolist() == [item['T'] * 1_000_000 for item in eth]
+        # разбор без orjson даёт тот же результат
+        monkeypatch.setattr(ingest, 'orjson', None)
+        fallback = ingest.parse_trades(self.frames)
+        for symbol in trades:
+            for column, fallback_column in zip(trades[symbol], fallback[symbol]):
+                assert np.array_equal(column, fallback_column)
+        # сообщения, записанные json.dumps (с пробелами), регулярное выражение не находит - разбор json
+        spaced = ingest.parse_trades([json.dumps(json.loads(frame)) for frame in self.frames])
+        for symbol in trades:
+            for column, spaced_column in zip(trades[symbol], spaced[symbol]):
+                assert np.array_equal(column, spaced_column)
+        assert ingest.parse_trades([]) == {}
+
+    def test_stream_from_local_server(self):
+        async def replay(ws):
+            for frame in self.frames:
+                await ws.send(frame)
+            await ws.wait_closed()
+
+        async def receive_all():
+            received = {}
+            done = asyncio.Event()
+
+            def handler(trades):
+                for symbol, columns in trades.items():
+                    received.setdefault(symbol, []).extend(columns.price.tolist())
+                if sum(map(len, received.values())) == len(self.frames):
+                    done.set()
+
+            async with websockets.serve(replay, '127.0.0.1', 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                stream = ingest.TradeStream(['btcusdt@aggTrade', 'ethusdt@aggTrade'], url=f'ws://127.0.0.1:{port}/stream')
+                task = asyncio.create_task(stream.run(handler))
+                await asyncio.wait_for(done.wait(), 5)
+                task.cancel()
+            return received
+
+        received = asyncio.run(receive_all())
+        assert received['BTCUSDT'] == ingest.parse_trades(self.frames)['BTCUSDT'].price.tolist()
+
+    def test_stream_receiver_error(self):
+        # ошибка получения сообщений не скрывается за вызовами on_idle
+        idle = []
+        stream = ingest.TradeStream(['btcusdt@aggTrade'], url='http://127.0.0.1/stream')
+        with pytest.raises(websockets.InvalidURI):
+            asyncio.run(asyncio.wait_for(stream.run(print, idle=0.01, on_idle=lambda: idle.append(1)), 5))
+        assert len(idle) <= 1
+
+
+class TestBarAggregator:
+
+    def test_matches_grouped_trades(self):
+        trades = ingest.parse_trades(AGG_TRADE_FRAMES.read_text().splitlines())
+        aggregator = BarAggregator(['BTCUSDT', 'ETHUSDT', 'XRPUSDT'], tf_ns=1_000_000_000)
+        # сделки поступают несколькими пачками
+        bars = []
+        for part in range(3):
+            bars += aggregator.add({symbol: ingest.Trades(*(column[part::3] for column in columns))
+                                    for symbol, columns in trades.items()})
+        # пачки пересекаются по времени, поэтому без допустимого опоздания часть сделок отброшена
+        assert aggregator.late > 0
+
+        aggregator = BarAggregator(['BTCUSDT', 'ETHUSDT', 'XRPUSDT'], tf_ns=1_000_000_000, lateness_ns=10 ** 10)
+        bars = []
+        for part in range(3):
+            bars += aggregator.add({symbol: ingest.Trades(*(column[part::3] for column in columns))
+                                    for symbol, columns in trades.items()})
+        bars += aggregator.advance(int(trades['BTCUSDT'].time.max()) + 10 ** 10)
+        assert aggregator.late == 0
+        assert [b.time for b in bars] == list(range(bars[0].time, bars[-1].time + 1, 1_000_000_000))
+        for i, symbol in enumerate(['BTCUSDT', 'ETHUSDT']):
+            columns = trades[symbol]
+            for b in bars:
+                in_bar = (columns.time >= b.time) & (columns.time < b.time + 1_000_000_000)
+                if not in_bar.any():
+                    assert b.count[i] == 0 and b.open[i] == b.close[i] == b.vwap[i]
+                    continue
+                price, qty = columns.price[in_bar], columns.qty[in_bar]
+                assert (b.open[i], b.close[i]) == (price[0], price[-1])
+                assert (b.high[i], b.low[i]) == (price.max(), price.min())
+                assert np.isclose(b.volume[i], qty.sum())
+                assert np.isclose(b.vwap[i], (price * qty).sum() / qty.sum())
+                assert b.count[i] == in_bar.sum()
+        # по валюте без сделок бары не определены
+        assert all(np.isnan(b.close[2]) for b in bars)
+
+    def test_lateness(self):
+        second = 1_000_000_000
+        aggregator = BarAggregator(['A'], tf_ns=second, lateness_ns=second // 2)
+
+        def trade(price, ticktime):
+            return {'A': ingest.Trades(np.array([price]), np.array([1.0]), np.array([ticktime]))}
+
+        assert aggregator.add(trade(10.0, 100 * second)) == []
+        # сделка в следующем таймфрейме, но раньше допустимого опоздания - таймфрейм ещё открыт
+        assert aggregator.add(trade(11.0, 101 * second + second // 4)) == []
+        assert aggregator.add(trade(12.0, 100 * second + 1)) == []
+        bars = aggregator.add(trade(13.0, 103 * second))
+        assert [b.time for b in bars] == [100 * second, 101 * second]
+        assert bars[0].vwap[0] == bars[1].vwap[0] == 11.0 and bars[0].count[0] == 2
+        # сделка закрытого таймфрейма отбрасывается
+        assert aggregator.add(trade(9.0, 101 * second)) == [] and aggregator.late == 1
+
+
+class TestReplay:
+
+    @staticmethod
+    def write_dumps(path: Path, seconds: int = 600):
+        """
+        выгрузки aggTrades BTCUSDT (CSV фьючерсов с заголовком) и ETHUSDT (JSONL сообщений потока)
+        """
+        rng = np.random.default_rng(3)
+        eth, btc = random_walks(seconds * 4)
+        start = 1696118400000
+        btc_time = start + np.sort(rng.integers(0, seconds * 1000, len(btc)))
+        eth_time = start + np.sort(rng.integers(0, seconds * 1000, len(eth)))
+        with open(path / 'BTCUSDT-aggTrades-2023-10-01.csv', 'w') as file:
+            file.write('agg_trade_id,price,quantity,first_trade_id,last_trade_id,transact_time,is_buyer_maker\n')
+            for i, (price, ticktime) in enumerate(zip(btc, btc_time)):
+                file.write(f'{i},{price:.1f},0.01,{i},{i},{ticktime},true\n')
+        with open(path / 'eth.jsonl', 'w') as file:
+            for i, (price, ticktime) in enumerate(zip(eth, eth_time)):
+                data = {'e': 'aggTrade', 'E': int(ticktime) + 5, 'a': i, 's': 'ETHUSDT', 'p': f'{price:.2f}',
+                        'q': '0.500', 'f': i, 'l': i, 'T': int(ticktime), 'm': False}
+                file.write(json.dumps({'stream': 'ethusdt@aggTrade', 'data': data}) + '\n')
+        return len(btc) + len(eth)
+
+    def test_replay_files(self, tmp_path):
+        total = self.write_dumps(tmp_path)
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT'})
+        sources = [read_trades(tmp_path / 'BTCUSDT-aggTrades-2023-10-01.csv'), read_trades(tmp_path / 'eth.jsonl')]
+        report = replay(merge_by_time(sources), registry, history=120, percent=0.01)
+        assert report.trades == total
+        assert report.late == 0
+        assert 595 <= report.bars <= 600
+        assert report.trades_per_second > 0
+        assert all(follower == 'ETHUSDT' for _, follower, _ in report.alerts)
+        # чтение частями не меняет результат
+        sources = [read_trades(tmp_path / 'BTCUSDT-aggTrades-2023-10-01.csv', chunk_size=100),
+                   read_trades(tmp_path / 'eth.jsonl', chunk_size=100)]
+        assert replay(merge_by_time(sources), registry, history=120, percent=0.01).alerts == report.alerts
+
+    def test_replay_closes_last_bar(self):
+        # опоздание не кратно таймфрейму - после последней сделки открытыми остаются два таймфрейма
+        batches = [{'BTCUSDT': ingest.Trades(np.array([100.0]), np.ones(1), np.array([100 * 10 ** 9]))},
+                   {'BTCUSDT': ingest.Trades(np.array([101.0]), np.ones(1), np.array([101_400_000_000]))}]
+        report = replay(batches, PairRegistry({'BTCUSDT': 'BTCUSDT'}), lateness=0.5)
+        assert report.trades == 2 and report.bars == 2
+
+    def test_pacing(self, tmp_path):
+        self.write_dumps(tmp_path, seconds=10)
+        report = replay(read_trades(tmp_path / 'BTCUSDT-aggTrades-2023-10-01.csv'),
+                        PairRegistry({'BTCUSDT': 'BTCUSDT'}), speed=50)
+        # последний таймфрейм начинается не раньше чем через 8 секунд после первой сделки
+        assert 8 / 50 <= report.elapsed < 1
+
+
+class TestBacktest:
+
+    def test_rolling_windows(self):
+        x = np.random.default_rng(4).normal(0, 1, 103)
+        expected_sum = [x[max(0, i - 9):i + 1].sum() for i in range(len(x))]
+        expected_max = [x[max(0, i - 9):i + 1].max() for i in range(len(x))]
+        assert np.allclose(rolling_sum(x, 10), expected_sum)
+        assert np.array_equal(rolling_max(x, 10), expected_max)
+
+    def test_matches_engine(self):
+        window = 50
+        eth, btc = random_walks(3000, seed=5)
+        sol, _ = random_walks(3000, seed=6)
+        # резкие движения, чтобы были выходы за экстремумы
+        eth[1000:] += 40
+        sol[2000:] -= 30
+        engine = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT', 'SOLUSDT': 'BTCUSDT'}), window=window)
+        clear, deviation = zip(*(engine.on_bar(np.array([b, e, s]), i, 0.5) for i, (b, e, s) in enumerate(zip(btc, eth, sol))))
+        clear, deviation = np.array(clear), np.array(deviation)
+
+        result = backtest(np.column_stack([eth, sol]), np.column_stack([btc, btc]), window, 0.5, chunk_blocks=7)
+        assert np.allclose(result.clear, clear, rtol=1e-10, equal_nan=True)
+        assert np.array_equal(np.isnan(result.clear), np.isnan(clear))
+        assert len(result.events) > 0
+        assert np.array_equal(result.events, np.argwhere(deviation))
+        assert np.allclose(result.deviation, deviation)
+        # одна пара считается так же, как столбец нескольких
+        assert np.array_equal(backtest(eth, btc, window, 0.5).events[:, 0], result.events[result.events[:, 1] == 0, 0])
+
+    def test_sweep(self):
+        eth, btc = random_walks(2000, seed=5)
+        eth[1000:] += 40
+        result = sweep(eth, btc, [50, 100], [0.5, 5])
+        assert result[50, 0.5] == len(backtest(eth, btc, 50, 0.5).events)
+        assert result[50, 5] <= result[50, 0.5]
+
+
+class TestStore:
+    # 2023-10-01 23:59:00 UTC - бары переходят через границу суток
+    START = 1696204740 * 10 ** 9
+
+    @staticmethod
+    def bars(ticktime, prices):
+        prices = np.asarray(prices, dtype=np.float64)
+        return Bars(ticktime, prices, prices, prices, prices, np.ones(len(prices)), prices, np.ones(len(prices), dtype=np.int64))
+
+    def test_round_trip(self, tmp_path):
+        store = BarStore(tmp_path, tf_ns=10 ** 9)
+        for i in range(120):
+            if i != 30:  # пропущенный таймфрейм
+                store.append(self.bars(self.START + i * 10 ** 9, [100 + i, 200 + i]), ['BTCUSDT', 'ETHUSDT'])
+        store.flush()
+        assert sorted(path.name for path in (tmp_path / 'BTCUSDT').iterdir()) == ['2023-10-01.npy', '2023-10-02.npy']
+        # чтение в пределах суток - отображение файла без копирования
+        day = store.read('ETHUSDT', self.START + 60 * 10 ** 9, self.START + 70 * 10 ** 9)
+        assert isinstance(day, np.memmap)
+        assert day['vwap'].tolist() == list(range(260, 270))
+        times, prices = store.history(['BTCUSDT', 'ETHUSDT'], self.START + 120 * 10 ** 9, 100)
+        assert len(times) == 100 and times[-1] == self.START + 119 * 10 ** 9
+        assert self.START + 30 * 10 ** 9 not in times
+        assert np.array_equal(prices[:, 1] - prices[:, 0], np.full(100, 100))
+
+        trades = TradeStore(tmp_path)
+        ticktime = self.START + np.array([0, 10 ** 9, 70 * 10 ** 9])
+        trades.append({'BTCUSDT': ingest.Trades(np.array([1.0, 2.0, 3.0]), np.ones(3), ticktime)})
+        assert trades.read('BTCUSDT', self.START // (86_400 * 10 ** 9))['price'].tolist() == [1.0, 2.0]
+
+    def test_files_without_price(self, tmp_path):
+        # файлы, записанные до появления цены расчёта: цена расчёта - vwap, запись дополняет файл
+        old = np.dtype([(name, BAR_DTYPE[name]) for name in BAR_DTYPE.names if name != 'price'])
+        store = BarStore(tmp_path, tf_ns=10 ** 9)
+        for symbol, price in (('BTCUSDT', 100.0), ('ETHUSDT', 200.0)):
+            path = store.path(symbol, self.START // (86_400 * 10 ** 9))
+            path.parent.mkdir(parents=True)
+            file = np.lib.format.open_memmap(path, mode='w+', dtype=old, shape=(store.rows,))
+            file['time'] = -1
+            file[(self.START // 10 ** 9 - 59) % store.rows] = (self.START - 59 * 10 ** 9, price, price, price, price, 1, price, 1)
+            del file
+        assert store.read('BTCUSDT', self.START - 59 * 10 ** 9, self.START)['price'][0] == 100
+        store.append(self.bars(self.START, [101, 201]), ['BTCUSDT', 'ETHUSDT'], np.array([102.0, 202.0]))
+        times, prices = store.history(['BTCUSDT', 'ETHUSDT'], self.START + 10 ** 9, 10)
+        assert times.tolist() == [self.START - 59 * 10 ** 9, self.START]
+        assert prices.tolist() == [[100, 200], [102, 202]]
+
+    def test_warm_start_continues_history(self, tmp_path):
+        window = 50
+        eth, btc = random_walks(300, seed=7)
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT'})
+        continuous = PairEngine(registry, window=window)
+        store = BarStore(tmp_path, tf_ns=10 ** 9)
+        for i in range(200):
+            prices = np.array([btc[i], eth[i]])
+            continuous.on_bar(prices, self.START + i * 10 ** 9, 1)
+            store.append(self.bars(self.START + i * 10 ** 9, prices), registry.symbols)
+
+        # после перезапуска расчёт продолжается так же, как без перезапуска
+        restarted = PairEngine(registry, window=window)
+        assert warm_start(restarted, store, end=self.START + 200 * 10 ** 9) == window
+        for i in range(200, 300):
+            prices = np.array([btc[i], eth[i]])
+            expected, expected_deviation = continuous.on_bar(prices, self.START + i * 10 ** 9, 1)
+            clear, deviation = restarted.on_bar(prices, self.START + i * 10 ** 9, 1)
+            assert np.allclose(clear, expected, rtol=1e-10)
+            assert np.array_equal(deviation, expected_deviation)
+
+
+    def test_warm_start_skips_bars_without_trades(self, tmp_path):
+        eth, btc = random_walks(300, seed=9)
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT'})
+        store = BarStore(tmp_path, tf_ns=10 ** 9)
+        for i in range(200):
+            # первые таймфреймы - до первой сделки ETHUSDT
+            prices = np.array([btc[i], eth[i] if i >= 3 else np.nan])
+            store.append(self.bars(self.START + i * 10 ** 9, prices), registry.symbols)
+        times, prices = store.history(registry.symbols, self.START + 200 * 10 ** 9, 300)
+        assert len(times) == 197 and np.isfinite(prices).all()
+        engine = PairEngine(registry, window=50)
+        warm_start(engine, store, end=self.START + 200 * 10 ** 9)
+        clear, _ = engine.on_bar(np.array([btc[200], eth[200]]), self.START + 200 * 10 ** 9, 1)
+        assert np.isfinite(clear).all()
+
+
+class TestDashboard:
+
+    def publisher(self, n=300):
+        eth, btc = random_walks(n, seed=8)
+        engine = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT'}), window=200)
+        publisher = SnapshotPublisher(engine, 'ETHUSDT', every=2)
+        for i in range(n):
+            engine.on_bar(np.array([btc[i], eth[i]]), i * 10 ** 9, 1)
+            publisher.on_bar()
+        return publisher, eth, btc
+
+    def test_snapshots(self):
+        publisher, eth, btc = self.publisher()
+        snapshot = publisher.latest
+        assert snapshot.version == 150
+        # снимок - копия истории, не меняющаяся при обработке следующих таймфреймов
+        assert not np.shares_memory(snapshot.follower_prices, publisher.engine.prices._data)
+        assert not snapshot.clear_prices.flags.writeable
+        assert np.array_equal(snapshot.follower_prices, eth[-200:])
+        assert np.isclose(snapshot.correlations[3], np.corrcoef(eth[-200:], btc[-200:])[0, 1])
+        # корреляция скорректированных цен - по скользящим статистикам, совпадает с расчётом по окну
+        assert np.isclose(snapshot.correlations[0], np.corrcoef(snapshot.clear_prices, btc[-200:])[0, 1])
+
+        shared = SharedSnapshots(200, 'ETHUSDT', 'BTCUSDT')
+        try:
+            reader = SharedSnapshots(200, 'ETHUSDT', 'BTCUSDT', name=shared.name)
+            assert reader.read() is None
+            shared.write(snapshot)
+            copy = reader.read()
+            assert copy.version == 1 and copy.correlations == snapshot.correlations
+            assert np.array_equal(copy.time, snapshot.time)
+            assert np.array_equal(copy.clear_prices, snapshot.clear_prices, equal_nan=True)
+            reader.close()
+        finally:
+            shared.close()
+
+    def test_snapshots_are_lazy(self):
+        eth, btc = random_walks(300, seed=10)
+        engine = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT'}), window=200)
+        publisher = SnapshotPublisher(engine, 'ETHUSDT', lock=threading.Lock())
+        pushed = []
+        for i in range(300):
+            engine.on_bar(np.array([btc[i], eth[i]]), i * 10 ** 9, 1)
+            publisher.on_bar()
+            if i == 0:
+                # получатели получают снимки не чаще раза в interval
+                publisher.sinks.append(pushed.append)
+        assert len(pushed) == 1 and pushed[0].version == 2
+        # снимок строится при чтении и только после изменения данных
+        snapshot = publisher.latest
+        assert snapshot.version == 300 and publisher.latest is snapshot
+        engine.on_bar(np.array([btc[-1], eth[-1]]), 300 * 10 ** 9, 1)
+        publisher.on_bar()
+        assert publisher.latest.version == 301
+        # после загрузки истории (warm_start) статистики пересчитываются
+        engine.load(engine.time.view().copy(), engine.prices.view()[-200:].copy(), engine.clear.view().copy())
+        assert np.isclose(publisher.publish().correlations[0],
+                          np.corrcoef(engine.clear_series('ETHUSDT'), engine.series('BTCUSDT'))[0, 1])
+
+    def test_decimate_keeps_extrema(self):
+        y = np.random.default_rng(9).normal(0, 1, 10_001)
+        x = np.arange(len(y))
+        dx, dy = decimate(x, y, 1000)
+        assert len(dy) <= 1000 + 11
+        assert np.all(np.diff(dx) > 0)
+        assert dy.max() == y.max() and dy.min() == y.min()
+
+    def test_blitting(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        publisher, _, _ = self.publisher()
+        dashboard = Dashboard(lambda: publisher.latest)
+        dashboard.update()
+        assert dashboard.version == publisher.version
+        assert len(dashboard.lines[0].get_ydata()) == 200
+        # следующий снимок в пределах осей перерисовывает только линии
+        def draw():
+            raise AssertionError('полная перерисовка')
+        dashboard.fig.canvas.draw = draw
+        dashboard.update()
+        publisher.engine.on_bar(publisher.engine.prices.view()[-1], 300 * 10 ** 9, 1)
+        publisher.publish()
+        dashboard.update()
+        assert dashboard.version == publisher.version
+
+
+class TestAlerts:
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        latency = np.random.default_rng(10).lognormal(np.log(2e6), 1, 10_000).astype(np.int64)
+        histogram.record(latency[:5000])
+        histogram.record(latency[5000:])
+        assert histogram.count == 10_000 and histogram.max == latency.max()
+        # ошибка квантиля не больше ширины корзины
+        for q in (0.5, 0.99):
+            assert 1 <= histogram.quantile(q) / np.quantile(latency, q) < 2 ** (1 / 4) + 0.01
+        histogram.reset()
+        assert np.isnan(histogram.quantile(0.5))
+
+    def test_dispatcher(self, tmp_path):
+        class FailingSink:
+            async def send(self, alert):
+                raise ConnectionError('нет соединения')
+
+            async def close(self):
+                pass
+
+        async def dispatch(dispatcher, alerts):
+            task = asyncio.create_task(dispatcher.run())
+            for alert in alerts:
+                dispatcher.emit(alert)
+            await dispatcher.queue.join()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        stdout = io.StringIO()
+        metrics = LatencyMetrics()
+        dispatcher = AlertDispatcher([FailingSink(), StdoutSink(stdout), JsonlSink(tmp_path / 'alerts.jsonl')],
+                                     metrics=metrics, queue_size=2)
+        alerts = [Alert(i * 10 ** 9, 'ETHUSDT', deviation, 1800.0, 0) for i, deviation in enumerate((1.5, -2.0, 3.0))]
+        asyncio.run(dispatch(dispatcher, alerts))
+        # очередь на два сообщения: третье отброшено, ошибка одного получателя не мешает остальным
+        assert dispatcher.dropped == 1
+        assert stdout.getvalue().splitlines()[1].endswith('цена ETHUSDT(CLEAR) уменьшилась от минимальной за прошедшую историю на 2.0')
+        lines = (tmp_path / 'alerts.jsonl').read_text().splitlines()
+        assert [json.loads(line)['deviation'] for line in lines] == [1.5, -2.0]
+        assert metrics['alert'].count == 2
+
+
+class TestBench:
+
+    def test_synthetic_trades(self):
+        batches = synthetic_trades(['BTCUSDT', 'ETHUSDT'], seconds=10, rate=50, seed=3)
+        assert len(batches) == 100
+        assert all(np.array_equal(a.time, b.time) for a, b in
+                   zip(batches[0].values(), synthetic_trades(['BTCUSDT', 'ETHUSDT'], 10, 50, seed=3)[0].values()))
+        ticktime = np.concatenate([batch['ETHUSDT'].time for batch in batches if 'ETHUSDT' in batch])
+        assert np.all(np.diff(ticktime) >= 0)
+        assert 400 < len(ticktime) < 600
+
+    def test_run_and_compare(self):
+        results = run_benchmarks(histories=(60,), pair_counts=(2,), trade_rates=(100,), min_time=0.001)
+        assert {result['stage'] for result in results.values()} == {
+            'Prices.append', 'normalize', 'pearsons_correlation', 'get_clear_price', 'PairEngine.on_bar',
+            'MultiFactorEngine.on_bar', 'lstsq', 'lagged_correlation', 'corrcoef_lags', 'check_for_extremum', 'write_tf_price', 'handle_trades',
+            'OrderBook.apply_diff'}
+        assert all(result['ns_per_op'] > 0 for result in results.values())
+        baseline = {name: dict(result, ns_per_op=result['ns_per_op'] / 2) for name, result in results.items()}
+        baseline.pop('normalize[history=60]')
+        regressions = compare(results, baseline, tolerance=0.5)
+        assert len(regressions) == len(results) - 1
+        assert not compare(results, results)
+
+
+class TestSharding:
+
+    def test_trade_ring_wraparound(self):
+        ring = TradeRing(capacity=8)
+        try:
+            records = np.zeros(20, dtype=TRADE_RECORD)
+            records['time'] = np.arange(20)
+            assert ring.write(records[:5]) == 5
+            assert ring.read(3)['time'].tolist() == [0, 1, 2]
+            # запись через конец буфера, лишние сделки отбрасываются
+            assert ring.write(records[5:12]) == 6
+            assert ring.dropped == 1 and len(ring) == 8
+            attached = TradeRing(capacity=8, name=ring.name)
+            assert attached.read()['time'].tolist() == list(range(3, 11))
+            assert len(ring) == 0 and len(attached.read()) == 0
+            attached.close()
+        finally:
+            ring.close()
+
+    def test_shard_pairs(self):
+        pairs = {'ETHUSDT': 'BTCUSDT', 'LTCUSDT': 'ETHUSDT', 'SOLUSDT': 'BTCUSDT'}
+        shards = shard_pairs(pairs, 2)
+        assert shards == [{'ETHUSDT': 'BTCUSDT', 'SOLUSDT': 'BTCUSDT'}, {'LTCUSDT': 'ETHUSDT'}]
+        assert len(shard_pairs(pairs, 5)) == 3
+
+    def test_workers_match_single_pipeline(self):
+        pairs = {'ETHUSDT': 'BTCUSDT', 'LTCUSDT': 'ETHUSDT', 'SOLUSDT': 'BTCUSDT'}
+        full = Pipeline(PairRegistry(pairs), history=20)
+        shards = shard_pairs(pairs, 2)
+        symbols = full.registry.symbols
+        rings = [TradeRing(capacity=4096) for _ in shards]
+        try:
+            workers = [AnalyticsWorker(Pipeline(PairRegistry(shard), history=20), symbols, [ring], tf=1)
+                       for shard, ring in zip(shards, rings)]
+            for batch in synthetic_trades(symbols, seconds=30, rate=50, seed=5):
+                full.handle_trades(batch)
+                records = np.concatenate([to_records(symbols.index(symbol), columns)
+                                          for symbol, columns in batch.items()])
+                assert set(from_records(records, symbols)) == set(batch)
+                for worker, ring in zip(workers, rings):
+                    ring.write(records)
+                    worker.poll()
+            for worker in workers:
+                for follower in worker.pipeline.registry.followers:
+                    assert np.allclose(worker.pipeline.engine.clear_series(follower), full.engine.clear_series(follower),
+                                       equal_nan=True)
+        finally:
+            for ring in rings:
+                ring.close()
+
+    def test_worker_writes_timeseries(self):
+        class Pipe:
+            def __init__(self, commands):
+                self.commands = commands
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            def execute_command(self, *args):
+                self.commands.append(args)
+
+            def publish(self, channel, message):
+                self.commands.append(('PUBLISH', channel, message))
+
+            async def execute(self, raise_on_error=True):
+                return [True] * len(self.commands)
+
+        class Client:
+            commands = []
+
+            def pipeline(self, transaction=True):
+                return Pipe(self.commands)
+
+            async def aclose(self):
+                pass
+
+        symbols = ['BTCUSDT', 'ETHUSDT']
+        ring = TradeRing(capacity=4096)
+        try:
+            async def run():
+                pipeline = Pipeline(PairRegistry({'ETHUSDT': 'BTCUSDT'}), history=20,
+                                    timeseries=TimeSeriesPublisher(client=Client()))
+                for batch in synthetic_trades(symbols, seconds=10, rate=50, seed=6):
+                    ring.write(np.concatenate([to_records(symbols.index(symbol), columns)
+                                               for symbol, columns in batch.items()]))
+                stop = asyncio.Event()
+                stop.set()
+                # при остановке сделки из буфера дорабатываются, а очередь записи в Redis - записывается
+                await AnalyticsWorker(pipeline, symbols, [ring], tf=1).run(stop)
+                return pipeline.timeseries
+            publisher = asyncio.run(run())
+        finally:
+            ring.close()
+        assert publisher.written > 0 and publisher.queue.empty()
+        assert any(command[0] == 'TS.MADD' for command in Client.commands)
+
+
+class TestOrderBook:
+
+    def test_matches_reference(self):
+        rng = np.random.default_rng(2)
+        book = OrderBook(tick=0.1, levels=256)
+        reference = {'b': {}, 'a': {}}
+        bids = [[f'{100 - 0.1 * i:.1f}', '1'] for i in range(1, 20)]
+        asks = [[f'{100 + 0.1 * i:.1f}', '1'] for i in range(20)]
+        book.load_snapshot(10, bids, asks)
+        initial_base = book.base
+        for side, levels in (('b', bids), ('a', asks)):
+            reference[side].update({float(price): float(qty) for price, qty in levels})
+        update_id = 10
+        mid = 100.0
+        for _ in range(2000):
+            # цена постепенно уходит вверх, сетка стакана сдвигается
+            mid += 0.05
+            changes = {'b': [], 'a': []}
+            for side, sign in (('b', -1), ('a', 1)):
+                for _ in range(rng.integers(1, 6)):
+                    price = round(mid + sign * 0.1 * rng.integers(1 if side == 'b' else 0, 30), 1)
+                    qty = float(rng.choice([0, rng.integers(1, 5)]))
+                    changes[side].append([f'{price:.1f}', str(qty)])
+                    reference[side][price] = qty
+            # заявки, оказавшиеся по другую сторону середины, удаляются
+            for side, crossed in (('b', lambda p: p >= mid), ('a', lambda p: p < mid)):
+                for price in [p for p, q in reference[side].items() if q > 0 and crossed(p)]:
+                    reference[side][price] = 0
+                    changes[side].append([f'{price:.1f}', '0'])
+            assert book.apply_diff(update_id, update_id + 3, update_id, changes['b'], changes['a'])
+            update_id += 3
+            bid, bid_qty, ask, ask_qty = book.top()
+            # уровни ниже сетки отброшены при её сдвиге
+            low = book.base * 0.1 - 1e-9
+            expected_bid = max((p for p, q in reference['b'].items() if q > 0 and p > low), default=np.nan)
+            expected_ask = min((p for p, q in reference['a'].items() if q > 0 and p > low), default=np.nan)
+            assert np.isclose(bid, expected_bid, equal_nan=True) and np.isclose(ask, expected_ask, equal_nan=True)
+            if not np.isnan(expected_bid):
+                assert bid_qty == reference['b'][expected_bid]
+        assert book.base > initial_base
+        # разрыв последовательности изменений
+        assert not book.apply_diff(update_id + 2, update_id + 3, update_id + 1, [], [])
+        assert not book.synced
+
+    def test_microprice_and_flow(self):
+        book = OrderBook(tick=0.5, levels=64)
+        book.load_snapshot(5, [['100', '1']], [['101', '3']])
+        assert book.mid == 100.5 and book.microprice == (100 * 3 + 101 * 1) / 4
+        # изменения старше снимка пропускаются, первое изменение должно содержать номер снимка
+        assert book.apply_diff(1, 4, 0, [['100', '9']], [])
+        assert book.apply_diff(4, 6, 3, [['100', '2']], [])
+        assert book.ofi == 1
+        assert book.apply_diff(7, 8, 6, [], [['101', '5']])
+        assert book.ofi == -1
+        book.on_ticker(9, 100.5, 1, 101, 5)
+        assert book.top() == (100.5, 1, 101, 5) and book.ofi == 0
+
+    def test_book_bars(self):
+        books = OrderBooks(['BTCUSDT', 'ETHUSDT'], tf_ns=1_000_000_000, ticks={'BTCUSDT': 0.1})
+        books['BTCUSDT'].load_snapshot(1, [['100', '1']], [['100.2', '1']])
+        books.advance(500_000_000)
+        books['BTCUSDT'].apply_diff(1, 2, 0, [['100.1', '2']], [])
+        books.advance(1_200_000_000)
+        books['BTCUSDT'].apply_diff(3, 3, 2, [['100.1', '0']], [])
+        bars = books.bar(0)
+        assert np.isclose(bars.mid[0], 100.15) and bars.ofi[0] == 2 and np.isnan(bars.mid[1])
+        assert bars.buys[0] == 3 and bars.sells[0] == 1 and np.isnan(bars.buys[1])
+        # бар следующего таймфрейма ещё не зафиксирован - текущее состояние, накопленный дисбаланс не обнуляется
+        bars = books.bar(1_000_000_000)
+        assert np.isclose(bars.mid[0], 100.1) and bars.ofi[0] == -2
+        books.advance(2_100_000_000)
+        assert books.closed[1_000_000_000].ofi[0] == -2 and books['BTCUSDT'].ofi == 0
+
+    def test_pipeline_mid_price(self, tmp_path):
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT'})
+        books = OrderBooks(registry.symbols, tf_ns=1_000_000_000, ticks={'BTCUSDT': 0.1, 'ETHUSDT': 0.01})
+        books['BTCUSDT'].load_snapshot(1, [['100', '1']], [['100.2', '1']])
+        books['ETHUSDT'].load_snapshot(1, [['10', '1']], [['10.02', '1']])
+        with pytest.raises(ValueError):
+            Pipeline(registry, price='mid')
+        store = BarStore(tmp_path, tf_ns=1_000_000_000)
+        pipeline = Pipeline(registry, history=10, books=books, price='mid', bar_store=store)
+        pipeline.handle_trades({'BTCUSDT': ingest.Trades(np.array([50.0]), np.ones(1), np.array([0])),
+                                'ETHUSDT': ingest.Trades(np.array([5.0]), np.ones(1), np.array([0]))})
+        pipeline.close_idle_bars(now=3_000_000_000)
+        assert np.allclose(pipeline.engine.series('BTCUSDT'), 100.1)
+        assert np.allclose(pipeline.engine.series('ETHUSDT'), 10.01)
+        # в хранилище - цены, по которым считался расчёт, по ним же загружается история при перезапуске
+        times, prices = store.history(registry.symbols, 3_000_000_000, 10)
+        assert len(times) == 2 and np.allclose(prices, [100.1, 10.01])
+        assert store.read('BTCUSDT', 0, 1_000_000_000)['vwap'][0] == 50
+
+    def test_stream_sync(self):
+        snapshots = [
+            {'lastUpdateId': 100, 'bids': [['100.0', '1'], ['99.9', '2']], 'asks': [['100.1', '1.5'], ['100.2', '3']]},
+            {'lastUpdateId': 111, 'bids': [['101.0', '1']], 'asks': [['101.2', '2']]},
+        ]
+        info = {'symbols': [{'symbol': 'BTCUSDT', 'filters': [{'filterType': 'PRICE_FILTER', 'tickSize': '0.10'}]}]}
+
+        class Rest(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = info if self.path.startswith('/fapi/v1/exchangeInfo') else snapshots.pop(0)
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+
+            def log_message(self, *args):
+                pass
+
+        def depth(first, last, prev, bids=(), asks=()):
+            return {'stream': 'btcusdt@depth@100ms', 'data': {'e': 'depthUpdate', 'E': 1, 'T': 1, 's': 'BTCUSDT',
+                                                               'U': first, 'u': last, 'pu': prev,
+                                                               'b': list(bids), 'a': list(asks)}}
+
+        events = [
+            depth(90, 95, 89, bids=[['100.0', '7']]),  # старше снимка
+            depth(96, 102, 95, bids=[['100.0', '3']]),
+            depth(103, 105, 102, bids=[['100.1', '0.5']], asks=[['100.1', '0']]),
+            depth(110, 112, 108, asks=[['101.1', '3']]),  # разрыв - загрузка второго снимка
+            {'stream': 'btcusdt@bookTicker', 'data': {'e': 'bookTicker', 'u': 113, 's': 'BTCUSDT', 'T': 2, 'E': 2,
+                                                      'b': '101.0', 'B': '2', 'a': '101.1', 'A': '2'}},
+        ]
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Rest)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        states = []
+
+        async def send(ws):
+            # первые изменения приходят до загрузки первого снимка
+            for event in events[:3]:
+                await ws.send(json.dumps(event))
+            while stream.snapshots < 1:
+                await asyncio.sleep(0.01)
+            states.append(books['BTCUSDT'].top())
+            for event in events[3:]:
+                await ws.send(json.dumps(event))
+            await ws.wait_closed()
+
+        books = OrderBooks(['BTCUSDT'], tf_ns=1_000_000_000)
+        stream = BookStream(books, rest_url=f'http://127.0.0.1:{server.server_address[1]}')
+        try:
+            async def start():
+                async with websockets.serve(send, '127.0.0.1', 0) as ws_server:
+                    stream.url = f'ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}/stream'
+                    task = asyncio.create_task(stream.run())
+                    for _ in range(500):
+                        if stream.snapshots == 2 and books['BTCUSDT'].quote is not None:
+                            break
+                        await asyncio.sleep(0.01)
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+
+            asyncio.run(start())
+        finally:
+            server.shutdown()
+        assert states == [(100.1, 0.5, 100.2, 3.0)]
+        book = books['BTCUSDT']
+        assert stream.snapshots == 2 and book.update_id == 112
+        assert book.top() == (101.0, 2.0, 101.1, 2.0)
+        book.quote = None
+        assert np.isclose(book.microprice, (101.0 * 3 + 101.1 * 1) / 4)
+
+
+class TestTimeSeries:
+
+    bars = Bars(time=1_696_118_400_000_000_000, open=np.zeros(2), high=np.zeros(2), low=np.zeros(2),
+                close=np.zeros(2), volume=np.ones(2), vwap=np.array([27000.5, 1650.25]), count=np.ones(2, dtype=np.int64))
+
+    def test_bar_samples(self):
+        ticktime, values = bar_samples(['BTCUSDT', 'ETHUSDT'], self.bars, clear=np.array([1649.5]),
+                                       followers=['ETHUSDT'])
+        assert ticktime == 1_696_118_400_000
+        assert values == {'BTCUSDT': {'price': 27000.5}, 'ETHUSDT': {'price': 1650.25},
+                          'ETHUSDT(CLEAR)': {'price': 1649.5}}
+        assert series_labels('ETHUSDT', 'buys') == {'agg_orders': 'True', 'share': 'ETHUSDT', 'name': 'buys'}
+        _, values = bar_samples(['BTCUSDT', 'ETHUSDT'], self.bars, clear=np.array([np.nan]), followers=['ETHUSDT'])
+        assert 'ETHUSDT(CLEAR)' not in values
+
+    def test_queue_is_bounded(self):
+        async def run():
+            publisher = TimeSeriesPublisher(queue_size=2, client=object())
+            for _ in range(5):
+                publisher.emit(0, {})
+            return publisher
+        assert asyncio.run(run()).dropped == 3
+
+    def test_redis(self):
+        if timeseries.aioredis is None:
+            pytest.skip('redis не установлен')
+        url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+
+        async def run():
+            client = timeseries.aioredis.from_url(url)
+            try:
+                await client.execute_command('TS.INFO', 'nonexistent')
+            except Exception as ex:
+                if 'TSDB' not in str(ex):
+                    await client.aclose()
+                    pytest.skip(f'нет сервера Redis с модулем TimeSeries: {ex!r}')
+            prefix = f'TEST{os.getpid()}'
+            symbols = [f'{prefix}BTC', f'{prefix}ETH']
+            pubsub = client.pubsub()
+            await pubsub.subscribe('test_orders_and_prices')
+            publisher = TimeSeriesPublisher(url, channel='test_orders_and_prices')
+            writer = asyncio.create_task(publisher.run())
+            for i in range(3):
+                publisher.emit(*bar_samples(symbols, self.bars._replace(time=self.bars.time + i * 1_000_000_000),
+                                            clear=np.array([1649.5 + i]), followers=[symbols[1]]))
+            await asyncio.wait_for(publisher.queue.join(), 5)
+            series = await client.execute_command('TS.MRANGE', '-', '+', 'WITHLABELS', 'FILTER',
+                                                  f'share={symbols[1]}(CLEAR)', 'agg_prices=True')
+            messages = [message async for message in _messages(pubsub)]
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+            await client.delete(*[f'{share}:price' for share in [*symbols, f'{symbols[1]}(CLEAR)']])
+            await client.aclose()
+            return series, messages
+
+        async def _messages(pubsub):
+            while message := await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.5):
+                yield json.loads(message['data'])
+
+        series, messages = asyncio.run(run())
+        assert [float(value) for _, value in series[0][2]] == [1649.5, 1650.5, 1651.5]
+        assert messages[-1][f'TEST{os.getpid()}ETH(CLEAR)'] == {'time': 1_696_118_402_000, 'price': 1651.5}
+
+
+class TestLeadLag:
+
+    def test_lagged_correlation(self):
+        eth, btc = random_walks(300, seed=4)
+        correlation = lagged_correlation(eth, btc, 5)
+        for lag in range(6):
+            expected = pearsons_correlation(eth[lag:], btc[:len(btc) - lag], False)
+            # нормировка по всему ряду, а не по перекрытию, поэтому совпадение приблизительное
+            assert abs(correlation[lag] - expected) < 0.05
+
+    def test_engine_finds_lag(self):
+        rng = np.random.default_rng(8)
+        window, lag = 200, 3
+        btc_steps = rng.normal(0, 10, 1000)
+        eth_steps = 0.05 * np.r_[np.zeros(lag), btc_steps[:-lag]] + rng.normal(0, 0.1, 1000)
+        eth, btc = 1800 + np.cumsum(eth_steps), 30000 + np.cumsum(btc_steps)
+        engine = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT'}), window=window, max_lag=10, lag_every=50)
+        for i in range(len(eth)):
+            clear, _ = engine.on_bar(np.array([btc[i], eth[i]]), i, 1)
+        assert engine.lags.tolist() == [lag] and engine.lag_correlation[0] > 0.8
+        eth_window = eth[-window:]
+        btc_window = btc[-window - lag:-lag]
+        assert np.isclose(clear[0], get_clear_price(eth_window, btc_window), rtol=1e-9)
+        # с учётом запаздывания влияние ведущей валюты убирается лучше
+        plain = PairEngine(PairRegistry({'ETHUSDT': 'BTCUSDT'}), window=window)
+        for i in range(len(eth)):
+            plain.on_bar(np.array([btc[i], eth[i]]), i, 1)
+        assert np.diff(engine.clear_series('ETHUSDT')[-100:]).std() < np.diff(plain.clear_series('ETHUSDT')[-100:]).std()
+
+    def test_warm_start_with_lag(self, tmp_path):
+        rng = np.random.default_rng(9)
+        window, lag = 100, 3
+        btc_steps = rng.normal(0, 10, 700)
+        eth_steps = 0.05 * np.r_[np.zeros(lag), btc_steps[:-lag]] + rng.normal(0, 0.1, 700)
+        eth, btc = 1800 + np.cumsum(eth_steps), 30000 + np.cumsum(btc_steps)
+        registry = PairRegistry({'ETHUSDT': 'BTCUSDT'})
+        continuous = PairEngine(registry, window=window, max_lag=10, lag_every=50)
+        store = BarStore(tmp_path, tf_ns=10 ** 9)
+        for i in range(500):
+            prices = np.array([btc[i], eth[i]])
+            continuous.on_bar(prices, TestStore.START + i * 10 ** 9, 1)
+            store.append(TestStore.bars(TestStore.START + i * 10 ** 9, prices), registry.symbols)
+        # история последнего окна (после оценки запаздывания) совпадает с историей непрерывного расчёта
+        restarted = PairEngine(registry, window=window, max_lag=10, lag_every=50)
+        warm_start(restarted, store, end=TestStore.START + 500 * 10 ** 9)
+        assert restarted.lags.tolist() == continuous.lags.tolist() == [lag]
+        assert np.allclose(restarted.clear_series('ETHUSDT')[-window:], continuous.clear_series('ETHUSDT')[-window:],
+                           rtol=1e-9)
+        for i in range(500, 700):
+            prices = np.array([btc[i], eth[i]])
+            expected, _ = continuous.on_bar(prices, TestStore.START + i * 10 ** 9, 1)
+            clear, _ = restarted.on_bar(prices, TestStore.START + i * 10 ** 9, 1)
+            assert np.allclose(clear, expected, rtol=1e-9)
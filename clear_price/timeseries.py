@@ -0,0 +1,161 @@
+"""
+Запись баров и скорректированных цен в Redis TimeSeries для истории node.js (/history-data/:ticker/).
+Ряды и их метки - те, которые читает node.js:
+<символ>:price - цена таймфрейма (agg_prices=True, share=<символ>, name=price),
+<символ>:buys и <символ>:sells - объёмы заявок стакана (agg_orders=True, name=buys / sells),
+<ведомая валюта>(CLEAR):price - скорректированная цена (agg_prices=True, share=<ведомая валюта>(CLEAR)).
+Расчёт только кладёт значения таймфрейма в ограниченную очередь (без ожидания), запись выполняется
+отдельной задачей asyncio: всё накопившееся в очереди записывается одним конвейером (pipeline)
+из команд TS.MADD, последний бар публикуется в канал orders_and_prices. Пока Redis отвечает медленно,
+очередь накапливается и следующие пачки становятся больше; при переполнении новые бары отбрасываются.
+"""
+import asyncio
+import json
+import logging
+import math
+
+import numpy as np
+
+from clear_price.bars import Bars
+from clear_price.book import BookBars
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # запись в Redis доступна только при установленном redis
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# время хранения значений рядов в миллисекундах (0 - без ограничения)
+RETENTION_MS = 7 * 24 * 3600 * 1000
+
+# наибольшее количество значений в одной команде TS.MADD
+MADD_CHUNK = 1000
+
+
+def series_labels(share: str, name: str) -> dict[str, str]:
+    """
+    :param share: символ валюты (для скорректированных цен - с суффиксом (CLEAR))
+    :param name: price, buys или sells
+    :return: метки ряда
+    """
+    kind = 'agg_prices' if name == 'price' else 'agg_orders'
+    return {kind: 'True', 'share': share, 'name': name}
+
+
+def bar_samples(symbols: list[str], bars: Bars, prices: np.ndarray | None = None,
+                clear: np.ndarray | None = None, followers: list[str] = (),
+                book_bars: BookBars | None = None) -> tuple[int, dict[str, dict[str, float]]]:
+    """
+    значения рядов за один таймфрейм
+    :param symbols: символы валют в порядке массивов баров
+    :param bars: бары таймфрейма
+    :param prices: цены таймфрейма, по которым считались скорректированные цены (None - vwap)
+    :param clear: скорректированные цены ведомых валют
+    :param followers: ведомые валюты в порядке clear
+    :param book_bars: бары стаканов (None - без рядов заявок)
+    :return: время таймфрейма в миллисекундах и значения {share: {name: значение}}, nan пропускаются
+    """
+    prices = bars.vwap if prices is None else prices
+    values = {}
+    for i, symbol in enumerate(symbols):
+        fields = {'price': prices[i]}
+        if book_bars is not None:
+            fields |= {'buys': book_bars.buys[i], 'sells': book_bars.sells[i]}
+        values[symbol] = {name: float(value) for name, value in fields.items() if not math.isnan(value)}
+    if clear is not None:
+        for follower, value in zip(followers, clear):
+            if not math.isnan(value):
+                values[f'{follower}(CLEAR)'] = {'price': float(value)}
+    return bars.time // 1_000_000, {share: fields for share, fields in values.items() if fields}
+
+
+class TimeSeriesPublisher:
+    """
+    запись значений таймфреймов в ряды Redis TimeSeries и публикация последнего бара
+    """
+    def __init__(self, url: str = 'redis://localhost:6379', channel: str = 'orders_and_prices',
+                 retention_ms: int = RETENTION_MS, queue_size: int = 10_000, client=None):
+        """
+        :param url: адрес сервера Redis с модулем TimeSeries
+        :param channel: канал публикации последнего бара (None - не публиковать)
+        :param retention_ms: время хранения значений создаваемых рядов в миллисекундах
+        :param queue_size: размер очереди таймфреймов, при переполнении новые таймфреймы отбрасываются
+        :param client: клиент redis.asyncio (None - клиент с одним соединением по url)
+        """
+        if client is None:
+            if aioredis is None:
+                raise ImportError('Для записи рядов в Redis нужен пакет redis')
+            # одно соединение: команды конвейера отправляются одним пакетом, ожидание - в задаче записи
+            client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(url, max_connections=1))
+        self.client = client
+        self.channel = channel
+        self.retention_ms = retention_ms
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.created: set[str] = set()  # ключи рядов, созданных с метками
+        self.dropped = 0  # количество отброшенных таймфреймов
+        self.written = 0  # количество записанных значений
+
+    def emit(self, ticktime: int, values: dict[str, dict[str, float]]):
+        """
+        постановка значений таймфрейма в очередь без ожидания (вызывается из потока цикла событий)
+        :param ticktime: время таймфрейма в миллисекундах
+        :param values: значения {share: {name: значение}} (см. bar_samples)
+        """
+        try:
+            self.queue.put_nowait((ticktime, values))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _batch(self) -> list[tuple[int, dict]]:
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def write(self, batch: list[tuple[int, dict]]):
+        """
+        запись пачки таймфреймов одним конвейером: создание новых рядов, TS.MADD и публикация последнего бара
+        """
+        samples, new = [], []
+        for ticktime, values in batch:
+            for share, fields in values.items():
+                for name, value in fields.items():
+                    key = f'{share}:{name}'
+                    samples += [key, ticktime, value]
+                    if key not in self.created:
+                        self.created.add(key)
+                        new.append((key, series_labels(share, name)))
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, labels in new:
+                pipe.execute_command('TS.CREATE', key, 'RETENTION', self.retention_ms, 'DUPLICATE_POLICY', 'LAST',
+                                     'LABELS', *(item for pair in labels.items() for item in pair))
+            for start in range(0, len(samples), 3 * MADD_CHUNK):
+                pipe.execute_command('TS.MADD', *samples[start:start + 3 * MADD_CHUNK])
+            if self.channel is not None:
+                ticktime, values = batch[-1]
+                pipe.publish(self.channel, json.dumps({share: {'time': ticktime, **fields}
+                                                       for share, fields in values.items()}))
+            results = await pipe.execute(raise_on_error=False)
+        for result in results:
+            # ряд уже существует - не ошибка
+            if isinstance(result, Exception) and 'already exists' not in str(result):
+                logger.error(f'Ошибка записи рядов в Redis: {result!r}')
+        self.written += len(samples) // 3
+
+    async def run(self):
+        """
+        запись таймфреймов из очереди, ошибка соединения не останавливает запись следующих пачек
+        """
+        try:
+            while True:
+                batch = [await self.queue.get()] + self._batch()
+                try:
+                    await self.write(batch)
+                except Exception as ex:
+                    logger.error(f'Ошибка записи рядов в Redis: {ex!r}, пропущено таймфреймов: {len(batch)}')
+                    self.created.clear()
+                for _ in batch:
+                    self.queue.task_done()
+        finally:
+            await self.client.aclose()
@@ -0,0 +1,30 @@
+// Вспомогательные функции /history-data (без обращения к Redis)
+
+// линейное слияние отсортированных по времени рядов заявок с рядом цен:
+// для каждой цены берутся значения заявок с тем же временем
+const mergeByTime = (prices, buys, sells) => {
+  const data = new Array(prices.length);
+  let i = 0, j = 0;
+  for (let k = 0; k < prices.length; k++) {
+    const time = prices[k].timestamp;
+    const item = {time: time, price: prices[k].value};
+    while (i < buys.length && buys[i].timestamp < time) i++;
+    if (i < buys.length && buys[i].timestamp === time) item.buys = buys[i].value;
+    while (j < sells.length && sells[j].timestamp < time) j++;
+    if (j < sells.length && sells[j].timestamp === time) item.sells = sells[j].value;
+    data[k] = item;
+  }
+  return data;
+};
+
+// Границы страницы по её последнему значению цены last (мс).
+// С прореживанием значение - начало интервала bucket: интервал заканчивается в last + bucket - 1,
+// поэтому заявки берутся до конца интервала, а следующая страница начинается со следующего интервала
+// (иначе Redis заново агрегирует остаток интервала last и на границе страниц появляется неполное значение).
+// next не задаётся, если страница неполная (больше значений нет)
+const pageBounds = (last, count, limit, bucket) => {
+  const end = bucket ? last + bucket - 1 : last;
+  return {end: end, next: count === limit ? end + 1 : undefined};
+};
+
+module.exports = {mergeByTime, pageBounds};
@@ -0,0 +1,56 @@
+// node --test
+const test = require("node:test");
+const assert = require("node:assert");
+const {mergeByTime, pageBounds} = require("./history");
+
+// прореживание ряда как TS.RANGE ... AGGREGATION avg bucket (интервалы от эпохи, время - начало интервала)
+const aggregate = (samples, start, end, bucket, limit) => {
+  const buckets = new Map();
+  for (const {timestamp, value} of samples) {
+    if (timestamp < start || timestamp > end) continue;
+    const key = timestamp - timestamp % bucket;
+    const item = buckets.get(key) || {sum: 0, count: 0};
+    item.sum += value;
+    item.count++;
+    buckets.set(key, item);
+  }
+  return [...buckets].sort((a, b) => a[0] - b[0]).slice(0, limit)
+    .map(([timestamp, {sum, count}]) => ({timestamp, value: sum / count}));
+};
+
+test("merge by time", () => {
+  const prices = [{timestamp: 1, value: 10}, {timestamp: 2, value: 11}, {timestamp: 4, value: 12}];
+  assert.deepStrictEqual(mergeByTime(prices, [{timestamp: 2, value: 5}], [{timestamp: 0, value: 1}, {timestamp: 4, value: 7}]),
+    [{time: 1, price: 10}, {time: 2, price: 11, buys: 5}, {time: 4, price: 12, sells: 7}]);
+});
+
+test("pages across bucket boundaries", () => {
+  const prices = [], buys = [];
+  for (let t = 0; t < 1000; t += 7) {
+    prices.push({timestamp: t, value: t});
+    buys.push({timestamp: t, value: 1});
+  }
+  const bucket = 50, limit = 3;
+  const expected = aggregate(prices, 0, Infinity, bucket, Infinity);
+  const pages = [];
+  let start = 0;
+  for (;;) {
+    const samples = aggregate(prices, start, Infinity, bucket, limit);
+    const {end, next} = pageBounds(samples[samples.length - 1].timestamp, samples.length, limit, bucket);
+    const orders = aggregate(buys, start, end, bucket, Infinity);
+    pages.push(...mergeByTime(samples, orders, []));
+    // заявки последнего интервала страницы не обрезаны
+    assert.strictEqual(orders.length, samples.length);
+    if (next === undefined) break;
+    start = next;
+  }
+  // страницы без повторов и неполных значений на границах совпадают с запросом без страниц
+  assert.deepStrictEqual(pages.map((item) => [item.time, item.price]),
+                         expected.map((item) => [item.timestamp, item.value]));
+  assert.ok(pages.every((item) => item.buys === 1));
+});
+
+test("pages without buckets", () => {
+  assert.deepStrictEqual(pageBounds(120, 10, 10, undefined), {end: 120, next: 121});
+  assert.deepStrictEqual(pageBounds(120, 4, 10, undefined), {end: 120, next: undefined});
+});
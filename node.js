@@ -12,6 +12,47 @@ const io = require("socket.io")(server, {
 });
 
 const redis = require("redis");
+const {mergeByTime, pageBounds} = require("./history");
+
+// количество последних значений каждого ключа, которые получает клиент
+const RING_SIZE = 10;
+// наименьший интервал между рассылками изменений ключа в мс
+const EMIT_INTERVAL = Number(process.env.EMIT_INTERVAL) || 250;
+
+// кольцевой буфер фиксированного размера: добавление без копирования массива
+class Ring {
+  constructor(size) {
+    this.items = new Array(size);
+    this.start = 0;
+    this.length = 0;
+  }
+
+  push(item) {
+    const size = this.items.length;
+    this.items[(this.start + this.length) % size] = item;
+    if (this.length < size) {
+      this.length++;
+    } else {
+      this.start = (this.start + 1) % size;
+    }
+  }
+
+  last() {
+    return this.items[(this.start + this.length - 1) % this.items.length];
+  }
+
+  replaceLast(item) {
+    this.items[(this.start + this.length - 1) % this.items.length] = item;
+  }
+
+  toArray() {
+    const result = new Array(this.length);
+    for (let i = 0; i < this.length; i++) {
+      result[i] = this.items[(this.start + i) % this.items.length];
+    }
+    return result;
+  }
+}
 
 
 const main = async () => {
@@ -48,48 +89,57 @@ const main = async () => {
       res.send(`server ${typeof(redisClientPub)==="object"}`);
     });
 
+    // агрегации, которые можно запросить у Redis для прореживания длинных диапазонов
+    const AGGREGATIONS = ["avg", "sum", "min", "max", "range", "count", "first", "last",
+                          "std.p", "std.s", "var.p", "var.s", "twa"];
+    // наибольшее количество значений цены на одной странице
+    const MAX_PAGE = 10000;
+
+    // История цен и заявок валюты.
+    // Параметры: start, end - диапазон времени в мс; bucket (мс) и aggregation - прореживание на стороне Redis;
+    // limit - размер страницы, следующая страница запрашивается со start = next из ответа.
     app.get("/history-data/:ticker/",  cors(), async(req, res) => {
 
       const ticker = req.params.ticker
-      const start = req.query.start
-      const end = req.query.end
-
-      const prices = await redisClientPub.ts.mRangeWithLabels(start?start:"-", end?end:"+", `agg_prices=True`)
-      const orders = await redisClientPub.ts.mRangeWithLabels(start?start:"-", end?end:"+", `agg_orders=True`)
-
-      ticker_prices = prices.filter(function (el) {
-        return  el.labels.share === ticker;
-      });
-
-      ticker_orders = orders.filter(function (el) {
-        return  el.labels.share === ticker;
-      });
+      const start = req.query.start ? Number(req.query.start) : "-"
+      const end = req.query.end ? Number(req.query.end) : "+"
+      const limit = Math.min(Number(req.query.limit) || MAX_PAGE, MAX_PAGE)
+
+      const options = {COUNT: limit};
+      const bucket = req.query.bucket ? Number(req.query.bucket) : undefined;
+      if (req.query.bucket) {
+        const aggregation = (req.query.aggregation || "avg").toLowerCase();
+        if (!AGGREGATIONS.includes(aggregation) || !(bucket > 0)) {
+          res.status(400).send({error: "bad bucket or aggregation"});
+          return;
+        }
+        options.AGGREGATION = {type: aggregation.toUpperCase(), timeBucket: bucket};
+      }
 
-      if (ticker_prices[0].samples.length){
-        console.log("samples", ticker_prices[0].samples, ticker_prices[0].samples===true, ticker_prices[0].samples==true)
-
-        ticker_prices = ticker_prices[0].samples.map(({timestamp:timems, value: value})=>({time:timems, price: value}));
-
-        ticker_orders.forEach(function(obj) {
-          let name = obj.labels.name;
-          if (name === "buys"){
-            obj.samples = obj.samples.map(({timestamp:timems, value: value})=>({time:timems, buys: value}));
-          } else if (name === "sells") {
-            obj.samples = obj.samples.map(({timestamp:timems, value: value})=>({time:timems, sells: value}));
-          }
-        });
-
-        const mergeByTime = (arr1, arr2, arr3) =>
-          arr1.map(itm1 => ({
-              ...arr2.find((item) => (item.time === itm1.time) && item),
-              ...arr3.find((item) => (item.time === itm1.time) && item),
-              ...itm1
-        }));
-
-        data = mergeByTime(ticker_prices, ticker_orders[0].samples, ticker_orders[1].samples)
-        res.send({ data: data});
-      } else {
-        res.send({});
+      try {
+        // фильтр по метке share - Redis отдаёт только ряды запрошенной валюты
+        const prices = await redisClientPub.ts.mRangeWithLabels(start, end, [`share=${ticker}`, "agg_prices=True"],
+                                                                options);
+        const samples = prices.length ? prices[0].samples : [];
+        if (!samples.length) {
+          res.send({});
+          return;
+        }
+        // заявки - за тот же интервал, что и полученная страница цен (с прореживанием - до конца последнего интервала)
+        const page = pageBounds(samples[samples.length - 1].timestamp, samples.length, limit, bucket);
+        const ordersEnd = end === "+" ? page.end : Math.min(page.end, end);
+        const orders = await redisClientPub.ts.mRangeWithLabels(start, ordersEnd, [`share=${ticker}`, "agg_orders=True"],
+                                                                {...options, COUNT: undefined});
+        const series = (name) => (orders.find((item) => item.labels.name === name) || {samples: []}).samples;
+
+        const body = {data: mergeByTime(samples, series("buys"), series("sells"))};
+        if (page.next !== undefined) {
+          body.next = page.next;
+        }
+        res.send(body);
+      } catch (err) {
+        console.log(err);
+        res.status(500).send({error: "history query failed"});
       }
     });
 
@@ -100,32 +150,54 @@ const main = async () => {
     });
 
 
+    // ключи, значения которых изменились с последней рассылки
+    const dirty = new Set();
+
     await redisClientSub.subscribe("orders_and_prices", (message) => {
 
-      dict = JSON.parse(message)
+      const dict = JSON.parse(message)
       Object.keys(dict).forEach(key => {
-        if (orders.has(key)){
-          if (orders.get(key).at(-1).time === dict[key].time){
-            orders.get(key)[orders.get(key).length - 1] = dict[key]
-          }
-          else{
-            orders.set(key, [...orders.get(key), dict[key]].slice(-10))
-          }
+        let ring = orders.get(key);
+        if (!ring) {
+          ring = new Ring(RING_SIZE);
+          orders.set(key, ring);
+        }
+        // значение того же времени заменяет последнее
+        if (ring.length && ring.last().time === dict[key].time) {
+          ring.replaceLast(dict[key]);
+        } else {
+          ring.push(dict[key]);
         }
-        else {orders.set(key, [dict[key]])};
-        io.emit(key, { channel: "CHANNEL", message: JSON.stringify(orders.get(key))});
+        dirty.add(key);
       });
     });
 
+    // Рассылка изменений не чаще одного раза за EMIT_INTERVAL: по каждому изменившемуся ключу
+    // значения сериализуются один раз и отправляются только клиентам, подписанным на ключ (комната socket.io)
+    const payload = (key) => ({ channel: "CHANNEL", message: JSON.stringify(orders.get(key).toArray())});
+    setInterval(() => {
+      for (const key of dirty) {
+        const room = io.sockets.adapter.rooms.get(key);
+        if (room && room.size) {
+          io.to(key).emit(key, payload(key));
+        }
+      }
+      dirty.clear();
+    }, EMIT_INTERVAL);
+
     // Creating a websocket connection.
     io.on("connection", (socket) => { 
       console.log('Got connection!');
-        socket.on("subscribe", async (channel) => {
-          console.log('Subscribed!');
+      // подписка на ключ (например ETHUSDT, ETHUSDT(CLEAR) или сообщения ETHUSDT(ALERT)): клиент сразу получает последние значения
+      socket.on("subscribe", (channel) => {
+        socket.join(channel);
+        if (orders.has(channel)) {
+          socket.emit(channel, payload(channel));
+        }
       });
 
-      socket.on("unsubscribe", async (channel) => {
-        await redisClientSub.unsubscribe(channel);
+      socket.on("unsubscribe", (channel) => {
+        socket.leave(channel);
       });
 
       socket.on("send message", async (channel, message) => {